@@ -0,0 +1,535 @@
+"""
+attachments.py
+"""
+
+import errno
+import hashlib
+import hmac
+import logging
+import mimetypes
+import mmap
+import os
+import socket
+import time
+import urllib
+from collections import OrderedDict
+
+
+LOG = logging.getLogger(__name__)
+DEFAULT_CACHE_LIMIT = 1024  # megabytes of downloaded attachments on disk
+# Attachments with a local URL (the least recently rendered are dropped)
+MAX_LINKS = 10000
+MAX_REQUEST_SIZE = 8192  # bytes of HTTP request headers
+SEND_CHUNK_SIZE = 2 ** 16  # bytes per send() call
+DOWNLOAD_POLL_INTERVAL = 0.5  # seconds between download completion checks
+# Seconds a download of unknown size must not grow to be complete
+DOWNLOAD_SETTLE_TIME = 5
+# Suffix of the completely downloaded files, the only ones served
+COMPLETE_SUFFIX = ".complete"
+DOWNLOAD_TIMEOUT = 600  # seconds
+BIND_RETRY_INTERVAL = 5  # seconds (e.g. while a previous process holds it)
+
+# HTTP connection states
+READING = "reading"  # reading the request
+WAITING = "waiting"  # waiting for the download of the attachment
+SENDING = "sending"  # sending the response
+
+RESPONSE_REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+def message_attachments(message):
+    """Returns the attachments (dicts with 'id', 'name' and 'size')
+    of a Flow message.
+    """
+    return message.get("attachments") or []
+
+
+def message_text(gateway, session, channel, message):
+    """Returns the text of a Flow message followed by its attachments:
+    their name and local URL (see AttachmentServer), or only their
+    name if attachments are not served.
+    """
+    text = message["text"]
+    for attachment in message_attachments(message):
+        url = ""
+        if gateway.attachment_server and session.account.attachment_dir:
+            url = " " + gateway.attachment_server.link(
+                session, channel, attachment)
+        text += "%s[%s%s]" % (" " if text else "", attachment["name"], url)
+    return text
+
+
+def parse_range(header, size):
+    """Parses the 'Range' header of a request for a 'size' bytes file
+    (only single byte ranges are supported).
+    Returns an inclusive (start, end) tuple, or 'None' to send the
+    whole file.
+    Raises ValueError if the range cannot be satisfied.
+    """
+    unit, _, byte_range = header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_range:
+        return None
+    start, _, end = byte_range.strip().partition("-")
+    if not start:
+        # Suffix range: the last 'end' bytes
+        start = max(0, size - int(end))
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError("range %r of %d bytes" % (header, size))
+    return (start, end)
+
+
+class HTTPConnection(object):
+    """An HTTP connection to the attachment server (one request,
+    the connection is closed after the response).
+    """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.state = READING
+        self.request = b""
+        self.method = ""
+        self.target = ""
+        self.headers = {}
+        self.path = ""  # path of the file being sent
+        self.__output = b""  # response headers not sent yet
+        self.__fd = None
+        self.__map = None  # mmap of the file
+        self.__offset = 0
+        self.__end = 0  # end offset (exclusive) of the body
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_request(self):
+        """Reads from the socket.
+        Returns True once the request headers are complete.
+        Raises ValueError if the request is too long or malformed.
+        """
+        data = self.sock.recv(4096)
+        if not data:
+            raise ValueError("connection closed")
+        self.request += data
+        if b"\r\n\r\n" not in self.request:
+            if len(self.request) > MAX_REQUEST_SIZE:
+                raise ValueError("request too long")
+            return False
+        lines = self.request.split(b"\r\n\r\n", 1)[0].split(b"\r\n")
+        (self.method, target, _) = lines[0].split(b" ", 2)
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            self.headers[name.strip().lower()] = value.strip()
+        self.target = urllib.unquote(target)
+        return True
+
+    def send_error(self, status):
+        """Queues an error response."""
+        body = "%d %s\n" % (status, RESPONSE_REASONS[status])
+        self.__output = self.__response_headers(status, [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(body)))]) + body
+        self.state = SENDING
+
+    def send_file(self, path, name):
+        """Queues the response with the file at 'path' (the file is
+        mapped, its pages are only read as they are sent).
+        """
+        try:
+            self.__fd = os.open(path, os.O_RDONLY)
+        except OSError as os_err:
+            LOG.error("Could not open attachment '%s': %s", path, os_err)
+            self.send_error(404)
+            return
+        self.path = path
+        size = os.fstat(self.__fd).st_size
+        status = 200
+        (start, end) = (0, size - 1)
+        headers = [
+            ("Content-Type",
+             mimetypes.guess_type(name)[0] or "application/octet-stream"),
+            ("Content-Disposition", "inline; filename=\"%s\"" % (
+                urllib.quote(name.encode("utf-8")))),
+            ("Accept-Ranges", "bytes"),
+            ("X-Content-Type-Options", "nosniff"),
+        ]
+        if "range" in self.headers and size:
+            try:
+                byte_range = parse_range(self.headers["range"], size)
+            except ValueError:
+                self.close_file()
+                self.__output = self.__response_headers(416, [
+                    ("Content-Range", "bytes */%d" % size),
+                    ("Content-Length", "0")])
+                self.state = SENDING
+                return
+            if byte_range:
+                status = 206
+                (start, end) = byte_range
+                headers.append(("Content-Range", "bytes %d-%d/%d" % (
+                    start, end, size)))
+        headers.append(("Content-Length", str(end + 1 - start)))
+        self.__output = self.__response_headers(status, headers)
+        if self.method == b"GET":
+            (self.__offset, self.__end) = (start, end + 1)
+        if self.__end > self.__offset:
+            self.__map = mmap.mmap(self.__fd, 0, access=mmap.ACCESS_READ)
+        self.state = SENDING
+
+    @staticmethod
+    def __response_headers(status, headers):
+        """Returns the encoded status line and headers of a response."""
+        lines = ["HTTP/1.1 %d %s" % (status, RESPONSE_REASONS[status])]
+        lines.extend("%s: %s" % header for header in headers)
+        lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+    def write(self):
+        """Sends the next part of the response.
+        Returns True once the whole response is sent.
+        """
+        if self.__output:
+            sent = self.sock.send(self.__output)
+            self.__output = self.__output[sent:]
+            return False
+        if self.__offset >= self.__end:
+            return True
+        count = min(SEND_CHUNK_SIZE, self.__end - self.__offset)
+        sent = self.sock.send(buffer(self.__map, self.__offset, count))
+        self.__offset += sent
+        self.server.gateway.stats.incr("attachments.bytes_sent", sent)
+        return self.__offset >= self.__end
+
+    def close_file(self):
+        """Closes the file being sent (if any)."""
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        self.path = ""
+
+    def close(self):
+        """Closes the connection."""
+        self.close_file()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class AttachmentServer(object):
+    """Local HTTP server of the attachments of the Flow messages.
+    Attachments are rendered in the messages as local URLs; the first
+    request of an attachment starts its download by Flow (to the
+    account's 'attachment-dir'), concurrent requests of the same
+    attachment wait for the same download. Downloaded files are served
+    from a mmap with Range support, and the least recently
+    served ones are removed when they go over the cache size limit.
+    It runs on the gateway main loop (non-blocking sockets, timers).
+    """
+
+    def __init__(self, gateway, port, cache_limit):
+        """Arguments:
+        gateway : FlowIRCGateway instance.
+        port : integer, listening port (local connections only).
+        cache_limit : integer, bytes of downloaded attachments on disk.
+        """
+        self.gateway = gateway
+        self.port = port
+        self.cache_limit = cache_limit
+        self.listener = None
+        self.__connections = {}  # socket --> HTTPConnection instance
+        # URL token --> (account name, orgId, channelId, attachment)
+        self.__links = OrderedDict()
+        self.__downloads = {}  # path --> list of waiting HTTPConnection
+        self.__cache = OrderedDict()  # path --> size, least recent first
+        self.__cache_size = 0
+        self.__scanned_dirs = set()  # attachment dirs in self.__cache
+        self.__secret = os.urandom(16)
+        for account in gateway.accounts.values() + [
+                account_session.account
+                for account_session in gateway.sessions.values()]:
+            if account.attachment_dir:
+                self.__scan(account.attachment_dir)
+        self.__evict()
+        self.bind()
+
+    def __scan(self, directory):
+        """Adds the complete downloads left in an attachment directory
+        (e.g. by a previous process) to the cache, by time of last use
+        (see __send), so they count in its size limit.
+        """
+        if directory in self.__scanned_dirs:
+            return
+        self.__scanned_dirs.add(directory)
+        try:
+            names = os.listdir(directory)
+        except OSError as os_err:
+            LOG.warning("Could not list attachment directory '%s': %s",
+                        directory, os_err)
+            return
+        files = []
+        for name in names:
+            if not name.endswith(COMPLETE_SUFFIX):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+        for (_, path, size) in sorted(files):
+            if path not in self.__cache:
+                self.__cache[path] = size
+                self.__cache_size += size
+
+    def bind(self):
+        """Binds the listening socket (retried later if the port
+        is not available).
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            # Listen to local connections only
+            sock.bind(("localhost", self.port))
+        except socket.error as sock_err:
+            LOG.error("Could not bind attachments port %s: %s, "
+                      "retrying in %d seconds.",
+                      self.port, sock_err, BIND_RETRY_INTERVAL)
+            sock.close()
+            self.gateway.timers.schedule(BIND_RETRY_INTERVAL, self.bind)
+            return
+        sock.listen(5)
+        sock.setblocking(0)
+        self.listener = sock
+        LOG.info("Serving attachments on port %d.", self.port)
+
+    def close(self):
+        """Closes the listening socket and the connections."""
+        for connection in self.__connections.values():
+            connection.close()
+        self.__connections = {}
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+
+    def readable_sockets(self):
+        """Returns the sockets to select() for reading."""
+        sockets = [sock for sock, connection in self.__connections.items()
+                   if connection.state == READING]
+        if self.listener:
+            sockets.append(self.listener)
+        return sockets
+
+    def writable_sockets(self):
+        """Returns the sockets to select() for writing."""
+        return [sock for sock, connection in self.__connections.items()
+                if connection.state == SENDING]
+
+    def owns(self, sock):
+        """Returns True if 'sock' is a socket of the server."""
+        return sock is self.listener or sock in self.__connections
+
+    def link(self, session, channel, attachment):
+        """Returns the local URL of an attachment of a message
+        of 'channel'.
+        """
+        token = hmac.new(
+            self.__secret,
+            (u"%s/%s" % (session.account.name, attachment["id"])).encode(
+                "utf-8"),
+            hashlib.sha1).hexdigest()[:20]
+        self.__links.pop(token, None)
+        self.__links[token] = (session.account.name,
+                               channel.organization_id,
+                               channel.channel_id,
+                               attachment)
+        if len(self.__links) > MAX_LINKS:
+            self.__links.popitem(last=False)
+        return "http://localhost:%d/%s/%s" % (
+            self.port, token,
+            urllib.quote(attachment["name"].encode("utf-8")))
+
+    def socket_readable(self, sock):
+        """Handles a readable socket: a new connection or request data."""
+        if sock is self.listener:
+            try:
+                (conn, _) = sock.accept()
+            except socket.error as sock_err:
+                if sock_err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn.setblocking(0)
+            self.__connections[conn] = HTTPConnection(self, conn)
+            return
+        connection = self.__connections[sock]
+        try:
+            if connection.read_request():
+                self.__handle_request(connection)
+        except socket.error as sock_err:
+            if sock_err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.__close(connection)
+        except ValueError:
+            if connection.request:
+                connection.send_error(400)
+            else:
+                self.__close(connection)
+
+    def socket_writable(self, sock):
+        """Handles a writable socket: sends the next part
+        of the response.
+        """
+        connection = self.__connections[sock]
+        try:
+            done = connection.write()
+        except socket.error as sock_err:
+            if sock_err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            done = True
+        if done:
+            self.__close(connection)
+
+    def __close(self, connection):
+        """Closes and forgets an HTTP connection."""
+        connection.close()
+        self.__connections.pop(connection.sock, None)
+
+    def __handle_request(self, connection):
+        """Handles a complete request: the attachment is sent if it was
+        downloaded, otherwise the connection waits for its download.
+        """
+        self.gateway.stats.incr("attachments.requests")
+        if connection.method not in (b"GET", b"HEAD"):
+            connection.send_error(405)
+            return
+        link = self.__links.get(connection.target.lstrip("/").split("/")[0])
+        if not link:
+            connection.send_error(404)
+            return
+        (account_name, oid, channel_id, attachment) = link
+        session = self.gateway.sessions.get(account_name)
+        if not session or not session.flow_initialized:
+            connection.send_error(503)
+            return
+        # Flow downloads the attachments to its attachment directory,
+        # named after their id (see __complete_download)
+        self.__scan(session.account.attachment_dir)
+        path = os.path.join(session.account.attachment_dir, attachment["id"])
+        if os.path.isfile(path + COMPLETE_SUFFIX):
+            self.__send(connection, path + COMPLETE_SUFFIX, attachment)
+            return
+        connection.state = WAITING
+        if path in self.__downloads:
+            # Already being downloaded for another request
+            self.gateway.stats.incr("attachments.coalesced")
+            self.__downloads[path].append(connection)
+            return
+        self.__downloads[path] = [connection]
+        self.gateway.stats.incr("attachments.downloads")
+        self.gateway.call_flow_with_retry(
+            "start_attachment_download",
+            lambda: session.flow_service.start_attachment_download(
+                attachment, oid, channel_id),
+            lambda _: self.__poll_download(
+                path, attachment, time.time() + DOWNLOAD_TIMEOUT),
+            on_failure=lambda _: self.__download_done(path, attachment, 502))
+
+    def __poll_download(self, path, attachment, deadline, last_size=None):
+        """Timer callback, checks whether the download to 'path' completed:
+        the file has the attachment size or, if the size is not known,
+        it did not grow for DOWNLOAD_SETTLE_TIME seconds.
+        Arguments:
+        last_size : integer, size of the file on the previous check
+        (downloads of unknown size).
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        expected_size = attachment.get("size")
+        if size is not None and (size >= expected_size if expected_size
+                                 else size == last_size):
+            self.__complete_download(path, attachment)
+        elif time.time() > deadline:
+            LOG.error("Download of attachment '%s' timed out.", path)
+            self.__download_done(path, attachment, 504)
+        else:
+            self.gateway.timers.schedule(
+                DOWNLOAD_POLL_INTERVAL if expected_size
+                else DOWNLOAD_SETTLE_TIME,
+                self.__poll_download, path, attachment, deadline, size)
+
+    def __complete_download(self, path, attachment):
+        """Renames a complete download to its COMPLETE_SUFFIX name, so
+        partial files (e.g. of a previous process) are never served.
+        """
+        try:
+            os.rename(path, path + COMPLETE_SUFFIX)
+        except OSError as os_err:
+            LOG.error("Could not rename attachment '%s': %s", path, os_err)
+            self.__download_done(path, attachment, 502)
+            return
+        self.__download_done(path, attachment)
+
+    def __download_done(self, path, attachment, error_status=None):
+        """Answers the requests waiting for the download to 'path'."""
+        for connection in self.__downloads.pop(path, []):
+            if connection.sock not in self.__connections:
+                continue  # closed meanwhile
+            if error_status:
+                connection.send_error(error_status)
+            else:
+                self.__send(connection, path + COMPLETE_SUFFIX, attachment)
+        if not error_status:
+            self.__evict()
+
+    def __send(self, connection, path, attachment):
+        """Sends the attachment file and marks it as recently used
+        (its mtime too, for the next process, see __scan).
+        """
+        connection.send_file(path, attachment["name"])
+        if not connection.path:  # could not be opened
+            return
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        if path in self.__cache:
+            self.__cache[path] = self.__cache.pop(path)
+        else:
+            self.__cache[path] = os.path.getsize(path)
+            self.__cache_size += self.__cache[path]
+
+    def __evict(self):
+        """Removes the least recently used attachment files (except the
+        ones being sent) while the cache is over its size limit.
+        """
+        in_use = set(connection.path
+                     for connection in self.__connections.values())
+        for path in list(self.__cache):
+            if self.__cache_size <= self.cache_limit:
+                break
+            if path in in_use:
+                continue
+            self.__cache_size -= self.__cache.pop(path)
+            try:
+                os.remove(path)
+            except OSError as os_err:
+                LOG.debug("Could not remove attachment '%s': %s",
+                          path, os_err)
+            self.gateway.stats.incr("attachments.evicted")
@@ -2,11 +2,26 @@
 channel.py
 """
 
+import time
 from collections import namedtuple
 
 from . import common
 
 
+class MembersNotLoaded(Exception):
+    """Raised by Channel.members when the members of an evicted channel
+    could not be reloaded from Flow (see FlowSession.rehydrate_channel).
+    """
+    pass
+
+
+class HistoryNotLoaded(Exception):
+    """Raised by FlowSession.get_history and FlowSession.get_message when
+    the history of a channel could not be loaded from Flow.
+    """
+    pass
+
+
 class ChannelMember(object):
     """Represents a member of a IRC/Flow channel"""
 
@@ -35,22 +50,82 @@ class ChannelMember(object):
 class Channel(object):
     """Represents a IRC/Flow Channel"""
 
-    def __init__(self, gateway, channel_id, channel_name="",
+    def __init__(self, session, channel_id, channel_name="",
                  organization_id="", organization_name=""):
         """Arguments:
-        gateway : FlowIRCGateway, reference to the FlowIRCGateway object
+        session : FlowSession, reference to the account's session
         channel_id : string, Channel's channelId.
         channel_name : string, Channel's Name.
         organization_id : string, Organization's orgId.
         organization_name : string, Organization's Name.
         """
-        self.gateway = gateway
-        self.members = set()  # set of "channelMember"
+        self.session = session
+        self.__members = set()  # set of "channelMember"
         self.channel_id = channel_id
         self.channel_name = channel_name
         self.organization_id = organization_id
         self.organization_name = organization_name
         self.name_collides = False
+        # Last message or client interaction (see eviction.ChannelEvictor)
+        self.last_used = time.time()
+        self.evicted = False  # members dropped, see evict()
+        self.__evicted_member_count = 0
+
+    def __getstate__(self):
+        """Pickled without the session (see FlowSession.snapshot)."""
+        state = self.__dict__.copy()
+        del state["session"]
+        return state
+
+    def __setstate__(self, state):
+        """Restores a pickled channel (also from a previous version)."""
+        if "members" in state:
+            state["_Channel__members"] = state.pop("members")
+            state["last_used"] = time.time()
+            state["evicted"] = False
+            state["_Channel__evicted_member_count"] = 0
+        self.__dict__.update(state)
+
+    @property
+    def members(self):
+        """Set of the "ChannelMember" of the channel, reloaded from Flow
+        if the channel was evicted.
+        Raises MembersNotLoaded if the reload fails.
+        """
+        if self.evicted:
+            self.session.rehydrate_channel(self)
+        return self.__members
+
+    def loaded_members(self):
+        """Returns the members in memory (none if the channel was
+        evicted), without reloading them.
+        """
+        return self.__members
+
+    def member_count(self):
+        """Returns the number of members (as of the eviction, if the
+        channel was evicted).
+        """
+        if self.evicted:
+            return self.__evicted_member_count
+        return len(self.__members)
+
+    def touch(self):
+        """Marks the channel as used (a message or a client command)."""
+        self.last_used = time.time()
+
+    def can_evict(self):
+        """Returns True if the members of the channel can be evicted."""
+        return True
+
+    def evict(self):
+        """Drops the members of the channel (they are reloaded from Flow
+        the next time they are needed), the name and ids are kept.
+        """
+        self.__evicted_member_count = len(self.__members)
+        self.__members = set()
+        self.evicted = True
+        self.session.directory_changed()
 
     def channel_suffix(self):
         """Returns a suffix with the first last 5 chars of the channelId.
@@ -76,6 +151,7 @@ class Channel(object):
         account_id : string, represents the member accountId
         Returns a 'ChannelMember' instance.
         Returns 'None' if the member does not exist within this channel.
+        Raises MembersNotLoaded (see members).
         """
         for member in self.members:
             if member.account_id == account_id:
@@ -87,13 +163,14 @@ class Channel(object):
         Arguments:
         member : 'ChannelMember' instance, member to add to the channel.
         """
-        self.members.add(member)
+        self.__members.add(member)
+        self.session.directory_changed()
 
 
 class DirectChannel(Channel):
     """Represents a Direct Conversation IRC/Flow Channel"""
 
-    def __init__(self, gateway, channel_id, organization_id="",
+    def __init__(self, session, channel_id, organization_id="",
                  organization_name="", created_on_irc_session=False):
         """Arguments:
         created_on_irc_session : boolean, sets whether the direct conversation
@@ -103,7 +180,7 @@ class DirectChannel(Channel):
             DirectChannel,
             self
         ).__init__(
-            gateway,
+            session,
             channel_id,
             "",
             organization_id,
@@ -111,6 +188,12 @@ class DirectChannel(Channel):
         )
         self.created_on_irc_session = created_on_irc_session
 
+    def can_evict(self):
+        """Direct conversations are not evicted (their IRC name
+        is made from the other member).
+        """
+        return False
+
     def get_irc_name(self):
         """Returns the IRC name of the Channel.
         If the channel was created on the current IRC session,
@@ -131,11 +214,11 @@ class DirectChannel(Channel):
 
     def get_other_dc_member(self):
         """Returns the 'ChannelMember' that is not
-        the logged-in account on this gateway.
+        the logged-in account of the session.
         """
         assert len(self.members) == 2, "%s" % self.members
         for member in self.members:
-            if member.account_id != self.gateway.flow_account_id:
+            if member.account_id != self.session.flow_account_id:
                 return member
         return None
 
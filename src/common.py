@@ -3,11 +3,13 @@ common.py
 """
 
 from datetime import datetime
+import calendar
 import locale
 
 
 VERSION = "0.1"
 CONFIG_FILE_SECTION = "flow-irc-gateway"
+ACCOUNT_SECTION_PREFIX = "account:"
 DEFAULT_ENCODING = "UTF-8"
 DEFAULT_IRC_PORT = "6667"
 
@@ -22,6 +24,56 @@ def get_message_timestamp_string(timestamp_usecs):
         timestamp_secs).strftime("[%Y-%m-%d %H:%M:%S]")
 
 
+def get_server_time_string(timestamp_usecs):
+    """Given a timestamp float in microseconds.
+    Returns an IRCv3 'server-time' string ('%Y-%m-%dT%H:%M:%S.mmmZ', UTC).
+    """
+    timestamp = datetime.utcfromtimestamp(timestamp_usecs / 1.0e+6)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + \
+        "%03dZ" % (timestamp.microsecond // 1000)
+
+
+def parse_server_time_string(server_time):
+    """Given an IRCv3 'server-time' string.
+    Returns the timestamp in microseconds.
+    Raises ValueError if the string is not valid.
+    """
+    seconds, _, fraction = server_time.rstrip("Z").partition(".")
+    timestamp = datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S")
+    usecs = int((fraction + "000000")[:6]) if fraction else 0
+    return calendar.timegm(timestamp.timetuple()) * 1000000 + usecs
+
+
+def parse_message_tags(tags):
+    """Given the IRCv3 message tags of a line (without the leading '@').
+    Returns a dict tag name --> unescaped value ('' for tags without value).
+    """
+    escapes = {":": ";", "s": " ", "r": "\r", "n": "\n", "\\": "\\"}
+    parsed = {}
+    for tag in tags.split(";"):
+        if not tag:
+            continue
+        name, _, value = tag.partition("=")
+        unescaped = []
+        chars = iter(value)
+        for char in chars:
+            if char == "\\":
+                char = next(chars, "")
+                char = escapes.get(char, char)
+            unescaped.append(char)
+        parsed[name] = "".join(unescaped)
+    return parsed
+
+
+def escape_message_tag(value):
+    """Returns the IRCv3 escaped form of a message tag value
+    (see parse_message_tags).
+    """
+    escapes = {";": "\\:", " ": "\\s", "\r": "\\r", "\n": "\\n",
+               "\\": "\\\\"}
+    return "".join(escapes.get(char, char) for char in value)
+
+
 def irc_escape(string):
     """Escapes the given 'string' to fulfill IRC channel/nickname constraints.
     Returns a string with ',' replaced with '-' and spaces replaced with '_'.
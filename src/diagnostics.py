@@ -0,0 +1,181 @@
+"""
+diagnostics.py
+"""
+
+import cProfile
+import gc
+import logging
+import os
+import pstats
+import signal
+import time
+from collections import Counter
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4 without the pytracemalloc backport
+    tracemalloc = None
+
+
+LOG = logging.getLogger(__name__)
+DEFAULT_TOP_N = 25
+
+
+def report_path(directory, suffix):
+    """Returns a unique report file path with the given suffix."""
+    return os.path.join(
+        directory,
+        "flow-irc-gateway-%d-%s.%s" % (
+            os.getpid(), time.strftime("%Y%m%d-%H%M%S"), suffix))
+
+
+class Diagnostics(object):
+    """On-demand diagnostics triggered by signals.
+    SIGUSR1 toggles cProfile profiling of the main loop, the stats are
+    written to a file when profiling is turned off.
+    SIGUSR2 writes a memory report (tracemalloc top-N and gateway
+    object counts) to a file.
+    Signal handlers only set flags, the work is done from the main loop
+    on run_pending() (so it never interrupts a handler half-way).
+    Reports are written to files because stdout is /dev/null in daemon mode.
+    """
+
+    def __init__(self, gateway, directory, top_n=DEFAULT_TOP_N,
+                 trace_memory=False):
+        """Arguments:
+        gateway : FlowIRCGateway instance.
+        directory : string, absolute path where the reports are written.
+        top_n : integer, number of entries in the memory report rankings.
+        trace_memory : boolean, start tracemalloc right away (otherwise it
+        starts on the first SIGUSR2 and allocations before it are not traced).
+        """
+        self.gateway = gateway
+        self.directory = directory
+        self.top_n = top_n
+        self.__profiler = None
+        self.__profile_requested = False
+        self.__memory_report_requested = False
+        if trace_memory and tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def install_signal_handlers(self):
+        """Installs the SIGUSR1 and SIGUSR2 handlers."""
+        signal.signal(signal.SIGUSR1, self.__sigusr1_handler)
+        signal.signal(signal.SIGUSR2, self.__sigusr2_handler)
+        # Restart interrupted system calls where possible
+        signal.siginterrupt(signal.SIGUSR1, False)
+        signal.siginterrupt(signal.SIGUSR2, False)
+
+    def __sigusr1_handler(self, sig, frame):
+        """Requests a profiling toggle."""
+        self.__profile_requested = True
+
+    def __sigusr2_handler(self, sig, frame):
+        """Requests a memory report."""
+        self.__memory_report_requested = True
+
+    def run_pending(self):
+        """Runs the diagnostics requested by signals since the last call."""
+        if self.__profile_requested:
+            self.__profile_requested = False
+            self.toggle_profiling()
+        if self.__memory_report_requested:
+            self.__memory_report_requested = False
+            self.write_memory_report()
+
+    def toggle_profiling(self):
+        """Starts profiling, or stops it and writes the stats.
+        Two files are written: a '.prof' file (pstats/snakeviz format) and
+        a '.prof.txt' file with the top cumulative entries.
+        """
+        if not self.__profiler:
+            self.__profiler = cProfile.Profile()
+            self.__profiler.enable()
+            LOG.warning("Profiling enabled.")
+            return
+        self.__profiler.disable()
+        path = report_path(self.directory, "prof")
+        try:
+            self.__profiler.dump_stats(path)
+            with open(path + ".txt", "w") as report:
+                stats = pstats.Stats(self.__profiler, stream=report)
+                stats.sort_stats("cumulative").print_stats(self.top_n * 2)
+            LOG.warning("Profiling disabled, stats written to '%s'.", path)
+        except (IOError, OSError) as io_err:
+            LOG.error("Could not write profiling stats: %s", io_err)
+        self.__profiler = None
+
+    def get_object_counts(self):
+        """Returns a list of (description, count) of the gateway's model
+        (summed over all the sessions).
+        """
+        gateway = self.gateway
+        sessions = gateway.sessions.values()
+        clients = gateway.clients.values()
+        return [
+            ("sessions", len(sessions)),
+            ("organizations",
+             sum(len(session.organizations) for session in sessions)),
+            ("channels", sum(len(session.channels) for session in sessions)),
+            ("channel members",
+             sum(len(channel.loaded_members())
+                 for session in sessions
+                 for channel in session.channels.values())),
+            ("evicted channels",
+             sum(channel.evicted
+                 for session in sessions
+                 for channel in session.channels.values())),
+            ("pending_channels",
+             sum(len(session.pending_channels) for session in sessions)),
+            ("reorder buffer events",
+             sum(len(session.reorder_buffer) for session in sessions)),
+            ("clients", len(clients)),
+            ("client output queues (bytes)",
+             sum(client.write_queue_size() for client in clients)),
+        ]
+
+    def write_memory_report(self):
+        """Writes the memory report file."""
+        path = report_path(self.directory, "mem.txt")
+        try:
+            with open(path, "w") as report:
+                self.__write_memory_report(report)
+            LOG.warning("Memory report written to '%s'.", path)
+        except (IOError, OSError) as io_err:
+            LOG.error("Could not write memory report: %s", io_err)
+
+    def __write_memory_report(self, report):
+        """Writes the memory report sections to the 'report' file object."""
+        report.write("== Gateway objects ==\n")
+        for description, count in self.get_object_counts():
+            report.write("%s: %d\n" % (description, count))
+        for client in self.gateway.clients.values():
+            report.write("  client %s:%s (%s) output buffer: %d\n" % (
+                client.host, client.port,
+                client.session.account.name if client.session else "-",
+                client.write_queue_size()))
+
+        report.write("\n== Counters ==\n")
+        for name, value in self.gateway.stats.snapshot():
+            report.write("%s: %d\n" % (name, value))
+
+        report.write("\n== Live objects by type (top %d) ==\n" % self.top_n)
+        type_counts = Counter(
+            type(obj).__name__ for obj in gc.get_objects())
+        for type_name, count in type_counts.most_common(self.top_n):
+            report.write("%s: %d\n" % (type_name, count))
+
+        report.write("\n== tracemalloc (top %d) ==\n" % self.top_n)
+        if not tracemalloc:
+            report.write("tracemalloc is not available.\n")
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            report.write("tracemalloc started now, send SIGUSR2 again "
+                         "later to get allocation statistics.\n")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        for stat in snapshot.statistics("lineno")[:self.top_n]:
+            report.write("%s\n" % stat)
+        current, peak = tracemalloc.get_traced_memory()
+        report.write("traced memory: current=%d peak=%d\n" % (current, peak))
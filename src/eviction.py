@@ -0,0 +1,121 @@
+"""
+eviction.py
+"""
+
+import gc
+import logging
+import os
+import time
+
+
+LOG = logging.getLogger(__name__)
+DEFAULT_CHANNEL_IDLE_TIME = 900  # seconds
+EVICTION_INTERVAL = 30  # seconds between memory checks
+# Share of the loaded channel members evicted when the budget is
+# exceeded (see ChannelEvictor.run)
+EVICTION_BATCH = 0.25
+
+
+def current_rss():
+    """Returns the resident set size of the process in bytes,
+    or 'None' if it is not available (no /proc).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class ChannelEvictor(object):
+    """Keeps the process RSS under a memory budget by evicting cold
+    channels: the members of the channels with no activity (messages or
+    client commands) for 'idle_time' seconds are dropped, least recently
+    used first, and reloaded from Flow the next time they are needed
+    (see Channel.evict()). The cached replies of the sessions are
+    dropped too.
+    """
+
+    def __init__(self, gateway, budget, idle_time=DEFAULT_CHANNEL_IDLE_TIME):
+        """Arguments:
+        gateway : FlowIRCGateway instance.
+        budget : integer, RSS budget in bytes (0 disables the eviction).
+        idle_time : float, seconds without activity before a channel
+        can be evicted.
+        """
+        self.gateway = gateway
+        self.budget = budget
+        self.idle_time = idle_time
+        self.__rss_warned = False
+        # Loaded channel members allowed while over the budget
+        self.__member_limit = None
+
+    def start(self):
+        """Schedules the periodic memory checks."""
+        self.gateway.timers.schedule(EVICTION_INTERVAL, self.run)
+
+    def run(self):
+        """Timer callback, evicts cold channels if the RSS is over the
+        budget.
+        The memory freed by an eviction is reused by the process but
+        seldom returned to the system, so the RSS does not tell what was
+        freed: once the budget is exceeded the loaded members are kept
+        under EVICTION_BATCH less than they were then, and the next
+        checks only evict the members loaded again beyond that limit.
+        """
+        self.gateway.timers.schedule(EVICTION_INTERVAL, self.run)
+        if not self.budget:
+            return
+        rss = current_rss()
+        if rss is None:
+            if not self.__rss_warned:
+                self.__rss_warned = True
+                LOG.warning("RSS not available, 'memory-budget' ignored.")
+            return
+        stats = self.gateway.stats
+        stats.set_max("eviction.rss_high_water", rss)
+        if rss <= self.budget:
+            self.__member_limit = None
+            return
+        sessions = self.gateway.sessions.values()
+        channels = [channel
+                    for account_session in sessions
+                    for channel in account_session.channels.values()
+                    if channel.can_evict() and not channel.evicted]
+        loaded = sum(len(channel.loaded_members()) for channel in channels)
+        if self.__member_limit is None:
+            if not loaded:
+                return
+            stats.incr("eviction.over_budget")
+            self.__member_limit = int(loaded * (1 - EVICTION_BATCH))
+        if loaded <= self.__member_limit:
+            return
+        stats.incr("eviction.reply_cache_bytes",
+                   sum(account_session.drop_reply_cache()
+                       for account_session in sessions))
+        deadline = time.time() - self.idle_time
+        cold = sorted((channel for channel in channels
+                       if channel.last_used <= deadline),
+                      key=lambda channel: channel.last_used)
+        evicted = 0
+        evicted_members = 0
+        for channel in cold:
+            if loaded - evicted_members <= self.__member_limit:
+                break
+            evicted_members += len(channel.loaded_members())
+            channel.evict()
+            evicted += 1
+        gc.collect()
+        stats.incr("eviction.channels_evicted", evicted)
+        stats.incr("eviction.members_evicted", evicted_members)
+        if loaded - evicted_members > self.__member_limit:
+            LOG.warning("RSS %d MB over the memory budget, %d loaded "
+                        "member(s) over the limit after evicting %d cold "
+                        "channel(s).", rss // 2 ** 20,
+                        loaded - evicted_members - self.__member_limit,
+                        evicted)
+        else:
+            LOG.info("RSS %d MB over the memory budget, evicted %d cold "
+                     "channel(s) (%d member(s)).", rss // 2 ** 20, evicted,
+                     evicted_members)
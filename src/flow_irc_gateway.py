@@ -4,9 +4,16 @@ flow_irc_gateway.py: Flow-IRC-Gateway main script
 """
 
 from __future__ import print_function
+# First import, it takes the process start time (see startup.STARTED)
+from . import startup  # pylint: disable=wrong-import-order
+import errno
+import hmac
+import logging
 import os
 import select
+import tempfile
 import socket
+import sqlite3
 import sys
 import time
 from optparse import OptionParser
@@ -16,372 +23,657 @@ import re
 
 from flow import Flow
 
+from . import attachments
 from . import common
-from .channel import ChannelMember, Channel, DirectChannel
+from . import logger
+from . import diagnostics
+from . import eviction
+from . import handoff
+from . import ratelimit
+from . import scheduler
+from . import sendq
+from . import session
+from . import stats
+from . import store
+from . import subscriptions
+from . import supervisor
+from . import timers
+from . import watchdog
 from .irc_client import IRCClient
-from .notification import NotificationHandler
+
+
+LOG = logging.getLogger(__name__)
+FLOW_RETRY_ATTEMPTS = 5
+DEFAULT_REFRESH_INTERVAL = 600  # seconds
+DEFAULT_HISTORY_REPLAY_LIMIT = 0  # messages per channel (0: no limit)
+# Options only applied on restart (see FlowIRCGateway.reload_config)
+RESTART_OPTIONS = (
+    "username", "server", "port", "db", "schema", "uri", "flowappglue",
+    "attachment_dir", "daemon", "tracemalloc", "workers", "handoff_socket",
+    "message_store", "outbox_dir", "attachment_http_port",
+)
 
 
 class FlowIRCGateway(object):
-    """A Flow-IRC gateway."""
+    """A Flow-IRC gateway.
+    It listens for IRC clients and hosts one FlowSession per Flow account.
+    In single-account mode, all clients use the account given by the
+    'username' option. In multi-account mode, the account is chosen with
+    the IRC PASS or SASL credentials at registration.
+    """
 
-    def __init__(self, options):
+    def __init__(self, options, listeners=None, worker_link=None,
+                 takeover=None):
         """Arguments:
         options : optparse.OptionParser, with the following attributes:
             irc_ports, verbose, debug, show_timestamps, daemon,
-            flowappglue, username, server, port, db, schema, uri
+            flowappglue, username, server, port, db, schema, uri, accounts
+        listeners : list of bound IRC listening sockets (bound on start()
+        if not given).
+        worker_link : supervisor.WorkerLink instance, if the gateway runs
+        as a worker process of the supervisor.
+        takeover : handoff.Takeover instance, state and sockets handed
+        over by the previous gateway process (see restore()).
         """
+        self.options = options
+        self.startup = options.startup  # startup.StartupTimer instance
+        self.listeners = listeners or []
+        self.worker_link = worker_link
+        self.takeover = takeover
+        self.handoff_server = None
+        self.running = True
         self.irc_ports = options.irc_ports
         self.verbose = options.verbose
         self.debug = options.debug
         self.show_timestamps = options.show_timestamps
+        self.sendq_limit = options.sendq_limit
+        self.sendq_policy = options.sendq_policy
+        self.refresh_interval = options.refresh_interval
+        self.history_replay_limit = options.history_replay_limit
+        self.paste_window = options.paste_window
+        self.rate_limits = options.rate_limits
+        self.subscriptions = options.subscriptions
+        self.store = None  # store.MessageStore instance (optional)
+        # attachments.AttachmentServer instance (optional)
+        self.attachment_server = None
 
         gateway_name_limit = 63  # From the RFC.
         self.name = socket.getfqdn()[:gateway_name_limit]
 
-        self.channels = {}  # channelId --> Channel instance.
         self.clients = {}  # Socket --> IRCClient instance.
-        self.organizations = {}  # orgId --> Organization Name
-        self.pending_channels = {}  # channelId --> PendingChannel instance
+        # Account name --> AccountConfig instance (multi-account mode)
+        self.accounts = dict(
+            (account.name, account) for account in options.accounts)
+        self.sessions = {}  # Account name --> FlowSession instance.
 
-        self.client_connected = True
-        self.flow_service = None
-        self.flow_initialized = False
-        self.flow_username = ""
-        self.flow_account_id = ""
-        self.notification_handler = NotificationHandler(self)
+        self.stats = stats.Counters()
+        self.scheduler = scheduler.WorkScheduler(
+            self.stats,
+            options.scheduler_time_slice,
+            options.scheduler_notification_budget)
+        self.timers = timers.TimerWheel()
+        self.diagnostics = diagnostics.Diagnostics(
+            self,
+            options.diagnostics_dir,
+            options.diagnostics_top,
+            options.tracemalloc)
+        self.watchdog = watchdog.StallWatchdog(
+            self.stats, options.stall_threshold)
+        self.evictor = eviction.ChannelEvictor(
+            self,
+            options.memory_budget * 2 ** 20,
+            options.channel_idle_time)
+        self.__reload_requested = False
 
-    def terminate(self):
-        """Terminates the Flow service."""
-        self.flow_service.terminate()
+    def install_signal_handlers(self):
+        """Installs the SIGHUP handler (configuration reload)."""
+        signal.signal(signal.SIGHUP, self.__sighup_handler)
+        signal.siginterrupt(signal.SIGHUP, False)
 
-    def get_member(self, irc_nickname):
-        """Gets a channel member from its IRC nickname.
-        Arguments:
-        irc_nickname : string, IRC nickname of a 'ChannelMember'.
-        Returns a ChannelMember instance or 'None' if not found.
-        """
-        for channel in self.channels.values():
-            for member in channel.members:
-                if member.get_irc_nickname() == irc_nickname:
-                    return member
-        return None
+    def __sighup_handler(self, sig, frame):
+        """Requests a configuration reload."""
+        self.__reload_requested = True
 
-    def get_oid_from_name(self, org_name):
-        """Returns an the orgId given an organization name.
-        Arguments:
-        org_name : string, organization name.
-        Returns an empty string if not found.
+    def reload_config(self):
+        """Reads the command line and '--config' file again and applies
+        the new options to the running gateway: sessions, model and
+        client connections are kept. The options of RESTART_OPTIONS are
+        only applied on restart.
         """
-        for oid, oname in self.organizations.iteritems():
-            if oname == org_name:
-                return oid
-        return ""
+        options = reload_options_and_config(sys.argv)
+        if not options:
+            LOG.error("Configuration not reloaded (bad config).")
+            return
+        old_options = self.options
+        for name in RESTART_OPTIONS:
+            if getattr(options, name) != getattr(old_options, name):
+                LOG.warning("'%s' changed, it is applied on restart.",
+                            name.replace("_", "-"))
+        logger.setup_logging(options)
+        if self.worker_link:
+            # The listeners are shared with the other worker processes
+            options.irc_ports = old_options.irc_ports
+            options.accounts = old_options.accounts
+        else:
+            self.update_listeners(options.irc_ports)
+        self.options = options
+        self.irc_ports = options.irc_ports
+        self.verbose = options.verbose
+        self.debug = options.debug
+        self.show_timestamps = options.show_timestamps
+        self.sendq_limit = options.sendq_limit
+        self.sendq_policy = options.sendq_policy
+        self.history_replay_limit = options.history_replay_limit
+        self.paste_window = options.paste_window
+        self.rate_limits = options.rate_limits
+        self.subscriptions = options.subscriptions
+        if not self.refresh_interval and options.refresh_interval:
+            self.refresh_interval = options.refresh_interval
+            self.schedule_refresh()
+        self.refresh_interval = options.refresh_interval
+        self.scheduler.configure(options.scheduler_time_slice,
+                                 options.scheduler_notification_budget)
+        self.diagnostics.directory = options.diagnostics_dir
+        self.diagnostics.top_n = options.diagnostics_top
+        if self.attachment_server:
+            self.attachment_server.cache_limit = \
+                options.attachment_cache_limit * 2 ** 20
+        self.evictor.budget = options.memory_budget * 2 ** 20
+        self.evictor.idle_time = options.channel_idle_time
+        self.watchdog.threshold = options.stall_threshold
+        self.update_accounts(options)
+        for client in self.clients.values():
+            client.reconfigure()
+        self.stats.incr("config.reloads")
+        LOG.info("Configuration reloaded.")
 
-    def get_member_account_id(self, username):
-        """Returns an accountId string from Flow given the username.
-        Arguments:
-        username : string, Flow username of the account.
-        Returns an empty string if not found.
+    def update_accounts(self, options):
+        """Applies the reloaded account configurations: new logins use
+        them and running sessions get the new settings (the Flow service
+        of a session whose Flow username changed is only restarted on
+        restart).
         """
-        try:
-            member_peer_data = self.flow_service.get_peer(username)
-            if member_peer_data:
-                return member_peer_data["accountId"]
-        except Flow.FlowError as flow_err:
-            self.print_debug("get_peer: '%s'" % str(flow_err))
-        return ""
+        if options.accounts:
+            self.accounts = dict(
+                (account.name, account) for account in options.accounts)
+        for name, account_session in self.sessions.items():
+            account = self.accounts.get(name)
+            if not self.multi_account():
+                account = account_session.account._replace(
+                    sendq_limit=options.sendq_limit,
+                    notification_budget=(
+                        options.scheduler_notification_budget))
+            if account and account.username == \
+                    account_session.account.username:
+                account_session.account = account
+            account_session.show_timestamps = options.show_timestamps
 
-    def transmit_message_to_channel(self, channel, message_text):
-        """Sends a message using Flow.send_message.
-        Arguments:
-        channel : Channel instance
-        message_test : Text to be sent to the channel.
-        Returns True if the message was sent successfully.
+    def update_listeners(self, ports):
+        """Binds the listeners of the new IRC ports and closes the
+        listeners of the ports that are no longer configured.
         """
-        try:
-            message_id = self.flow_service.send_message(
-                channel.organization_id,
-                channel.channel_id,
-                message_text)
-            return message_id != ""
-        except Flow.FlowError as flow_err:
-            self.print_debug("send_message: '%s'" % str(flow_err))
-            return False
-
-    def create_direct_channel(self,
-                              account_id,
-                              account_username,
-                              oid,
-                              organization_name):
-        """Creates a direct conversation channel.
-        Arguments:
-        account_id : string, receiver's accountId.
-        account_username : string, receiver's username.
-        oid : string, orgId the two members share.
-        organization_name : Name of the Organization the two members share.
-        Returns a 'Channel' instance.
-        If there's an error in the channel creation, then 'None' is returned.
+        for sock in list(self.listeners):
+            if sock.getsockname()[1] not in ports:
+                LOG.info("Closing port %d.", sock.getsockname()[1])
+                self.listeners.remove(sock)
+                sock.close()
+        bound_ports = [sock.getsockname()[1] for sock in self.listeners]
+        for port in ports:
+            if port not in bound_ports:
+                try:
+                    self.listeners.append(bind_listener(port))
+                except socket.error as sock_err:
+                    LOG.error("Could not bind port %s: %s.", port, sock_err)
+
+    def multi_account(self):
+        """Returns True if the gateway hosts several Flow accounts."""
+        return bool(self.accounts)
+
+    def terminate(self):
+        """Terminates the Flow service of all sessions."""
+        if self.handoff_server:
+            self.handoff_server.close()
+        if self.attachment_server:
+            self.attachment_server.close()
+        for account_session in self.sessions.values():
+            account_session.terminate()
+        if self.store:
+            self.store.close()
+
+    def initialize(self):
+        """Initializes the gateway sessions.
+        In single-account mode, the Flow service of the account is
+        started right away (in the background, unless the state of a
+        previous process is restored), in multi-account mode each
+        session is started on its first login.
+        Returns False if the gateway cannot start.
         """
-        direct_conversation_channel = None
-        try:
-            direct_conversation_cid = \
-                self.flow_service.new_direct_conversation(
-                    oid,
-                    account_id)
-            if direct_conversation_cid:
-                direct_conversation_channel = DirectChannel(
-                    self,
-                    direct_conversation_cid,
-                    oid,
-                    organization_name,
-                    True)
-                current_user = ChannelMember(
-                    self.flow_username,
-                    self.flow_account_id,
-                    organization_name)
-                other_member = ChannelMember(
-                    account_username, account_id, organization_name)
-                direct_conversation_channel.add_member(current_user)
-                direct_conversation_channel.add_member(other_member)
-                self.add_channel(direct_conversation_channel)
-        except Flow.FlowError as flow_err:
-            self.print_debug("NewDirectConversation: '%s'" % str(flow_err))
-        return direct_conversation_channel
+        if self.options.message_store:
+            try:
+                self.store = store.MessageStore(self.options.message_store)
+            except sqlite3.Error as sqlite_err:
+                LOG.error("Could not open the message store '%s': %s",
+                          self.options.message_store, sqlite_err)
+                return False
+        if self.multi_account():
+            return True
+        options = self.options
+        account = session.AccountConfig(
+            "",
+            options.username,
+            None,
+            options.uri,
+            options.db,
+            options.attachment_dir,
+            0,
+            options.sendq_limit,
+            options.scheduler_notification_budget)
+        default_session = session.FlowSession(self, account)
+        self.sessions[account.name] = default_session
+        if not self.takeover:
+            default_session.start_flow_service(options)
+            return True
+        default_session.initialize_flow_service(options)
+        return default_session.flow_initialized
 
-    def get_channel(self, channel_id):
-        """Returns a 'Channel' instance given a channelId.
-        Returns 'None' if not found.
+    def check_credentials(self, account_name, password):
+        """Returns the AccountConfig for the given IRC credentials.
+        Arguments:
+        account_name : string, account name (ignored in single-account mode).
+        password : string, IRC PASS/SASL password.
+        Returns 'None' if the credentials are not valid.
         """
-        try:
-            return self.channels[channel_id]
-        except KeyError:
+        account = self.get_account(account_name)
+        if not self.multi_account():
+            return account
+        if not account or not password or \
+                not hmac.compare_digest(
+                    account.password.encode("utf-8"),
+                    password.encode("utf-8")):
+            self.stats.incr("sessions.failed_logins")
             return None
+        return account
 
-    def get_channel_from_irc_name(self, channel_irc_name):
-        """Returns a 'Channel' instance given the IRC name.
-        Returns 'None' if not found.
+    def get_account(self, account_name):
+        """Returns the AccountConfig of 'account_name'
+        (the single account in single-account mode), or 'None'.
         """
-        for channel in self.channels.values():
-            if channel.get_irc_name() == channel_irc_name:
-                return channel
-        return None
+        if not self.multi_account():
+            return self.sessions[""].account
+        return self.accounts.get(account_name)
 
-    def check_channel_collision(self, channel):
-        """Checks and sets if a 'Channel'
-        instance IRC name collides with other channel.
+    def owns_account(self, account):
+        """Returns True if 'account' is hosted by this process
+        (always, unless running as a supervisor worker).
         """
-        if self.get_channel_from_irc_name(channel.get_irc_name()):
-            channel.name_collides = True
+        return not self.worker_link or self.worker_link.owns(account.name)
 
-    def get_channels(self, oid, org_name):
-        """Loads all channels of a given organization
+    def get_session(self, account, wait=True):
+        """Returns the FlowSession of 'account'.
+        The session is created (and its Flow service started) on the
+        first login of the account.
         Arguments:
-        oid : string, orgId of the Organization
-        org_name : string, Name of the Organization
+        account : AccountConfig instance.
+        wait : boolean, if False the Flow service is started in the
+        background (the session is returned with 'flow_starting' set,
+        see finish_session_starts()).
+        Returns 'None' if the session could not be started.
         """
-        channels = self.flow_service.enumerate_channels(oid)
-        for channel in channels:
-            channel_name = channel["name"]
-            direct_channel = channel["purpose"] == "direct message"
-            if direct_channel:
-                irc_channel = DirectChannel(
-                    self, channel["id"], oid, org_name)
-            else:
-                irc_channel = Channel(
-                    self, channel["id"], channel_name, oid, org_name)
-                self.check_channel_collision(irc_channel)
-            self.get_channel_members(irc_channel)
-            self.add_channel(irc_channel)
-
-    def get_orgs_and_channels(self):
-        """Loads all Organizations and Channels the account is member of."""
-        self.organizations = {}
-        self.channels = {}
-        orgs = self.flow_service.enumerate_orgs()
-        for org in orgs:
-            oid = org["id"]
-            org_name = org["name"]
-            self.organizations[oid] = org_name
-            self.get_channels(oid, org_name)
-
-    def get_local_account(self):
-        """Returns the first local Flow account on this device.
-        It returns the username string.
-        Returns 'None' if there is no account on the device.
+        account_session = self.sessions.get(account.name)
+        if not account_session:
+            account_session = session.FlowSession(self, account)
+            if not wait:
+                account_session.start_flow_service(self.options)
+                self.sessions[account.name] = account_session
+                return account_session
+            account_session.initialize_flow_service(self.options)
+            if not account_session.flow_initialized:
+                account_session.terminate()
+                return None
+            self.sessions[account.name] = account_session
+            self.stats.incr("sessions.started")
+            LOG.info("Started session for account '%s'.", account.name)
+        return account_session
+
+    def finish_session_starts(self):
+        """Completes the sessions whose Flow service was started in the
+        background and resumes the registration of their waiting
+        clients. A session that could not start is dropped (and the
+        gateway stops in single-account mode).
         """
-        local_accounts = self.flow_service.enumerate_local_accounts()
-        if not local_accounts:
-            return None
-        return local_accounts[0]["username"]
-
-    def register_callbacks(self):
-        """Registers all the notification types this gateway supports."""
-        self.flow_service.register_callback(
-            Flow.ORG_NOTIFICATION,
-            self.notification_handler.org_notification)
-        self.flow_service.register_callback(
-            Flow.CHANNEL_NOTIFICATION,
-            self.notification_handler.channel_notification)
-        self.flow_service.register_callback(
-            Flow.MESSAGE_NOTIFICATION,
-            self.notification_handler.message_notification)
-        self.flow_service.register_callback(
-            Flow.CHANNEL_MEMBER_NOTIFICATION,
-            self.notification_handler.channel_member_notification)
-
-    def unregister_callbacks(self):
-        """Unregisters all the notification types this gateway supports."""
-        self.flow_service.unregister_callback(Flow.ORG_NOTIFICATION)
-        self.flow_service.unregister_callback(Flow.CHANNEL_NOTIFICATION)
-        self.flow_service.unregister_callback(Flow.MESSAGE_NOTIFICATION)
-        self.flow_service.unregister_callback(Flow.CHANNEL_MEMBER_NOTIFICATION)
-
-    def initialize_flow_service(self, options):
-        """Initializes the Flow Service by logging into the user
-        account and starting up the Flow session.
+        for name, account_session in self.sessions.items():
+            if not account_session.flow_starting or \
+                    not account_session.finish_flow_service_start(
+                        self.options):
+                continue
+            if account_session.flow_initialized:
+                self.stats.incr("sessions.started")
+                LOG.info("Started session for account '%s'.",
+                         name or account_session.flow_username)
+            else:
+                del self.sessions[name]
+                account_session.terminate()
+            for client in list(account_session.waiting_clients):
+                client.session_started(account_session)
+            if not account_session.flow_initialized and \
+                    not self.multi_account():
+                self.terminate()
+                self.running = False
+
+    def transfer_client(self, client, account):
+        """Hands 'client' over to the worker process that hosts 'account'
+        (through the supervisor).
         """
-        self.flow_initialized = False
+        state = client.detach()
         try:
-            self.flow_username = options.username
-            self.flow_service = Flow(
-                "",
-                "",
-                options.flowappglue,
-                options.debug,
-                options.server,
-                options.port,
-                options.db,
-                options.schema,
-                options.attachment_dir)
-            if not self.flow_username:
-                self.flow_username = self.get_local_account()
-            if not self.flow_username:
-                raise Flow.FlowError("Local account not found.")
-            self.flow_service.start_up(self.flow_username, options.uri)
-            self.flow_initialized = True
-        except Flow.FlowError as flow_err:
-            self.print_error("Flow Initialization: '%s'" % str(flow_err))
+            self.worker_link.send_client(
+                account.name, state, client.client_socket)
+            self.stats.incr("workers.clients_transferred")
+        except (IOError, OSError) as io_err:
+            LOG.error("Could not transfer client %s:%s: %s",
+                      client.host, client.port, io_err)
+        client.client_socket.close()
 
-    def add_channel(self, channel):
-        """Adds a 'Channel' instance to the gateway's channel list."""
-        self.channels[channel.channel_id] = channel
+    def receive_client(self):
+        """Takes over a client connection handed over by another worker."""
+        (state, client_socket) = self.worker_link.receive_client()
+        client = IRCClient(self, client_socket)
+        self.clients[client_socket] = client
+        LOG.info("Received connection from %s:%s.", client.host, client.port)
+        client.resume(state)
 
-    def print_info(self, msg):
-        """Prints a info msg string to stdout
-        (if self.verbose is set to True).
+    def handoff_state(self):
+        """Returns the state of the gateway to hand over to a new process
+        (see handoff.HandoffServer) as a (state, handles) tuple, where
+        handles are the file descriptors of the listening and client
+        sockets.
+        Raises handoff.HandoffError while a Flow service is starting.
         """
-        if self.verbose:
-            print(msg)
-            sys.stdout.flush()
+        if any(account_session.flow_starting
+               for account_session in self.sessions.values()):
+            raise handoff.HandoffError("a Flow session is starting")
+        clients = self.clients.values()
+        state = {
+            "version": handoff.HANDOFF_VERSION,
+            "listeners": len(self.listeners),
+            "sessions": dict(
+                (name, account_session.snapshot())
+                for name, account_session in self.sessions.items()),
+            "clients": [client.get_state() for client in clients],
+        }
+        handles = [sock.fileno() for sock in self.listeners] + \
+            [client.client_socket.fileno() for client in clients]
+        return state, handles
 
-    def print_debug(self, msg):
-        """Prints a debug msg string to stdout
-        (if self.debug is set to True).
+    def release_handoff(self):
+        """Stops the gateway after a handoff: the Flow services are
+        terminated and the sockets closed here (the connections stay
+        open in the new process).
         """
-        if self.debug:
-            print(msg)
-            sys.stdout.flush()
-
-    @staticmethod
-    def print_error(msg):
-        """Prints an error msg string to stdout."""
-        sys.stderr.write("%s\n" % msg)
+        for client in self.clients.values():
+            client.detach()
+            client.client_socket.close()
+        for sock in self.listeners:
+            sock.close()
+        self.terminate()
+        self.running = False
 
-    def remove_client(self, client):
-        """Removes 'Client' instance 'client' from the clients map.
-        The gateway stops processing notifications until reconnection.
+    def restore(self):
+        """Restores the state handed over by the previous gateway
+        process: the sessions get their model from the snapshot (instead
+        of loading it from Flow) and the clients go on on the same
+        connections.
         """
-        del self.clients[client.client_socket]
-        self.unregister_callbacks()
-        self.client_connected = False
+        state = self.takeover.state
+        for name, snapshot in state["sessions"].items():
+            account = self.get_account(name)
+            account_session = account and self.get_session(account)
+            if account_session:
+                account_session.restore(snapshot)
+        for sock in self.takeover.listeners:
+            sock.setblocking(0)
+            if sock.getsockname()[1] in self.irc_ports:
+                self.listeners.append(sock)
+            else:
+                sock.close()
+        bound_ports = [sock.getsockname()[1] for sock in self.listeners]
+        self.listeners.extend(bind_listeners(
+            [port for port in self.irc_ports if port not in bound_ports]))
+        for client_state, client_socket in zip(
+                state["clients"], self.takeover.client_sockets):
+            client = IRCClient(self, client_socket)
+            self.clients[client_socket] = client
+            client.resume(client_state)
+        self.stats.incr("handoff.clients", len(state["clients"]))
+        self.takeover = None
 
-    def notify_clients(self, irc_msg):
-        """Sends 'msg' string to all IRC client connections."""
-        for client in self.clients.values():
-            client.message(irc_msg)
+    def report_stats(self):
+        """Timer callback, reports the counters to the supervisor."""
+        try:
+            self.worker_link.send_stats(self.stats)
+        except (IOError, OSError) as io_err:
+            LOG.error("Could not report stats: %s", io_err)
+        self.timers.schedule(supervisor.STATS_INTERVAL, self.report_stats)
 
-    def get_username_from_id(self, account_id):
-        """Returns the username of a given account.
+    def call_flow_with_retry(self, description, func, on_success,
+                             backoff=None, on_failure=None):
+        """Calls 'func()' and then 'on_success(result)'.
+        If 'func' raises Flow.FlowError, the call is retried later
+        (on the gateway timers) with exponential backoff.
         Arguments:
-        account_id : string
+        description : string, name of the call for the logs.
+        func : function, performs the Flow call(s).
+        on_success : function, called with the result of 'func'.
+        backoff : timers.Backoff instance (for the retries).
+        on_failure : function, called with the last Flow.FlowError
+        when the retries are exhausted (optional).
+        """
+        try:
+            result = func()
+        except Flow.FlowError as flow_err:
+            backoff = backoff or timers.Backoff(
+                max_attempts=FLOW_RETRY_ATTEMPTS)
+            delay = backoff.next_delay()
+            if delay is None:
+                self.stats.incr("flow.retries_exhausted")
+                LOG.error("%s: '%s', giving up after %d attempts.",
+                          description, flow_err, backoff.attempts + 1)
+                if on_failure:
+                    on_failure(flow_err)
+                return
+            self.stats.incr("flow.retries")
+            LOG.debug("%s: '%s', retrying in %.1f seconds.",
+                      description, flow_err, delay)
+            self.timers.schedule(delay, self.call_flow_with_retry,
+                                 description, func, on_success, backoff,
+                                 on_failure)
+            return
+        on_success(result)
+
+    def remove_client(self, client):
+        """Removes 'Client' instance 'client' from the clients map
+        (and from its session).
         """
-        peer_data = self.flow_service.get_peer_from_id(account_id)
-        return peer_data["username"] if peer_data else ""
+        del self.clients[client.client_socket]
+        if client.session:
+            client.session.remove_client(client)
 
-    def get_channel_members(self, channel):
-        """Retrieves (via Flow.enumerate_channel_members) and sets
-        all channel members on a given 'Channel' instance.
+    def notification_sources(self):
+        """Returns a list of (process_one_notification, budget)
+        for the sessions with connected clients.
         """
-        members = self.flow_service.enumerate_channel_members(
-            channel.channel_id)
-        for member in members:
-            account_id = member["accountId"]
-            account_username = self.get_username_from_id(account_id)
-            assert account_username
-            if account_username == self.flow_username:
-                self.flow_account_id = account_id
-            channel_member = ChannelMember(
-                account_username, account_id, channel.organization_name)
-            channel.add_member(channel_member)
+        return [(account_session.process_one_notification,
+                 account_session.account.notification_budget)
+                for account_session in self.sessions.values()
+                if account_session.flow_initialized and
+                account_session.client_connected]
 
     def start(self):
         """FlowIRCGateway initialization and main loop"""
-        if not self.flow_initialized:
+        if not self.initialize():
             self.terminate()
             return
+        if self.takeover:
+            self.restore()
+        if not self.listeners:
+            listen_started = time.time()
+            self.listeners = bind_listeners(self.irc_ports)
+            self.startup.record(
+                startup.LISTEN, listen_started, time.time())
         gatewaysockets = []
-        for port in self.irc_ports:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            try:
-                # Listen to local connections only
-                sock.bind(("localhost", port))
-            except socket.error as sock_err:
-                self.print_error(
-                    "Could not bind port %s: %s." %
-                    (port, sock_err))
-                sys.exit(1)
-            sock.listen(5)
-            gatewaysockets.append(sock)
-            del sock
-            self.print_info("Listening on port %d." % port)
-        last_aliveness_check = time.time()
-
-        while True:
+        if self.worker_link:
+            gatewaysockets.append(self.worker_link)
+            self.timers.schedule(supervisor.STATS_INTERVAL, self.report_stats)
+        elif self.options.handoff_socket:
+            self.handoff_server = handoff.HandoffServer(
+                self, self.options.handoff_socket)
+            gatewaysockets.append(self.handoff_server)
+        if self.options.attachment_http_port:
+            self.attachment_server = attachments.AttachmentServer(
+                self,
+                self.options.attachment_http_port,
+                self.options.attachment_cache_limit * 2 ** 20)
+        self.schedule_refresh()
+        self.evictor.start()
+        self.watchdog.start()
+
+        while self.running:
+            self.watchdog.heartbeat()
+            if self.__reload_requested:
+                self.__reload_requested = False
+                self.reload_config()
+            self.diagnostics.run_pending()
+            self.finish_session_starts()
+            if not self.running:
+                break
+            self.timers.advance()
             # Process Flow notifications
-            if self.client_connected:
-                while self.flow_service.process_one_notification(0.05):
-                    pass
+            self.scheduler.run_notifications(
+                self.notification_sources(), 0.05)
             # Process IRC client socket connections
-            (iwtd, owtd, _) = select.select(
-                gatewaysockets +
-                [client.client_socket for client in self.clients.values()],
-                [client.client_socket for client in self.clients.values()
-                 if client.write_queue_size() > 0],
-                [], 0.05)
-            for sock in iwtd:
-                if sock in self.clients:
-                    self.clients[sock].socket_readable_notification()
-                else:
-                    (conn, addr) = sock.accept()
-                    try:
-                        self.clients[conn] = IRCClient(self, conn)
-                        self.print_info("Accepted connection from %s:%s." % (
-                            addr[0], addr[1]))
-                    except socket.error:
-                        try:
-                            conn.close()
-                        except:
-                            pass
-            for sock in owtd:
-                if sock in self.clients:  # client may have been disconnected
-                    self.clients[sock].socket_writable_notification()
-            now = time.time()
-            if last_aliveness_check + 10 < now:
-                for client in self.clients.values():
-                    client.check_aliveness()
-                last_aliveness_check = now
+            readable = self.listeners + gatewaysockets + \
+                [client.client_socket for client in self.clients.values()]
+            writable = [client.client_socket
+                        for client in self.clients.values()
+                        if client.has_pending_output()]
+            if self.attachment_server:
+                readable += self.attachment_server.readable_sockets()
+                writable += self.attachment_server.writable_sockets()
+            try:
+                (iwtd, owtd, _) = select.select(
+                    readable, writable, [],
+                    self.scheduler.select_timeout(0.05))
+            except select.error as select_err:
+                # Interrupted by a signal (e.g. SIGUSR1/SIGUSR2)
+                if select_err.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.scheduler.run_sockets(
+                scheduler.READS, iwtd, self.socket_readable)
+            self.scheduler.run_sockets(
+                scheduler.WRITES, owtd, self.socket_writable)
+            self.scheduler.run_tasks()
+            self.scheduler.end_tick(self.output_backlog())
+
+    def socket_readable(self, sock):
+        """Handles a readable socket: either data from an IRC client
+        or a new connection on a listening socket.
+        """
+        if not self.running:  # handed over in this tick
+            return
+        if sock in self.clients:
+            self.clients[sock].socket_readable_notification()
+            return
+        if sock is self.worker_link:
+            self.receive_client()
+            return
+        if sock is self.handoff_server:
+            self.handoff_server.serve()
+            return
+        if self.attachment_server and self.attachment_server.owns(sock):
+            self.attachment_server.socket_readable(sock)
+            return
+        try:
+            (conn, addr) = sock.accept()
+        except socket.error as sock_err:
+            # Listeners are non-blocking, another worker process
+            # may have accepted the connection first
+            if sock_err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        try:
+            self.clients[conn] = IRCClient(self, conn)
+            LOG.info("Accepted connection from %s:%s.", addr[0], addr[1])
+        except socket.error:
+            try:
+                conn.close()
+            except:
+                pass
+
+    def socket_writable(self, sock):
+        """Handles a writable IRC client (or attachment server) socket."""
+        if not self.running:  # handed over in this tick
+            return
+        if sock in self.clients:  # client may have been disconnected
+            self.clients[sock].socket_writable_notification()
+        elif self.attachment_server and self.attachment_server.owns(sock):
+            self.attachment_server.socket_writable(sock)
+
+    def schedule_refresh(self):
+        """Schedules the next background refresh
+        (if 'refresh-interval' is set).
+        """
+        if self.refresh_interval:
+            self.timers.schedule(self.refresh_interval, self.__refresh)
+
+    def __refresh(self):
+        """Timer callback, queues the background refresh tasks."""
+        for account_session in self.sessions.values():
+            if account_session.client_connected and account_session.clients:
+                self.scheduler.add_task(account_session.reconcile_orgs())
+        self.schedule_refresh()
+
+    def output_backlog(self):
+        """Returns True if any IRC client has its output queue
+        over half its sendq limit.
+        """
+        for client in self.clients.values():
+            if client.write_queue_size() > client.sendq_limit() // 2:
+                return True
+        return False
+
+
+def bind_listeners(ports):
+    """Returns a list of non-blocking listening sockets
+    (local connections only) for the given IRC ports.
+    """
+    listeners = []
+    for port in ports:
+        try:
+            listeners.append(bind_listener(port))
+        except socket.error as sock_err:
+            LOG.error("Could not bind port %s: %s.", port, sock_err)
+            sys.exit(1)
+    return listeners
+
+
+def bind_listener(port):
+    """Returns a non-blocking listening socket (local connections only)
+    for the given IRC port.
+    Raises socket.error if the port cannot be bound.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        # Listen to local connections only
+        sock.bind(("localhost", port))
+    except socket.error:
+        sock.close()
+        raise
+    sock.listen(5)
+    sock.setblocking(0)
+    LOG.info("Listening on port %d.", port)
+    return sock
 
 
 def get_from_config(config, var_name, default_value, isbool=False):
@@ -436,6 +728,112 @@ def read_from_config(opt_parser, options):
     options.irc_ports = get_from_config(config, "irc-ports", options.irc_ports)
     options.show_timestamps = get_from_config(
         config, "show-timestamps", options.show_timestamps)
+    options.log_file = get_from_config(config, "log-file", options.log_file)
+    options.log_payload_limit = get_from_config(
+        config, "log-payload-limit", options.log_payload_limit)
+    options.log_payload_sample = get_from_config(
+        config, "log-payload-sample", options.log_payload_sample)
+    options.diagnostics_dir = get_from_config(
+        config, "diagnostics-dir", options.diagnostics_dir)
+    options.diagnostics_top = get_from_config(
+        config, "diagnostics-top", options.diagnostics_top)
+    options.tracemalloc = get_from_config(
+        config, "tracemalloc", options.tracemalloc, True)
+    options.sendq_limit = get_from_config(
+        config, "sendq-limit", options.sendq_limit)
+    options.sendq_policy = get_from_config(
+        config, "sendq-policy", options.sendq_policy)
+    options.scheduler_time_slice = get_from_config(
+        config, "scheduler-time-slice", options.scheduler_time_slice)
+    options.scheduler_notification_budget = get_from_config(
+        config, "scheduler-notification-budget",
+        options.scheduler_notification_budget)
+    options.refresh_interval = get_from_config(
+        config, "refresh-interval", options.refresh_interval)
+    options.workers = get_from_config(config, "workers", options.workers)
+    options.handoff_socket = get_from_config(
+        config, "handoff-socket", options.handoff_socket)
+    options.message_store = get_from_config(
+        config, "message-store", options.message_store)
+    options.history_replay_limit = get_from_config(
+        config, "history-replay-limit", options.history_replay_limit)
+    options.outbox_dir = get_from_config(
+        config, "outbox-dir", options.outbox_dir)
+    options.paste_window = get_from_config(
+        config, "paste-window", options.paste_window)
+    for command_class in ratelimit.DEFAULT_LIMITS:
+        options.rate_limits[command_class] = get_from_config(
+            config, "rate-limit-" + command_class,
+            options.rate_limits[command_class])
+    options.include_orgs = get_from_config(
+        config, "include-orgs", options.include_orgs)
+    options.exclude_orgs = get_from_config(
+        config, "exclude-orgs", options.exclude_orgs)
+    options.include_channels = get_from_config(
+        config, "include-channels", options.include_channels)
+    options.exclude_channels = get_from_config(
+        config, "exclude-channels", options.exclude_channels)
+    options.direct_conversations_only = get_from_config(
+        config, "direct-conversations-only",
+        options.direct_conversations_only, True)
+    options.attachment_http_port = get_from_config(
+        config, "attachment-http-port", options.attachment_http_port)
+    options.attachment_cache_limit = get_from_config(
+        config, "attachment-cache-limit", options.attachment_cache_limit)
+    options.memory_budget = get_from_config(
+        config, "memory-budget", options.memory_budget)
+    options.channel_idle_time = get_from_config(
+        config, "channel-idle-time", options.channel_idle_time)
+    options.stall_threshold = get_from_config(
+        config, "stall-threshold", options.stall_threshold)
+
+
+def read_accounts_from_config(opt_parser, options, encoding):
+    """Reads the accounts of the multi-account mode from the config.
+    Each account is a '[account:NAME]' section, NAME is the login used
+    with the IRC PASS ('NAME:PASSWORD') or SASL PLAIN credentials.
+    Arguments:
+    opt_parser : optparser.OptionParser instance.
+    options : container object with options, the global options are
+    used as defaults for the account options.
+    encoding : string, encoding of the Flow usernames in the config.
+    Returns a list of session.AccountConfig instances.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(options.config)
+    accounts = []
+    for section in config.sections():
+        if not section.startswith(common.ACCOUNT_SECTION_PREFIX):
+            continue
+        name = section[len(common.ACCOUNT_SECTION_PREFIX):]
+
+        def get_option(var_name, default_value, section=section):
+            """Returns the account option (or 'default_value')."""
+            if config.has_option(section, var_name):
+                return config.get(section, var_name)
+            return default_value
+
+        username = get_option("username", "")
+        password = get_option("password", "")
+        if not name or not username or not password:
+            opt_parser.error("[%s]: account name, 'username' and "
+                             "'password' are required" % section)
+        try:
+            accounts.append(session.AccountConfig(
+                name,
+                username.decode(encoding),
+                password.decode(encoding),
+                get_option("uri", options.uri),
+                get_option("db", options.db),
+                get_option("attachment-dir", options.attachment_dir),
+                int(get_option("max-clients", 0)),
+                int(get_option("sendq-limit", options.sendq_limit)),
+                int(get_option("notification-budget",
+                               options.scheduler_notification_budget))))
+        except ValueError as value_err:
+            opt_parser.error("[%s]: bad config value: %s" %
+                             (section, value_err))
+    return accounts
 
 
 def set_sane_defaults(options):
@@ -452,6 +850,36 @@ def set_sane_defaults(options):
     options.flowappglue = ""
     options.verbose = False
     options.irc_ports = common.DEFAULT_IRC_PORT
+    options.log_file = ""
+    options.log_payload_limit = logger.DEFAULT_PAYLOAD_LIMIT
+    options.log_payload_sample = logger.DEFAULT_PAYLOAD_SAMPLE
+    options.diagnostics_dir = tempfile.gettempdir()
+    options.diagnostics_top = diagnostics.DEFAULT_TOP_N
+    options.tracemalloc = False
+    options.sendq_limit = sendq.DEFAULT_LIMIT
+    options.sendq_policy = sendq.DEFAULT_POLICY
+    options.scheduler_time_slice = scheduler.DEFAULT_TIME_SLICE
+    options.scheduler_notification_budget = \
+        scheduler.DEFAULT_NOTIFICATION_BUDGET
+    options.refresh_interval = DEFAULT_REFRESH_INTERVAL
+    options.workers = 0
+    options.handoff_socket = ""
+    options.message_store = ""
+    options.history_replay_limit = DEFAULT_HISTORY_REPLAY_LIMIT
+    options.outbox_dir = ""
+    options.paste_window = 0
+    options.rate_limits = dict(ratelimit.DEFAULT_LIMITS)
+    options.include_orgs = ""
+    options.exclude_orgs = ""
+    options.include_channels = ""
+    options.exclude_channels = ""
+    options.direct_conversations_only = False
+    options.attachment_http_port = 0
+    options.attachment_cache_limit = attachments.DEFAULT_CACHE_LIMIT
+    options.memory_budget = 0
+    options.channel_idle_time = eviction.DEFAULT_CHANNEL_IDLE_TIME
+    options.stall_threshold = watchdog.DEFAULT_STALL_THRESHOLD
+    options.accounts = []
 
 
 def parse_options_and_config(argv):
@@ -478,6 +906,11 @@ def parse_options_and_config(argv):
         "--username",
         metavar="X",
         help="flow account username")
+    opt_parser.add_option(
+        "--takeover",
+        action="store_true",
+        help="Take over the running gateway (see 'handoff-socket')",
+        default=False)
     opt_parser.add_option(
         "--daemon",
         action="store_true",
@@ -491,14 +924,14 @@ def parse_options_and_config(argv):
     if options.config:
         read_from_config(opt_parser, options)
 
+    try:
+        system_encoding = common.get_system_encoding()
+    except:  # OSX bug in locale.getdefaultlocale()
+        system_encoding = common.DEFAULT_ENCODING
+        print(
+            "locale.getdefaultlocale() failed, using '%s'." %
+            system_encoding)
     if options.username:
-        try:
-            system_encoding = common.get_system_encoding()
-        except:  # OSX bug in locale.getdefaultlocale()
-            system_encoding = common.DEFAULT_ENCODING
-            print(
-                "locale.getdefaultlocale() failed, using '%s'." %
-                system_encoding)
         options.username = options.username.decode(system_encoding)
 
     if options.debug:
@@ -512,9 +945,73 @@ def parse_options_and_config(argv):
             opt_parser.error("bad port: %r" % port)
     options.irc_ports = ports
 
+    try:
+        options.log_payload_limit = int(options.log_payload_limit)
+        options.log_payload_sample = int(options.log_payload_sample)
+        options.diagnostics_top = int(options.diagnostics_top)
+        options.sendq_limit = int(options.sendq_limit)
+        options.scheduler_time_slice = float(options.scheduler_time_slice)
+        options.scheduler_notification_budget = int(
+            options.scheduler_notification_budget)
+        options.refresh_interval = float(options.refresh_interval)
+        options.workers = int(options.workers)
+        options.history_replay_limit = int(options.history_replay_limit)
+        options.paste_window = float(options.paste_window)
+        options.attachment_http_port = int(options.attachment_http_port)
+        options.attachment_cache_limit = int(options.attachment_cache_limit)
+        options.memory_budget = int(options.memory_budget)
+        options.channel_idle_time = float(options.channel_idle_time)
+        options.stall_threshold = float(options.stall_threshold)
+        for command_class, limit in options.rate_limits.items():
+            options.rate_limits[command_class] = ratelimit.parse_limit(limit)
+        options.subscriptions = subscriptions.Subscriptions(
+            options.include_orgs.decode(system_encoding),
+            options.exclude_orgs.decode(system_encoding),
+            options.include_channels.decode(system_encoding),
+            options.exclude_channels.decode(system_encoding),
+            options.direct_conversations_only)
+    except ValueError as value_err:
+        opt_parser.error("bad config value: %s" % value_err)
+    if options.sendq_policy not in sendq.POLICIES:
+        opt_parser.error("bad sendq-policy: %r (expected one of: %s)" %
+                         (options.sendq_policy, ", ".join(sendq.POLICIES)))
+    if options.config:
+        options.accounts = read_accounts_from_config(
+            opt_parser, options, system_encoding)
+    if options.workers and not options.accounts:
+        opt_parser.error("'workers' requires [account:NAME] sections")
+    if options.workers and options.handoff_socket:
+        opt_parser.error("'handoff-socket' is not supported with 'workers'")
+    if options.workers and options.attachment_http_port:
+        opt_parser.error(
+            "'attachment-http-port' is not supported with 'workers'")
+    if options.takeover and not options.handoff_socket:
+        opt_parser.error("--takeover requires 'handoff-socket'")
+    # daemonize() changes the working directory
+    if options.log_file:
+        options.log_file = os.path.abspath(options.log_file)
+    options.diagnostics_dir = os.path.abspath(options.diagnostics_dir)
+    if options.handoff_socket:
+        options.handoff_socket = os.path.abspath(options.handoff_socket)
+    if options.message_store:
+        options.message_store = os.path.abspath(options.message_store)
+    if options.outbox_dir:
+        options.outbox_dir = os.path.abspath(options.outbox_dir)
+
     return options
 
 
+def reload_options_and_config(argv):
+    """Parses the command line and config again
+    (see parse_options_and_config).
+    Returns 'None' if the config is not valid.
+    """
+    try:
+        return parse_options_and_config(argv)
+    except SystemExit:
+        return None
+
+
 def daemonize():
     """Forks a daemon process and exits."""
     try:
@@ -539,15 +1036,16 @@ def daemonize():
     os.dup2(dev_null.fileno(), sys.stdin.fileno())
 
 
-def main():
-    """Entry point for the application"""
-
-    options = parse_options_and_config(sys.argv)
-
-    if options.daemon:
-        daemonize()
-
-    gateway = FlowIRCGateway(options)
+def run_gateway(options, listeners=None, worker_link=None, takeover=None):
+    """Runs the gateway (in this process) until it is terminated
+    (or handed over to a new process).
+    Arguments:
+    options : container object with the gateway options.
+    listeners : list of bound IRC listening sockets (optional).
+    worker_link : supervisor.WorkerLink instance (worker processes only).
+    takeover : handoff.Takeover instance (optional).
+    """
+    gateway = FlowIRCGateway(options, listeners, worker_link, takeover)
 
     def signal_handler(sig, frame):
         """Function used to gracefully terminate the gateway."""
@@ -557,14 +1055,47 @@ def main():
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    gateway.diagnostics.install_signal_handlers()
+    gateway.install_signal_handlers()
 
     try:
-        gateway.initialize_flow_service(options)
         gateway.start()
     except:
         gateway.terminate()
         raise
 
 
+def main():
+    """Entry point for the application"""
+
+    config_started = time.time()
+    options = parse_options_and_config(sys.argv)
+    options.startup = startup.StartupTimer(startup.STARTED)
+    options.startup.record(startup.IMPORT, startup.STARTED, config_started)
+    options.startup.record(startup.CONFIG, config_started, time.time())
+
+    if options.daemon:
+        daemonize()
+
+    # The log listener thread must be started after daemonize() forks
+    logger.setup_logging(options)
+
+    if options.workers:
+        listen_started = time.time()
+        listeners = bind_listeners(options.irc_ports)
+        options.startup.record(startup.LISTEN, listen_started, time.time())
+        supervisor.Supervisor(options, listeners, run_gateway,
+                              reload_options_and_config).start()
+    elif options.takeover:
+        try:
+            takeover = handoff.take_over(options.handoff_socket)
+        except handoff.HandoffError as handoff_err:
+            LOG.error("Could not take over the gateway: %s", handoff_err)
+            sys.exit(1)
+        run_gateway(options, takeover=takeover)
+    else:
+        run_gateway(options)
+
+
 if __name__ == "__main__":
     main()
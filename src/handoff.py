@@ -0,0 +1,174 @@
+"""
+handoff.py
+"""
+
+import cPickle
+import errno
+import logging
+import os
+import socket
+import struct
+from collections import namedtuple
+from multiprocessing import reduction
+
+
+LOG = logging.getLogger(__name__)
+HANDOFF_VERSION = 1
+HANDOFF_TIMEOUT = 30  # seconds
+MSG_RECEIVED = "received"  # new process --> old process
+MSG_RELEASED = "released"  # old process --> new process
+_LENGTH = struct.Struct("!I")
+
+# What the new process gets from the old one
+Takeover = namedtuple(
+    "Takeover", [
+        "state",  # dict, see FlowIRCGateway.handoff_state
+        "listeners",  # list of listening socket instances
+        "client_sockets",  # list of socket instances (same order as state)
+    ])
+
+
+class HandoffError(Exception):
+    """Raised when the handoff between the processes fails."""
+    pass
+
+
+def _set_timeouts(sock):
+    """Makes 'sock' blocking, with HANDOFF_TIMEOUT send/receive timeouts.
+    (socket.settimeout() would make the file descriptor non-blocking,
+    which does not work with the SCM_RIGHTS helpers.)
+    """
+    sock.setblocking(1)
+    timeout = struct.pack("ll", HANDOFF_TIMEOUT, 0)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeout)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeout)
+
+
+def send_message(sock, obj):
+    """Sends a pickled object on the handoff connection."""
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    """Receives 'size' bytes from 'sock'."""
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise HandoffError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock):
+    """Receives a pickled object from the handoff connection."""
+    (size,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return cPickle.loads(_recv_exactly(sock, size))
+
+
+class HandoffServer(object):
+    """Old process side of a graceful restart.
+    Listens on a Unix socket for a new gateway process (started with
+    --takeover). When it connects, the gateway state is sent with the
+    IRC listening and client sockets (passed as SCM_RIGHTS ancillary
+    data), and once the new process confirms, the Flow services are
+    terminated and the gateway stops without closing any connection.
+    """
+
+    def __init__(self, gateway, path):
+        """Arguments:
+        gateway : FlowIRCGateway instance.
+        path : string, path of the Unix socket.
+        """
+        self.gateway = gateway
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)  # stale socket of a previous process
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.sock.setblocking(0)
+        LOG.info("Waiting for handoff on '%s'.", path)
+
+    def fileno(self):
+        """Returns the listening socket file descriptor (for select())."""
+        return self.sock.fileno()
+
+    def close(self):
+        """Closes and removes the Unix socket."""
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def serve(self):
+        """Hands the gateway over to a connecting process.
+        Returns True if the gateway was handed over (and must stop).
+        If the new process fails before confirming, nothing changes here.
+        """
+        try:
+            (conn, _) = self.sock.accept()
+        except socket.error as sock_err:
+            if sock_err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        _set_timeouts(conn)
+        try:
+            (state, handles) = self.gateway.handoff_state()
+            send_message(conn, state)
+            for handle in handles:
+                reduction.send_handle(conn, handle, 0)
+            if recv_message(conn) != MSG_RECEIVED:
+                raise HandoffError("unexpected reply")
+        except (socket.error, OSError, HandoffError) as handoff_err:
+            LOG.error("Handoff failed: %s", handoff_err)
+            conn.close()
+            return False
+        LOG.warning("Gateway handed over (%d clients).",
+                    len(state["clients"]))
+        # The new process binds its own handoff socket after MSG_RELEASED
+        self.close()
+        self.gateway.release_handoff()
+        try:
+            send_message(conn, MSG_RELEASED)
+        except socket.error as sock_err:
+            LOG.error("Could not confirm the handoff: %s", sock_err)
+        conn.close()
+        return True
+
+
+def take_over(path):
+    """New process side of a graceful restart: gets the state and the
+    sockets of the gateway listening for handoff on 'path'.
+    Returns a Takeover instance, once the old process released its
+    Flow services.
+    Raises HandoffError if the handoff fails.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    _set_timeouts(conn)
+    try:
+        conn.connect(path)
+        state = recv_message(conn)
+        if state["version"] != HANDOFF_VERSION:
+            raise HandoffError("unsupported handoff version %r" %
+                               state["version"])
+        sockets = []
+        for _ in range(state["listeners"] + len(state["clients"])):
+            handle = reduction.recv_handle(conn)
+            sockets.append(socket.fromfd(
+                handle, socket.AF_INET, socket.SOCK_STREAM))
+            os.close(handle)
+        send_message(conn, MSG_RECEIVED)
+        if recv_message(conn) != MSG_RELEASED:
+            raise HandoffError("unexpected reply")
+    except (socket.error, OSError) as sock_err:
+        raise HandoffError(sock_err)
+    finally:
+        conn.close()
+    LOG.warning("Took over the gateway (%d clients).", len(state["clients"]))
+    return Takeover(state,
+                    sockets[:state["listeners"]],
+                    sockets[state["listeners"]:])
@@ -2,12 +2,43 @@
 irc_client.py
 """
 
+import base64
+import fnmatch
+import logging
 import re
 import time
 import socket
+import sqlite3
 import string
+from collections import deque
+import attachments
 import common
-from channel import DirectChannel
+import logger
+import ratelimit
+import sendq
+import startup
+from channel import DirectChannel, HistoryNotLoaded, MembersNotLoaded
+
+
+LOG = logging.getLogger(__name__)
+PAYLOAD_LOG = logger.get_payload_logger(LOG)
+PING_INTERVAL = 90  # idle seconds before sending a PING
+PING_TIMEOUT = 180  # idle seconds before disconnecting
+CHATHISTORY_LIMIT = 100  # maximum messages per CHATHISTORY request
+# Maximum size of a multi-line message (draft/multiline batch or paste)
+MULTILINE_MAX_BYTES = 16384
+MULTILINE_MAX_LINES = 100
+SEARCH_NICK = "*search"  # virtual nick answering message searches
+SEARCH_PAGE_SIZE = 10  # search results per reply
+SEARCH_MAX_RESULTS = 100  # search results reachable with 'more'
+# LIST filters: masks (M), negated masks (N) and member counts (U)
+ELIST = "MNU"
+# Registration burst: the most active channels are sent first (JOINs
+# and history), then the others BURST_STEP_CHANNELS per BURST_INTERVAL
+# seconds, once the history of the previous ones was sent
+BURST_PRIORITY_CHANNELS = 10
+BURST_STEP_CHANNELS = 10
+BURST_INTERVAL = 0.1
 
 
 class IRCClient(object):
@@ -21,44 +52,116 @@ class IRCClient(object):
         client_socket : socket instance
         """
         self.gateway = gateway
+        self.session = None  # FlowSession instance, set on registration
         self.client_socket = client_socket
         self.nickname = ""
         self.user = ""
         self.realname = ""
+        self.caps = set()  # enabled IRCv3 capabilities
+        self.client_id = ""  # client identity (for the read markers)
         (self.host, self.port) = client_socket.getpeername()
         self.__timestamp = time.time()
         self.__readbuffer = ""
-        self.__writebuffer = ""
+        self.__sendq = sendq.SendQueue(gateway.stats,
+                                       gateway.sendq_limit,
+                                       gateway.sendq_policy)
+        self.__disconnected = False
         self.__sent_ping = False
+        self.__password = ""
+        self.__cap_negotiating = False
+        self.__sasl_mechanism = None
+        self.__account = None  # AccountConfig instance, once authenticated
+        # FlowSession whose Flow service is starting (the registration
+        # and the parsing resume once it is up, see session_started)
+        self.__waiting_session = None
+        self.__batch_id = 0
+        self.__next_search = None  # (text, offset) of the next results page
+        self.__tags = {}  # IRCv3 tags of the line being handled
+        self.__multiline = {}  # batch reference --> [target, lines]
+        self.__paste = None  # [target, lines, size] being coalesced
+        self.__paste_timer = None
+        self.__rate_limits = gateway.rate_limits
+        self.__buckets = ratelimit.client_buckets(gateway.rate_limits)
+        self.__throttle_timer = None  # resumes the parsing once throttled
+        self.__burst_timer = None  # sends the next registration burst step
+        # (channels, other_channels) deques of the Channels of the
+        # registration burst not sent yet (see __registration_burst)
+        self.__burst = (deque(), deque())
+        # [channelId, after, last] creationTimes of the history replays in
+        # progress: messages after 'after' up to 'last' (see get_state)
+        self.__replays = []
         self.__handle_command = self.__registration_handler
+        self.__aliveness_timer = gateway.timers.schedule(
+            PING_INTERVAL, self.check_aliveness)
 
     def check_aliveness(self):
         """Checks whether the IRC client connection is alive.
         Uses IRC's PING command.
+        Runs on the gateway timers, at the next ping deadline (activity
+        since the timer was scheduled just moves the deadline).
         """
         now = time.time()
-        if self.__timestamp + 180 < now:
+        if self.__waiting_session:
+            # (the client is not idle, the gateway is)
+            self.__timestamp = now
+        if self.__timestamp + PING_TIMEOUT <= now:
             self.disconnect("ping timeout")
             return
-        if not self.__sent_ping and self.__timestamp + 90 < now:
+        if not self.__sent_ping and self.__timestamp + PING_INTERVAL <= now:
             if self.__handle_command == self.__command_handler:
                 # Registered.
-                self.message("PING :%s" % self.gateway.name)
+                self.message("PING :%s" % self.gateway.name, sendq.CONTROL)
                 self.__sent_ping = True
             else:
                 # Not registered.
                 self.disconnect("ping timeout")
+                return
+        deadline = self.__timestamp + (
+            PING_TIMEOUT if self.__sent_ping else PING_INTERVAL)
+        self.__aliveness_timer = self.gateway.timers.schedule(
+            deadline - now, self.check_aliveness)
 
     def write_queue_size(self):
-        """Returns the length of the output buffer"""
-        return len(self.__writebuffer)
+        """Returns the length (in bytes) of the output queue"""
+        return len(self.__sendq)
+
+    def sendq_limit(self):
+        """Returns the limit (in bytes) of the output queue"""
+        return self.__sendq.limit
+
+    def reconfigure(self):
+        """Applies the reloaded gateway options
+        (see FlowIRCGateway.reload_config).
+        """
+        self.__sendq.limit = self.session.account.sendq_limit \
+            if self.session else self.gateway.sendq_limit
+        self.__sendq.policy = self.gateway.sendq_policy
+        if self.__rate_limits != self.gateway.rate_limits:
+            self.__rate_limits = self.gateway.rate_limits
+            self.__buckets = ratelimit.client_buckets(self.__rate_limits)
+
+    def has_pending_output(self):
+        """Returns True if there is output (or history replay)
+        waiting to be sent to the client.
+        """
+        return self.__sendq.has_pending_data()
 
     def __parse_read_buffer(self):
         """"Parses the input buffer received from the IRC client connection"""
-        lines = self.__linesep_regexp.split(self.__readbuffer)
-        self.__readbuffer = lines[-1]
-        lines = lines[:-1]
-        for line in lines:
+        # Lines are taken one at a time: a command may detach the client
+        # (see detach()) and the rest of the buffer goes with it.
+        while not self.__disconnected and not self.__throttle_timer and \
+                not self.__waiting_session:
+            lines = self.__linesep_regexp.split(self.__readbuffer, 1)
+            if len(lines) == 1:
+                return
+            (line, self.__readbuffer) = lines
+            raw_line = line
+            self.__tags = {}
+            if line.startswith("@"):
+                # IRCv3 client tags (message-tags)
+                (tags, _, line) = line.partition(" ")
+                self.__tags = common.parse_message_tags(tags[1:])
             if not line:
                 # Empty line. Ignore.
                 continue
@@ -75,43 +178,56 @@ class IRCClient(object):
                     arguments = string.split(args_string[0])
                     if len(args_string) == 2:
                         arguments.append(args_string[1])
+            if not self.__rate_limit(command, raw_line):
+                continue
             self.__handle_command(command, arguments)
 
+    def __rate_limit(self, command, raw_line):
+        """Applies the rate limit of the class of 'command'.
+        Returns True if the command can be handled now. Otherwise the
+        command is either rejected (RPL_TRYAGAIN) or put back in the
+        read buffer, and the parsing resumes once the client gets a
+        token again.
+        """
+        command_class = ratelimit.command_class(command)
+        bucket = self.__buckets.get(command_class)
+        if not bucket or (command in ("PRIVMSG", "NOTICE") and
+                          self.__tags.get("batch") in self.__multiline):
+            # (lines of a multiline batch count as one with its BATCH)
+            return True
+        delay = bucket.take()
+        if not delay:
+            return True
+        if command_class in ratelimit.REJECTED_CLASSES:
+            self.gateway.stats.incr("ratelimit.%s.rejected" % command_class)
+            self.reply("263 %s %s :Please wait a while and try again."
+                       % (self.nickname or "*", command))
+            return False
+        self.gateway.stats.incr("ratelimit.%s.delayed" % command_class)
+        self.__readbuffer = raw_line + "\r\n" + self.__readbuffer
+        self.__throttle_timer = self.gateway.timers.schedule(
+            delay, self.__resume_parsing)
+        return False
+
+    def __resume_parsing(self):
+        """Timer callback, resumes the parsing of a throttled client."""
+        self.__throttle_timer = None
+        self.__parse_read_buffer()
+
     def start_direct_conversation(self, targetname):
-        """Creates a direct conversation channel.
+        """Returns the direct conversation channel with a member
+        (an existing one if any, see FlowSession.get_direct_channel).
         Arguments:
         targetname : string, format: MemberName(TeamName).
         Returns a 'Channel' instance that represents the direct conversation.
         Returns 'None' if the direct conversation could not be created.
         """
-        direct_conversation_channel = None
         items = self.__dc_member_regexp.split(targetname)[1:-1]
         if len(items) != 2:
-            return
-        username = items[0]
-        organization_name = items[1]
-        # Try to get the member from local members
-        member = self.gateway.get_member(targetname)
-        if not member or (member and member.account_id !=
-                          self.gateway.flow_account_id):
-            # This is an unknown member to this gateway, try to get the
-            # peer data
-            if not member:
-                member_account_id = self.gateway.get_member_account_id(
-                    username)
-            else:
-                member_account_id = member.account_id
-            if member_account_id:
-                oid = self.gateway.get_oid_from_name(organization_name)
-                if oid:
-                    direct_conversation_channel = \
-                        self.gateway.create_direct_channel(
-                            member_account_id,
-                            username,
-                            oid,
-                            organization_name
-                        )
-        return direct_conversation_channel
+            return None
+        (username, organization_name) = items
+        return self.session.get_direct_channel(
+            targetname, username, organization_name)
 
     def send_welcome(self):
         """Sends the Welcome Message to the IRC client connection"""
@@ -119,39 +235,532 @@ class IRCClient(object):
         self.reply("002 %s :Your host is %s, "
                    "running version flow-irc-gateway-%s" %
                    (self.nickname, self.gateway.name, common.VERSION))
+        self.reply("005 %s CHATHISTORY=%d ELIST=%s "
+                   ":are supported by this server" %
+                   (self.nickname, CHATHISTORY_LIMIT, ELIST))
+
+    def supported_caps(self):
+        """Returns the set of IRCv3 capabilities offered on CAP LS."""
+        caps = set(["batch", "draft/chathistory", "draft/multiline",
+                    "echo-message", "message-tags", "server-time"])
+        if self.gateway.multi_account():
+            caps.add("sasl")
+        if self.gateway.store:
+            caps.add("draft/read-marker")
+        return caps
+
+    def __cap_handler(self, arguments):
+        """Handler for the CAP IRC command (capability negotiation).
+        Registration is held until CAP END once the client starts
+        the negotiation.
+        """
+        registered = self.__handle_command == self.__command_handler
+        subcommand = arguments[0].upper() if arguments else ""
+        nickname = self.nickname or "*"
+        if subcommand == "LS":
+            self.__cap_negotiating = not registered
+            caps = sorted(self.supported_caps())
+            if len(arguments) > 1 and arguments[1].isdigit() and \
+                    int(arguments[1]) >= 302:
+                # CAP LS 302: capability values
+                caps = [cap + "=max-bytes=%d,max-lines=%d" % (
+                    MULTILINE_MAX_BYTES, MULTILINE_MAX_LINES)
+                    if cap == "draft/multiline" else cap for cap in caps]
+            self.reply("CAP %s LS :%s" % (nickname, " ".join(caps)))
+        elif subcommand == "LIST":
+            self.reply("CAP %s LIST :%s"
+                       % (nickname, " ".join(sorted(self.caps))))
+        elif subcommand == "REQ":
+            self.__cap_negotiating = not registered
+            requested = arguments[1].split() if len(arguments) > 1 else []
+            supported = self.supported_caps()
+            if all(cap.lstrip("-") in supported for cap in requested):
+                for cap in requested:
+                    if cap.startswith("-"):
+                        self.caps.discard(cap[1:])
+                    else:
+                        self.caps.add(cap)
+                self.reply("CAP %s ACK :%s" % (nickname, " ".join(requested)))
+            else:
+                self.reply("CAP %s NAK :%s" % (nickname, " ".join(requested)))
+        elif subcommand == "END":
+            self.__cap_negotiating = False
+        else:
+            self.reply("410 %s %s :Invalid CAP command"
+                       % (nickname, subcommand))
+
+    def __authenticate_handler(self, arguments):
+        """Handler for the AUTHENTICATE IRC command (SASL PLAIN)."""
+        nickname = self.nickname or "*"
+        if "sasl" not in self.caps or not arguments:
+            self.reply("904 %s :SASL authentication failed" % nickname)
+            return
+        if arguments[0] == "*":
+            self.__sasl_mechanism = None
+            self.reply("906 %s :SASL authentication aborted" % nickname)
+            return
+        if self.__sasl_mechanism is None:
+            if arguments[0].upper() != "PLAIN":
+                self.reply("908 %s PLAIN :are available SASL mechanisms"
+                           % nickname)
+                self.reply("904 %s :SASL authentication failed" % nickname)
+                return
+            self.__sasl_mechanism = "PLAIN"
+            self.message("AUTHENTICATE +", sendq.CONTROL)
+            return
+        self.__sasl_mechanism = None
+        try:
+            _, account_name, password = base64.b64decode(
+                arguments[0]).decode("utf-8").split("\0")
+        except (TypeError, ValueError):
+            self.reply("904 %s :SASL authentication failed" % nickname)
+            return
+        account = self.gateway.check_credentials(account_name, password)
+        if not account:
+            self.reply("904 %s :SASL authentication failed" % nickname)
+            return
+        self.__account = account
+        self.reply("900 %s %s!%s@%s %s :You are now logged in as %s"
+                   % (nickname, nickname, self.user or "*", self.host,
+                      account_name, account_name))
+        self.reply("903 %s :SASL authentication successful" % nickname)
 
     def __registration_handler(self, command, arguments):
         """Handler for the IRC client registration.
-        NICK and USER are received.
-        This gateway ignores the arguments provided and forces the
-        NICK and USER to be the Flow username.
+        PASS (optional), NICK and USER are received, with an optional
+        CAP negotiation (and SASL authentication).
+        In multi-account mode the account is given either with
+        'PASS account:password' or with SASL PLAIN.
+        This gateway ignores the NICK and USER arguments provided and
+        forces the NICK and USER to be the Flow username.
         After the registration is complete, all organizations and channels
         are retrieved from Flow and sent to the IRC client.
         Arguments:
         command : string, IRC command
-        arguments : list, IRC command arguments (argument ignored)
+        arguments : list, IRC command arguments
         """
-        if command == "NICK":
-            self.nickname = common.irc_escape(
-                self.gateway.flow_username)  # override user provided NICK
+        if command == "PASS":
+            if arguments:
+                self.__password = arguments[0]
+        elif command == "NICK":
+            self.nickname = arguments[0] if arguments else "*"
         elif command == "USER":
-            self.user = common.irc_escape(
-                self.gateway.flow_username)  # override user provided USER
+            self.user = arguments[0] if arguments else "*"
+        elif command == "CAP":
+            self.__cap_handler(arguments)
+        elif command == "AUTHENTICATE":
+            self.__authenticate_handler(arguments)
         elif command == "QUIT":
             self.disconnect("Client quit")
             return
-        if self.nickname and self.user:
-            self.send_welcome()
-            self.gateway.get_orgs_and_channels()
-            self.send_lusers()
-            self.send_motd()
-            self.send_nick_data()
-            for channel in self.gateway.channels.values():
-                self.send_channel_data(channel)
-            self.__handle_command = self.__command_handler
-            # We signal the gateway to start processing notifications
-            self.gateway.client_connected = True
-            self.gateway.register_callbacks()
+        if self.nickname and self.user and not self.__cap_negotiating:
+            self.__complete_registration()
+
+    def __complete_registration(self):
+        """Attaches the client to its Flow account session and
+        sends the registration burst.
+        """
+        if not self.__account:
+            account_name, _, password = self.__password.partition(":")
+            self.__account = self.gateway.check_credentials(
+                account_name, password)
+        if not self.__account:
+            self.reply("464 %s :Password incorrect" % self.nickname)
+            self.disconnect("Bad password")
+            return
+        if not self.gateway.owns_account(self.__account):
+            # Hosted by another worker process
+            self.gateway.transfer_client(self, self.__account)
+            return
+        session = self.gateway.get_session(self.__account, wait=False)
+        if not session:
+            self.disconnect("Flow session unavailable")
+            return
+        if session.flow_starting:
+            self.__waiting_session = session
+            session.waiting_clients.append(self)
+            self.reply("NOTICE %s :Starting the Flow session, please wait"
+                       % (self.nickname or "*"))
+            return
+        if not self.__attach(session):
+            return
+        self.send_welcome()
+        # (the model of a session shared with other clients is up to date)
+        if not session.model_loaded:
+            session.get_orgs_and_channels()
+        session.start_history_backfill()
+        self.send_lusers()
+        self.send_motd()
+        self.send_nick_data()
+        # Channel JOINs are sent from a background task so that the
+        # burst does not block the main loop on large accounts, the most
+        # active channels first
+        channels = session.channels_by_activity()
+        self.__start_burst(channels[:BURST_PRIORITY_CHANNELS],
+                           channels[BURST_PRIORITY_CHANNELS:])
+        self.__handle_command = self.__command_handler
+        # We signal the session to start processing notifications
+        session.client_connected = True
+        session.register_callbacks()
+
+    def session_started(self, session):
+        """Called by the gateway once the Flow service of the session
+        this client waits for is started (or could not be started).
+        """
+        session.waiting_clients.remove(self)
+        self.__waiting_session = None
+        if not session.flow_initialized:
+            self.disconnect("Flow session unavailable")
+            return
+        self.__complete_registration()
+        self.__parse_read_buffer()
+
+    def __attach(self, session):
+        """Adds the client to 'session'.
+        Returns False (and disconnects the client) if the account's
+        client limit was reached.
+        """
+        if not session.add_client(self):
+            self.disconnect("Too many connections for this account")
+            return False
+        self.session = session
+        self.__sendq.limit = session.account.sendq_limit
+        # The user provided USER identifies the client (read markers)
+        self.client_id = self.client_id or self.user
+        # Override the user provided NICK and USER
+        self.nickname = common.irc_escape(session.flow_username)
+        self.user = common.irc_escape(session.flow_username)
+        return True
+
+    def __chathistory_fail(self, code, arguments, description):
+        """Sends a CHATHISTORY standard reply FAIL."""
+        self.reply("FAIL CHATHISTORY %s %s :%s"
+                   % (code, " ".join(arguments[:2]), description))
+
+    def __history_reference(self, channel, reference):
+        """Returns the creationTime of a CHATHISTORY reference
+        ('timestamp=...' or 'msgid=...'), 'None' for '*'.
+        Raises ValueError if the reference is not valid.
+        """
+        if reference == "*":
+            return None
+        kind, _, value = reference.partition("=")
+        if kind == "timestamp":
+            return common.parse_server_time_string(value)
+        if kind == "msgid":
+            message = self.session.get_message(channel, value)
+            if message:
+                return message["creationTime"]
+        raise ValueError(reference)
+
+    def __chathistory(self, arguments):
+        """Replies to a CHATHISTORY request (see chathistory_handler)."""
+        subcommand = arguments[0].upper() if arguments else ""
+        if subcommand not in ("LATEST", "BEFORE", "AFTER", "BETWEEN") or \
+                len(arguments) < (5 if subcommand == "BETWEEN" else 4):
+            self.__chathistory_fail("INVALID_PARAMS", arguments,
+                                    "Invalid parameters")
+            return
+        channel = self.session.get_channel_from_irc_name(arguments[1])
+        if not channel:
+            self.__chathistory_fail("INVALID_TARGET", arguments,
+                                    "Unknown channel")
+            return
+        try:
+            limit = int(arguments[-1])
+            if limit < 1:  # (0 is no limit for get_history)
+                raise ValueError(arguments[-1])
+            limit = min(limit, CHATHISTORY_LIMIT)
+            first = self.__history_reference(channel, arguments[2])
+            second = self.__history_reference(channel, arguments[3]) \
+                if subcommand == "BETWEEN" else None
+            messages = self.__chathistory_messages(
+                subcommand, channel, limit, first, second)
+        except ValueError:
+            self.__chathistory_fail("INVALID_PARAMS", arguments,
+                                    "Invalid message reference or limit")
+            return
+        except HistoryNotLoaded:
+            self.__chathistory_fail("MESSAGE_ERROR", arguments,
+                                    "Could not load the channel history")
+            return
+        self.__sendq.push_replay(
+            self.__render_history_batch(channel, messages))
+
+    def __chathistory_messages(self, subcommand, channel, limit, first,
+                               second):
+        """Returns the messages of a CHATHISTORY request
+        (see __chathistory).
+        Raises HistoryNotLoaded if Flow fails.
+        """
+        if subcommand == "LATEST":
+            return self.session.get_history(channel, limit, after=first)
+        if subcommand == "BEFORE":
+            return self.session.get_history(channel, limit, before=first)
+        if subcommand == "AFTER":
+            return self.session.get_history(
+                channel, limit, after=first, oldest_first=True)
+        if first < second:
+            return self.session.get_history(
+                channel, limit, before=second, after=first, oldest_first=True)
+        return self.session.get_history(
+            channel, limit, before=first, after=second)
+
+    def __render_history_batch(self, channel, messages):
+        """Yields the encoded lines of a CHATHISTORY reply
+        (in a 'chathistory' BATCH if the client supports it).
+        """
+        batch = None
+        if "batch" in self.caps:
+            self.__batch_id += 1
+            batch = "history%d" % self.__batch_id
+            yield self.encode_line(":%s BATCH +%s chathistory %s" % (
+                self.gateway.name, batch, channel.get_irc_name()))
+        for message in messages:
+            line = self.render_message(channel, message, batch)
+            if line:
+                yield self.encode_line(line)
+        if batch:
+            yield self.encode_line(
+                ":%s BATCH -%s" % (self.gateway.name, batch))
+
+    def send_read_marker(self, channel):
+        """Sends the read marker of 'channel' (IRCv3 draft/read-marker)."""
+        creation_time = self.session.get_read_marker(self.client_id, channel)
+        self.message(":%s MARKREAD %s %s" % (
+            self.gateway.name,
+            channel.get_irc_name(),
+            "timestamp=" + common.get_server_time_string(creation_time)
+            if creation_time is not None else "*"),
+            target=channel.get_irc_name())  # in order with the JOINs
+
+    def __markread(self, arguments):
+        """Replies to a MARKREAD request (see markread_handler)."""
+        if not arguments:
+            self.reply("FAIL MARKREAD NEED_MORE_PARAMS :Missing parameters")
+            return
+        channel = self.session.get_channel_from_irc_name(arguments[0])
+        if not channel:
+            self.reply("FAIL MARKREAD INVALID_PARAMS %s :Unknown channel"
+                       % arguments[0])
+            return
+        if not self.gateway.store:
+            self.reply("FAIL MARKREAD INTERNAL_ERROR %s :Read markers "
+                       "require the 'message-store' option" % arguments[0])
+            return
+        if len(arguments) < 2:
+            self.send_read_marker(channel)
+            return
+        kind, _, value = arguments[1].partition("=")
+        try:
+            if kind != "timestamp":
+                raise ValueError(arguments[1])
+            creation_time = common.parse_server_time_string(value)
+        except ValueError:
+            self.reply("FAIL MARKREAD INVALID_PARAMS %s %s :Invalid timestamp"
+                       % (arguments[0], arguments[1]))
+            return
+        self.session.set_read_markers(
+            self.client_id, [(channel.channel_id, "", creation_time)])
+        for client in self.session.clients.values():
+            if client is self or (client.client_id == self.client_id and
+                                  "draft/read-marker" in client.caps):
+                client.send_read_marker(channel)
+
+    def __send_privmsg(self, targetname, message, label=None):
+        """Sends 'message' to the channel or member 'targetname'
+        (a direct conversation is started if needed).
+        Arguments:
+        label : string, IRCv3 'label' tag of the command, given back
+        on the echo (see echo_message).
+        """
+        channel = self.session.get_channel_from_irc_name(targetname)
+        if not channel:
+            channel = self.start_direct_conversation(targetname)
+        if not channel or \
+                not self.session.transmit_message_to_channel(
+                    channel, message, self, label):
+            self.reply("401 %s %s :No such nick/channel"
+                       % (self.nickname, targetname))
+
+    def __queue_paste_line(self, targetname, message):
+        """Coalesces the consecutive lines to the same target received
+        within 'paste-window' seconds into one message (see flush_paste).
+        """
+        if self.__paste and (
+                self.__paste[0] != targetname or
+                self.__paste[2] + len(message) >= MULTILINE_MAX_BYTES):
+            self.flush_paste()
+        if not self.__paste:
+            self.__paste = [targetname, [], 0]
+        self.__paste[1].append(message)
+        self.__paste[2] += len(message) + 1
+        self.gateway.timers.cancel(self.__paste_timer)
+        if len(self.__paste[1]) >= MULTILINE_MAX_LINES:
+            self.flush_paste()
+        else:
+            self.__paste_timer = self.gateway.timers.schedule(
+                self.gateway.paste_window, self.flush_paste)
+
+    def flush_paste(self):
+        """Sends the lines being coalesced (if any) as one message."""
+        self.gateway.timers.cancel(self.__paste_timer)
+        self.__paste_timer = None
+        if not self.__paste:
+            return
+        (targetname, lines, _) = self.__paste
+        self.__paste = None
+        if len(lines) > 1:
+            self.gateway.stats.incr("paste.coalesced_lines", len(lines))
+        self.__send_privmsg(targetname, "\n".join(lines))
+
+    def __batch(self, arguments):
+        """Replies to a client BATCH command, only 'draft/multiline'
+        batches are supported: their lines are sent as one message.
+        """
+        if not arguments or len(arguments[0]) < 2 or \
+                arguments[0][0] not in "+-":
+            self.reply("FAIL BATCH INVALID_PARAMS :Invalid parameters")
+            return
+        reference = arguments[0][1:]
+        if arguments[0][0] == "+":
+            if len(arguments) < 3 or arguments[1] != "draft/multiline":
+                self.reply("FAIL BATCH UNSUPPORTED_TYPE :Unsupported batch")
+                return
+            self.__multiline[reference] = [arguments[2], [], 0]
+            return
+        batch = self.__multiline.pop(reference, None)
+        if batch is None:
+            self.reply("FAIL BATCH INVALID_REFTAG %s :Unknown batch"
+                       % reference)
+            return
+        (targetname, lines, _) = batch
+        if lines:
+            self.flush_paste()
+            self.gateway.stats.incr("multiline.batches")
+            self.__send_privmsg(targetname, "".join(lines))
+
+    def __multiline_line(self, reference, targetname, message):
+        """Adds a line to the open draft/multiline batch 'reference'."""
+        batch = self.__multiline[reference]
+        if targetname != batch[0]:
+            del self.__multiline[reference]
+            self.reply("FAIL BATCH MULTILINE_INVALID_TARGET %s %s "
+                       ":Invalid multiline target" % (batch[0], targetname))
+            return
+        if batch[1] and "draft/multiline-concat" not in self.__tags:
+            message = "\n" + message
+        batch[1].append(message)
+        batch[2] += len(message)
+        if len(batch[1]) > MULTILINE_MAX_LINES:
+            del self.__multiline[reference]
+            self.reply("FAIL BATCH MULTILINE_MAX_LINES %d "
+                       ":Multiline batch max-lines exceeded"
+                       % MULTILINE_MAX_LINES)
+        elif batch[2] > MULTILINE_MAX_BYTES:
+            del self.__multiline[reference]
+            self.reply("FAIL BATCH MULTILINE_MAX_BYTES %d "
+                       ":Multiline batch max-bytes exceeded"
+                       % MULTILINE_MAX_BYTES)
+
+    def __search_notice(self, text):
+        """Sends a NOTICE from SEARCH_NICK."""
+        self.message(":%s!search@%s NOTICE %s :%s"
+                     % (SEARCH_NICK, self.gateway.name, self.nickname, text),
+                     sendq.CONTROL)
+
+    def __search(self, text):
+        """Replies to a message search (SEARCH command or PRIVMSG to
+        SEARCH_NICK) with a page of results, best matches first.
+        'more' replies with the next page of the previous search.
+        """
+        if not self.gateway.store:
+            self.__search_notice(
+                "Search requires the 'message-store' option")
+            return
+        if not self.gateway.store.search_enabled:
+            self.__search_notice(
+                "Search is not available (SQLite without FTS5)")
+            return
+        offset = 0
+        if text.strip().lower() == "more":
+            if not self.__next_search:
+                self.__search_notice("No more results")
+                return
+            (text, offset) = self.__next_search
+        self.__next_search = None
+        limit = min(SEARCH_PAGE_SIZE, SEARCH_MAX_RESULTS - offset)
+        try:
+            # One extra result tells whether there is a next page
+            results = self.session.search(text, limit + 1, offset)
+        except sqlite3.OperationalError as search_err:
+            self.__search_notice("Invalid search: %s" % search_err)
+            return
+        self.gateway.stats.incr("search.queries")
+        unsynced = self.session.unsynced_channel_count()
+        if unsynced and not offset:
+            self.__search_notice(
+                "History of %d channel(s) still loading, results may be "
+                "incomplete" % unsynced)
+        if not results and not offset:
+            self.__search_notice("No results for '%s'" % text)
+            return
+        for (channel, message) in results[:limit]:
+            member = channel.get_member_from_account_id(
+                message["senderAccountId"])
+            self.__search_notice("%s %s <%s> %s" % (
+                common.get_message_timestamp_string(message["creationTime"]),
+                channel.get_irc_name(),
+                member.get_irc_nickname() if member else
+                message["senderAccountId"],
+                message["text"].replace("\n", "\\n")))
+        if len(results) > limit and offset + limit < SEARCH_MAX_RESULTS:
+            self.__next_search = (text, offset + limit)
+            self.__search_notice("Type 'more' for more results")
+        else:
+            self.__search_notice("End of results")
+
+    def __start_burst(self, channels, other_channels):
+        """Starts the registration burst (see __registration_burst).
+        Arguments:
+        channels : list of Channel instances, the most active ones.
+        other_channels : list of Channel instances, the rest.
+        """
+        self.__burst = (deque(channels), deque(other_channels))
+        self.gateway.scheduler.add_task(self.__registration_burst())
+
+    def __registration_burst(self):
+        """Background task that sends the data of one of the most active
+        channels per step (see scheduler.WorkScheduler.add_task),
+        then streams the other channels (see __stream_channels).
+        """
+        (channels, other_channels) = self.__burst
+        while channels:
+            if self.__disconnected:
+                return
+            self.send_channel_data(channels.popleft())
+            yield
+        self.gateway.startup.record(
+            startup.FIRST_CLIENT, self.gateway.startup.started, time.time())
+        self.gateway.startup.report(self.gateway.stats)
+        self.__stream_channels(other_channels)
+
+    def __stream_channels(self, channels):
+        """Sends the data of BURST_STEP_CHANNELS channels once the
+        history replay queued before is sent, and schedules the next step
+        in BURST_INTERVAL seconds (timer callback).
+        Arguments:
+        channels : deque of Channel instances.
+        """
+        self.__burst_timer = None
+        if self.__disconnected:
+            return
+        if not self.__sendq.has_pending_replay():
+            for _ in range(min(BURST_STEP_CHANNELS, len(channels))):
+                self.send_channel_data(channels.popleft())
+        if channels:
+            self.__burst_timer = self.gateway.timers.schedule(
+                BURST_INTERVAL, self.__stream_channels, channels)
 
     def __command_handler(self, command, arguments):
         """IRC commands handler."""
@@ -187,23 +796,50 @@ class IRCClient(object):
             pass
 
         def list_handler():
-            """Handler for the LIST IRC command.
+            """Handler for the LIST IRC command (see __list_replies).
             Flow Channels will return an empty IRC topic.
             """
+            query = arguments[0] if arguments else ""
+            self.__send_cached_replies(
+                ("LIST", query), lambda: self.__list_replies(query))
+
+        def batch_handler():
+            """Handler for the BATCH IRC command (IRCv3 draft/multiline)."""
+            self.__batch(arguments)
+
+        def cap_handler():
+            """Handler for the CAP IRC command."""
+            self.__cap_handler(arguments)
+
+        def reregistration_handler():
+            """PASS, USER and AUTHENTICATE are only valid
+            during the registration.
+            """
+            self.reply("462 %s :You may not reregister" % self.nickname)
+
+        def chathistory_handler():
+            """Handler for the CHATHISTORY IRC command (IRCv3
+            draft/chathistory): LATEST, BEFORE, AFTER and BETWEEN, with
+            'timestamp=' or 'msgid=' references.
+            """
+            self.__chathistory(arguments)
+
+        def search_handler():
+            """Handler for the SEARCH command (gateway specific):
+            'SEARCH <words>' or 'SEARCH more', see __search.
+            """
             if len(arguments) < 1:
-                channels = gateway.channels.values()
-            else:
-                channels = []
-                for channelname in arguments[0].split(","):
-                    channel = gateway.get_channel_from_irc_name(channelname)
-                    if channel:
-                        channels.append(channel)
-            channels.sort(key=lambda x: x.channel_name)
-            for channel in channels:
-                self.reply("322 %s %s %d :"
-                           % (self.nickname, channel.get_irc_name(),
-                              len(channel.members)))
-            self.reply("323 %s :End of LIST" % self.nickname)
+                self.reply("461 %s SEARCH :Not enough parameters"
+                           % self.nickname)
+                return
+            self.__search(" ".join(arguments))
+
+        def markread_handler():
+            """Handler for the MARKREAD IRC command (IRCv3
+            draft/read-marker): gets or moves ('timestamp=' argument)
+            the read marker of a channel.
+            """
+            self.__markread(arguments)
 
         def lusers_handler():
             """Handler for the LUSERS IRC command."""
@@ -229,8 +865,9 @@ class IRCClient(object):
             there's no direct conversation within the session, then
             a new direct conversation channel is created
             (with Flow.NewDirectConversation) and the message is sent.
+            Lines of a draft/multiline batch, or coalesced with
+            'paste-window', are sent as one message.
             """
-            privmsg_success = False
             if len(arguments) == 0:
                 self.reply("411 %s :No recipient given (%s)"
                            % (self.nickname, command))
@@ -240,18 +877,18 @@ class IRCClient(object):
                 return
             targetname = arguments[0]
             message = arguments[1]
-            channel = gateway.get_channel_from_irc_name(targetname)
-            if channel:
-                privmsg_success = gateway.transmit_message_to_channel(
-                    channel, message)
+            if targetname.lower() == SEARCH_NICK:
+                if command == "PRIVMSG":
+                    self.__search(message)
+                return
+            if self.__tags.get("batch") in self.__multiline:
+                self.__multiline_line(self.__tags["batch"], targetname,
+                                      message)
+            elif gateway.paste_window:
+                self.__queue_paste_line(targetname, message)
             else:
-                channel = self.start_direct_conversation(targetname)
-                if channel:
-                    privmsg_success = gateway.transmit_message_to_channel(
-                        channel, message)
-            if not privmsg_success:
-                self.reply("401 %s %s :No such nick/channel"
-                           % (self.nickname, targetname))
+                self.__send_privmsg(targetname, message,
+                                    self.__tags.get("label"))
 
         def ping_handler():
             """Handler for the PING IRC command."""
@@ -273,60 +910,42 @@ class IRCClient(object):
             if len(arguments) < 1:
                 return
             targetname = arguments[0]
-            channel = gateway.get_channel_from_irc_name(targetname)
-            if channel:
-                for member in channel.members:
-                    self.reply("352 %s %s %s %s %s %s H :0 %s"
-                               % (self.nickname,
-                                  targetname,
-                                  member.user,
-                                  member.host,
-                                  gateway.name,
-                                  member.get_irc_nickname(),
-                                  member.realname))
-                self.reply("315 %s %s :End of WHO list"
-                           % (self.nickname, targetname))
+            self.__send_cached_replies(
+                ("WHO", targetname), lambda: self.__who_replies(targetname))
 
         def whois_handler():
             """Handler for the WHOIS IRC command."""
             if len(arguments) < 1:
                 return
             membername = arguments[0]
-            member = gateway.get_member(membername)
-            if member:
-                self.reply("311 %s %s %s %s * :%s"
-                           % (self.nickname,
-                              member.get_irc_nickname(),
-                              member.user,
-                              member.host,
-                              member.realname))
-                self.reply("312 %s %s %s :%s"
-                           % (self.nickname,
-                              member.get_irc_nickname(),
-                              "",
-                              ""))
-                self.reply("318 %s %s :End of WHOIS list"
-                           % (self.nickname, member.get_irc_nickname()))
-            else:
-                self.reply("401 %s %s :No such nick"
-                           % (self.nickname, membername))
+            self.__send_cached_replies(
+                ("WHOIS", membername),
+                lambda: self.__whois_replies(membername))
 
         handler_table = {
+            "AUTHENTICATE": reregistration_handler,
             "AWAY": away_handler,
+            "BATCH": batch_handler,
+            "CAP": cap_handler,
+            "CHATHISTORY": chathistory_handler,
             "ISON": ison_handler,
             "JOIN": join_handler,
             "LIST": list_handler,
             "LUSERS": lusers_handler,
+            "MARKREAD": markread_handler,
             "MODE": mode_handler,
             "MOTD": motd_handler,
             "NICK": nick_handler,
             "NOTICE": notice_and_privmsg_handler,
             "PART": part_handler,
+            "PASS": reregistration_handler,
             "PING": ping_handler,
             "PONG": pong_handler,
             "PRIVMSG": notice_and_privmsg_handler,
             "QUIT": quit_handler,
+            "SEARCH": search_handler,
             "TOPIC": topic_handler,
+            "USER": reregistration_handler,
             "WHO": who_handler,
             "WHOIS": whois_handler,
         }
@@ -335,6 +954,9 @@ class IRCClient(object):
             handler_table[command]()
         except KeyError:
             self.reply("421 %s %s :Unknown command" % (self.nickname, command))
+        except MembersNotLoaded:
+            self.reply("263 %s %s :Please wait a while and try again."
+                       % (self.nickname, command))
 
     def socket_readable_notification(self):
         """Reads data from the IRC client socket
@@ -343,14 +965,18 @@ class IRCClient(object):
         try:
             data = self.client_socket.recv(2 ** 10)
             data = data.decode(common.get_system_encoding())
-            self.gateway.print_debug(
-                "[%s:%d] -> %r" % (self.host, self.port, data))
+            PAYLOAD_LOG.debug("[%s:%d] -> %r",
+                              self.host, self.port, logger.Payload(data))
             quitmsg = "EOT"
         except socket.error as sock_err:
             data = ""
             quitmsg = sock_err
         if data:
             self.__readbuffer += data
+            if len(self.__readbuffer) > ratelimit.MAX_PENDING_INPUT:
+                self.gateway.stats.incr("ratelimit.excess_flood")
+                self.disconnect("Excess Flood")
+                return
             self.__parse_read_buffer()
             self.__timestamp = time.time()
             self.__sent_ping = False
@@ -358,56 +984,298 @@ class IRCClient(object):
             self.disconnect(quitmsg)
 
     def socket_writable_notification(self):
-        """Sends data to IRC client socket (using self.__writebuffer)."""
+        """Sends data to IRC client socket (using self.__sendq)."""
         try:
-            sent = self.client_socket.send(self.__writebuffer.encode('utf-8'))
-            self.gateway.print_debug(
-                "[%s:%d] <- %r" % (
-                    self.host, self.port, self.__writebuffer[:sent]))
-            self.__writebuffer = self.__writebuffer[sent:]
+            data = self.__sendq.peek()
+            sent = self.client_socket.send(data)
+            PAYLOAD_LOG.debug("[%s:%d] <- %r", self.host, self.port,
+                              logger.Payload(data, 0, sent))
+            markers = self.__sendq.consume(sent)
         except socket.error as sock_err:
             self.disconnect(sock_err)
+            return
+        if markers and self.session:
+            self.session.set_read_markers(self.client_id, markers)
+        dropped = self.__sendq.pop_dropped_summary()
+        for target, count in sorted(dropped.items()):
+            self.gateway.stats.incr("sendq.drop_summaries")
+            self.reply("NOTICE %s :%d message(s) for %s were dropped "
+                       "(client too slow)"
+                       % (self.nickname, count, target or self.nickname))
+
+    def get_state(self):
+        """Returns the client state, to be given to resume()
+        in another process.
+        """
+        return {
+            "registered": self.__handle_command == self.__command_handler,
+            "nickname": self.nickname,
+            "user": self.user,
+            "client_id": self.client_id,
+            "realname": self.realname,
+            "caps": self.caps,
+            "password": self.__password,
+            "cap_negotiating": self.__cap_negotiating,
+            "account": self.__account.name if self.__account else None,
+            "readbuffer": self.__readbuffer,
+            "output": self.__sendq.pending_data(),
+            # (the queued data above does not include the replays and
+            # the burst not rendered yet, they are resumed from these)
+            "replays": [list(replay) for replay in self.__replays],
+            "burst": [[channel.channel_id for channel in channels]
+                      for channels in self.__burst],
+        }
+
+    def detach(self):
+        """Removes the client from this process without closing its
+        connection (see FlowIRCGateway.transfer_client).
+        Returns the client state (see get_state()).
+        """
+        self.flush_paste()
+        state = self.get_state()
+        self.__disconnected = True
+        self.gateway.timers.cancel(self.__aliveness_timer)
+        self.gateway.timers.cancel(self.__throttle_timer)
+        self.gateway.timers.cancel(self.__burst_timer)
+        self.gateway.remove_client(self)
+        return state
+
+    def resume(self, state):
+        """Restores the state of a client detached by another process.
+        A registered client goes on with its session, otherwise the
+        registration goes on where it was left.
+        """
+        self.nickname = state["nickname"]
+        self.user = state["user"]
+        self.client_id = state["client_id"]
+        self.realname = state["realname"]
+        self.caps = state["caps"]
+        self.__password = state["password"]
+        self.__cap_negotiating = state["cap_negotiating"]
+        self.__readbuffer = state["readbuffer"]
+        if state["output"]:
+            self.__sendq.push(state["output"], sendq.CONTROL)
+        if state["account"] is not None:
+            self.__account = self.gateway.get_account(state["account"])
+            if not self.__account:
+                self.disconnect("Account removed")
+                return
+        if state["registered"]:
+            session = self.gateway.get_session(self.__account)
+            if not session:
+                self.disconnect("Flow session unavailable")
+                return
+            if not self.__attach(session):
+                return
+            if not session.model_loaded:
+                session.get_orgs_and_channels()
+            self.__handle_command = self.__command_handler
+            session.client_connected = True
+            session.register_callbacks()
+            self.__resume_burst(state.get("replays", []),
+                                state.get("burst", ([], [])))
+        elif self.nickname and self.user and not self.__cap_negotiating:
+            self.__complete_registration()
+        self.__parse_read_buffer()
+
+    def __resume_burst(self, replays, burst):
+        """Resumes the history replays and the registration burst of a
+        client detached by another process (see get_state).
+        Channels that are no longer in the session are skipped.
+        """
+        for (channel_id, after, last) in replays:
+            channel = self.session.get_channel(channel_id)
+            if channel:
+                self.send_channel_messages(channel, after, last)
+        (channels, other_channels) = [
+            [self.session.get_channel(channel_id)
+             for channel_id in channel_ids
+             if self.session.get_channel(channel_id)]
+            for channel_ids in burst]
+        if channels or other_channels:
+            self.__start_burst(channels, other_channels)
 
     def disconnect(self, quitmsg):
         """Closes the socket for this IRC client and
         it is removed from the client list.
         """
-        self.message("ERROR :%s" % quitmsg)
-        self.gateway.print_info(
-            "Disconnected connection from %s:%s (%s)." % (
-                self.host, self.port, quitmsg))
+        if self.__disconnected:
+            return
+        self.flush_paste()
+        if self.__disconnected:  # (the replies of flush_paste may overflow)
+            return
+        if self.__waiting_session:
+            self.__waiting_session.waiting_clients.remove(self)
+            self.__waiting_session = None
+        self.__disconnected = True
+        try:
+            self.__sendq.push(
+                self.encode_line("ERROR :%s" % quitmsg), sendq.CONTROL)
+        except sendq.SendQueueFull:
+            # (over the hard limit, the ERROR line is dropped)
+            pass
+        self.gateway.timers.cancel(self.__aliveness_timer)
+        self.gateway.timers.cancel(self.__throttle_timer)
+        self.gateway.timers.cancel(self.__burst_timer)
+        LOG.info("Disconnected connection from %s:%s (%s).",
+                 self.host, self.port, quitmsg)
         self.client_socket.close()
         self.gateway.remove_client(self)
 
-    def message(self, msg):
-        """Writes to the self.__writebuffer buffer,
+    @staticmethod
+    def encode_line(msg):
+        """Returns the encoded IRC line for 'msg' string."""
+        return (msg + "\r\n").encode("utf-8")
+
+    def message(self, msg, lane=sendq.LIVE, target=None, mark=None):
+        """Queues 'msg' on the send queue,
         to be send via socket_writable_notification().
+        Arguments:
+        msg : string, IRC message.
+        lane : sendq.CONTROL or sendq.LIVE, priority of the message.
+        target : string, channel/nick the message is for.
+        mark : (channelId, messageId, creationTime) read marker,
+        moved once the message is sent (optional).
         """
-        self.__writebuffer += msg + "\r\n"
+        self.__push(self.encode_line(msg), lane, target, mark)
+
+    def __push(self, data, lane, target=None, mark=None):
+        """Queues encoded 'data' on the send queue (see message())."""
+        if self.__disconnected:
+            return
+        try:
+            self.__sendq.push(data, lane, target, mark)
+        except sendq.SendQueueFull as full_err:
+            self.disconnect(full_err)
 
     def reply(self, msg):
         """Sends an IRC reply message to an IRC client connection."""
-        self.message(":%s %s" % (self.gateway.name, msg))
+        self.message(":%s %s" % (self.gateway.name, msg), sendq.CONTROL)
+
+    def __send_cached_replies(self, key, render):
+        """Sends IRC replies, rendered and encoded only once per session
+        model version (see FlowSession.cached_replies).
+        Arguments:
+        key : tuple, command and arguments the replies are for.
+        render : function returning the list of replies.
+        """
+        block = self.session.cached_replies(
+            (self.nickname,) + key,
+            lambda: b"".join(
+                self.encode_line(":%s %s" % (self.gateway.name, msg))
+                for msg in render()))
+        if block:
+            self.__push(block, sendq.CONTROL)
+
+    def __list_replies(self, query):
+        """Returns the LIST replies.
+        Arguments:
+        query : string, comma separated channel names and ELIST filters:
+        masks with '*' and '?' wildcards (e.g. '*(TeamName)' for the
+        channels of a team), negated masks ('!mask') and member counts
+        ('>N', '<N'). Empty to list all the channels.
+        """
+        names = []
+        masks = []
+        negated_masks = []
+        (min_members, max_members) = (None, None)
+        for item in query.split(","):
+            try:
+                if item.startswith(">"):
+                    min_members = int(item[1:])
+                elif item.startswith("<"):
+                    max_members = int(item[1:])
+                elif item.startswith("!"):
+                    negated_masks.append(item[1:].lower())
+                elif "*" in item or "?" in item:
+                    masks.append(item.lower())
+                elif item:
+                    names.append(item)
+            except ValueError:
+                continue  # ignore bad member counts
+        if names:
+            channels = [self.session.get_channel_from_irc_name(name)
+                        for name in names]
+            channels = [channel for channel in channels if channel]
+        else:
+            channels = self.session.channels.values()
+        replies = []
+        for channel in sorted(channels, key=lambda x: x.channel_name):
+            irc_name = channel.get_irc_name()
+            member_count = channel.member_count()
+            if min_members is not None and member_count <= min_members or \
+                    max_members is not None and member_count >= max_members:
+                continue
+            if masks and not any(fnmatch.fnmatchcase(irc_name.lower(), mask)
+                                 for mask in masks):
+                continue
+            if any(fnmatch.fnmatchcase(irc_name.lower(), mask)
+                   for mask in negated_masks):
+                continue
+            replies.append("322 %s %s %d :"
+                           % (self.nickname, irc_name, member_count))
+        replies.append("323 %s :End of LIST" % self.nickname)
+        return replies
+
+    def __who_replies(self, targetname):
+        """Returns the WHO replies for channel 'targetname'."""
+        channel = self.session.get_channel_from_irc_name(targetname)
+        if not channel:
+            return []
+        replies = []
+        for member in channel.members:
+            replies.append("352 %s %s %s %s %s %s H :0 %s"
+                           % (self.nickname,
+                              targetname,
+                              member.user,
+                              member.host,
+                              self.gateway.name,
+                              member.get_irc_nickname(),
+                              member.realname))
+        replies.append("315 %s %s :End of WHO list"
+                       % (self.nickname, targetname))
+        return replies
+
+    def __whois_replies(self, membername):
+        """Returns the WHOIS replies for member 'membername'."""
+        member = self.session.get_member(membername)
+        if not member:
+            return ["401 %s %s :No such nick" % (self.nickname, membername)]
+        return [
+            "311 %s %s %s %s * :%s"
+            % (self.nickname,
+               member.get_irc_nickname(),
+               member.user,
+               member.host,
+               member.realname),
+            "312 %s %s %s :%s"
+            % (self.nickname,
+               member.get_irc_nickname(),
+               "",
+               ""),
+            "318 %s %s :End of WHOIS list"
+            % (self.nickname, member.get_irc_nickname()),
+        ]
 
     def send_lusers(self):
         """Replies the IRC client connection with LUSERS response data."""
         self.reply("251 %s :There are %d orgs and %d channels"
                    % (self.nickname,
-                      len(self.gateway.organizations),
-                      len(self.gateway.channels)))
+                      len(self.session.organizations),
+                      len(self.session.channels)))
 
     def get_list_of_channels_by_org(self):
         """Returns a map of
         OrgName -> [(ChannelName, IsDirectConversation, ChannelMemberCount)].
         """
         orgs_channels = {}
-        for org_name in self.gateway.organizations.values():
+        for org_name in self.session.organizations.values():
             orgs_channels[org_name] = []
-        for channel in self.gateway.channels.values():
+        for channel in self.session.channels.values():
             orgs_channels[channel.organization_name].append(
                 (channel.get_irc_name(),
                  isinstance(channel, DirectChannel),
-                 len(channel.members)))
+                 channel.member_count()))
         for channels in orgs_channels.values():
             channels.sort()
         return orgs_channels
@@ -416,23 +1284,27 @@ class IRCClient(object):
         """Sends the MOTD with the list of organizations,
         their channels with their member count.
         """
-        self.reply("375 %s :- Message of the day -" % self.nickname)
-        self.reply(
+        self.__send_cached_replies(("MOTD",), self.__motd_replies)
+
+    def __motd_replies(self):
+        """Returns the MOTD replies."""
+        replies = [
+            "375 %s :- Message of the day -" % self.nickname,
             "372 %s :- Your Flow username is: %s" %
-            (self.nickname, self.nickname))
-        self.reply(
-            "372 %s :- List of Teams and Channels:" %
-            self.nickname)
+            (self.nickname, self.nickname),
+            "372 %s :- List of Teams and Channels:" % self.nickname,
+        ]
         orgs_channels = self.get_list_of_channels_by_org()
         for org_name, channel_list in orgs_channels.iteritems():
-            self.reply("372 %s :  - %s: [%d channels]" %
-                       (self.nickname, org_name, len(channel_list)))
+            replies.append("372 %s :  - %s: [%d channels]" %
+                           (self.nickname, org_name, len(channel_list)))
             for channel_name, direct, member_count in channel_list:
                 direct_channel = " [direct conversation]" if direct else (
                     " [%d members]" % member_count)
-                self.reply("372 %s :    - %s%s" %
-                           (self.nickname, channel_name, direct_channel))
-        self.reply("376 %s :End of /MOTD command" % self.nickname)
+                replies.append("372 %s :    - %s%s" %
+                               (self.nickname, channel_name, direct_channel))
+        replies.append("376 %s :End of /MOTD command" % self.nickname)
+        return replies
 
     def send_nick_data(self):
         """Sends the NICK data to the user (forced by the gateway)."""
@@ -444,11 +1316,30 @@ class IRCClient(object):
         Arguments:
         channel : Channel instance
         """
-        self.send_channel_join_commands(channel)
+        try:
+            self.send_channel_join_commands(channel)
+        except MembersNotLoaded:
+            # Sent once the members are reloaded
+            self.session.reload_channel(
+                channel, lambda: self.__send_reloaded_channel_data(channel))
+            return
+        if "draft/read-marker" in self.caps:
+            self.send_read_marker(channel)
         self.send_channel_messages(channel)
 
+    def __send_reloaded_channel_data(self, channel):
+        """Sends the data of a channel whose members were reloaded
+        (see send_channel_data), if the client is still connected.
+        """
+        if not self.__disconnected:
+            self.send_channel_data(channel)
+
     def send_channel_join_commands(self, channel):
-        """Sends the Channel JOIN commands to the IRC client connection."""
+        """Sends the Channel JOIN commands to the IRC client connection.
+        Raises MembersNotLoaded (before sending anything) if the members
+        of an evicted channel cannot be reloaded.
+        """
+        members = channel.members
         # JOIN command for the current user
         self.message(":%s!%s@%s JOIN :%s" %
                      (self.nickname,
@@ -456,39 +1347,137 @@ class IRCClient(object):
                       self.host,
                       channel.get_irc_name()))
         # Then, JOIN for the remaining members
-        for member in channel.members:
-            if member.account_id != self.gateway.flow_account_id:
+        for member in members:
+            if member.account_id != self.session.flow_account_id:
                 self.message(":%s!%s@%s JOIN :%s" %
                              (member.get_irc_nickname(),
                               member.user,
                               member.host,
                               channel.get_irc_name()))
 
-    def send_channel_messages(self, channel):
-        """Retrieves and sends the messages of a
+    def send_channel_messages(self, channel, after=None, last=None):
+        """Queues the replay of the messages of a
         given channel to the IRC client connection.
+        Messages are retrieved and rendered as the send queue drains,
+        and the replay is paused while the client is slow.
+        Arguments:
+        channel : Channel instance.
+        after, last : creationTimes, replay the messages after 'after'
+        and up to 'last' (to resume a replay, see get_state), by default
+        the messages after the client read marker.
         """
-        messages = self.gateway.flow_service.enumerate_messages(
-            channel.organization_id,
-            channel.channel_id)
-        for message in reversed(messages):
-            member = channel.get_member_from_account_id(
-                message["senderAccountId"])
-            if member:
-                message_text = message["text"]
-                if self.gateway.show_timestamps:
-                    message_timestamp = common.get_message_timestamp_string(
-                        message["creationTime"])
-                    message_text = message_timestamp + " " + message_text
-                if member.account_id == self.gateway.flow_account_id:
-                    message_nickname = member.nickname
-                else:
-                    message_nickname = member.get_irc_nickname()
-                # IRC does not support newline within messages
-                message_text = message_text.replace("\n", "\\n")
-                self.message(":%s!%s@%s PRIVMSG %s :%s" %
-                             (message_nickname,
-                              member.user,
-                              member.host,
-                              channel.get_irc_name(),
-                              message_text))
+        if after is None and last is None:
+            after = self.session.get_read_marker(self.client_id, channel)
+        replay = [channel.channel_id, after, last]
+        self.__replays.append(replay)
+        self.__sendq.push_replay(self.__render_channel_messages(
+            channel, replay))
+
+    def __render_channel_messages(self, channel, replay):
+        """Retrieves the messages of a given channel and yields them as
+        encoded IRC lines, each one followed by its read marker
+        (see sendq.SendQueue).
+        Arguments:
+        channel : Channel instance.
+        replay : [channelId, after, last] entry of self.__replays, moved
+        forward as the messages are rendered.
+        """
+        try:
+            (_, after, last) = replay
+            # (a resumed replay takes the oldest messages, newer ones
+            # must not push them out of the limit)
+            try:
+                messages = self.session.get_history(
+                    channel, self.gateway.history_replay_limit, after=after,
+                    oldest_first=last is not None)
+            except HistoryNotLoaded:
+                LOG.error("History replay of %s to %s:%d stopped.",
+                          channel.get_irc_name(), self.host, self.port)
+                return
+            if last is None and messages:
+                replay[2] = messages[-1]["creationTime"]
+            for message in messages:
+                if message["creationTime"] > replay[2]:
+                    break
+                try:
+                    line = self.render_message(channel, message)
+                except MembersNotLoaded:
+                    # (evicted while the replay was paused)
+                    LOG.error("History replay of %s to %s:%d stopped.",
+                              channel.get_irc_name(), self.host, self.port)
+                    return
+                replay[1] = message["creationTime"]
+                if line:
+                    yield self.encode_line(line)
+                    yield (channel.channel_id, message["id"],
+                           message["creationTime"])
+        finally:
+            self.__replays.remove(replay)
+
+    def echo_message(self, channel, message, label, mark):
+        """Echoes a Flow message sent by this client (see
+        FlowSession.track_sent_message) if it negotiated 'echo-message',
+        with the 'label' of the command that sent it. Otherwise the echo
+        is suppressed: the client already shows its own messages.
+        Arguments:
+        channel : Channel instance.
+        message : dict, Flow message.
+        label : string, IRCv3 'label' tag of the command (or 'None').
+        mark : read marker of the message (see message()).
+        """
+        if "echo-message" not in self.caps:
+            self.gateway.stats.incr("echo.suppressed")
+            self.session.set_read_markers(self.client_id, [mark])
+            return
+        line = self.render_message(channel, message)
+        if line is None:
+            return
+        if label and "message-tags" in self.caps:
+            label_tag = "label=%s" % common.escape_message_tag(label)
+            if line.startswith("@"):
+                line = "@%s;%s" % (label_tag, line[1:])
+            else:
+                line = "@%s %s" % (label_tag, line)
+        self.gateway.stats.incr("echo.sent")
+        self.message(line, sendq.LIVE, channel.get_irc_name(), mark)
+
+    def render_message(self, channel, message, batch=None):
+        """Returns the IRC PRIVMSG line of a Flow message of 'channel',
+        with the IRCv3 tags enabled by the client.
+        Returns 'None' if the sender is not a channel member.
+        Arguments:
+        channel : Channel instance.
+        message : dict, Flow message.
+        batch : string, reference of the BATCH the line belongs to.
+        """
+        member = channel.get_member_from_account_id(
+            message["senderAccountId"])
+        if not member:
+            return None
+        message_text = attachments.message_text(
+            self.gateway, self.session, channel, message)
+        if self.session.show_timestamps:
+            message_timestamp = common.get_message_timestamp_string(
+                message["creationTime"])
+            message_text = message_timestamp + " " + message_text
+        if member.account_id == self.session.flow_account_id:
+            message_nickname = member.nickname
+        else:
+            message_nickname = member.get_irc_nickname()
+        # IRC does not support newline within messages
+        message_text = message_text.replace("\n", "\\n")
+        tags = []
+        if batch:
+            tags.append("batch=%s" % batch)
+        if "server-time" in self.caps:
+            tags.append("time=%s" % common.get_server_time_string(
+                message["creationTime"]))
+        if "message-tags" in self.caps:
+            tags.append("msgid=%s" % message["id"])
+        return "%s:%s!%s@%s PRIVMSG %s :%s" % (
+            "@%s " % ";".join(tags) if tags else "",
+            message_nickname,
+            member.user,
+            member.host,
+            channel.get_irc_name(),
+            message_text)
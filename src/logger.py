@@ -0,0 +1,240 @@
+"""
+logger.py
+"""
+
+import atexit
+import itertools
+import logging
+import sys
+import threading
+import Queue
+
+
+PACKAGE_LOGGER_NAME = __name__.rpartition(".")[0] or __name__
+PAYLOAD_LOGGER_SUFFIX = "payload"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DEFAULT_PAYLOAD_LIMIT = 512
+DEFAULT_PAYLOAD_SAMPLE = 1
+
+_payload_limit = DEFAULT_PAYLOAD_LIMIT
+_listener = None
+
+
+def get_payload_logger(logger):
+    """Returns the child logger used for socket payload dumps of 'logger'.
+    Payload dumps get their own logger so they can be sampled
+    (see PayloadSampler) independently of the module debug messages.
+    """
+    return logger.getChild(PAYLOAD_LOGGER_SUFFIX)
+
+
+class Payload(object):
+    """Lazy representation of a (possibly large) socket payload.
+    The slice and the repr() are only computed if the log record
+    is actually emitted, and the output is truncated to the
+    configured payload limit.
+    """
+    __slots__ = ("data", "start", "end")
+
+    def __init__(self, data, start=0, end=None):
+        """Arguments:
+        data : string, buffer holding the payload.
+        start, end : integers, slice of 'data' to log.
+        """
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        end = len(self.data) if self.end is None else self.end
+        length = end - self.start
+        if _payload_limit and length > _payload_limit:
+            return "%r... (%d more chars)" % (
+                self.data[self.start:self.start + _payload_limit],
+                length - _payload_limit)
+        return repr(self.data[self.start:end])
+
+
+class PayloadSampler(logging.Filter):
+    """Lets one out of every 'rate' records through."""
+
+    def __init__(self, rate):
+        """Arguments:
+        rate : integer, sampling rate (1 logs every record).
+        """
+        logging.Filter.__init__(self)
+        self.rate = max(1, rate)
+        self.__counter = itertools.count()
+
+    def filter(self, record):
+        return next(self.__counter) % self.rate == 0
+
+
+class QueueHandler(logging.Handler):
+    """Handler that formats records on the calling thread and
+    hands them to a QueueListener, so that the main loop never
+    blocks on (or flushes) the log output.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # Format here, lazy arguments may reference mutable state
+            record.msg = self.format(record)
+            record.args = None
+            record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to its QueueListener."""
+
+    def flush(self):
+        pass
+
+    def force_flush(self):
+        """Flushes the underlying stream."""
+        self.acquire()
+        try:
+            if self.stream and hasattr(self.stream, "flush"):
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+class QueueListener(object):
+    """Background thread that drains a queue of log records into handlers.
+    Output streams are flushed once per drained batch instead of per line.
+    """
+    __sentinel = None
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.__thread = None
+
+    def start(self):
+        """Starts the listener thread."""
+        self.__thread = threading.Thread(
+            target=self.__monitor, name="log-listener")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Flushes the pending records and stops the listener thread."""
+        if not self.__thread:
+            return
+        self.queue.put(self.__sentinel)
+        self.__thread.join()
+        self.__thread = None
+
+    def __handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def __flush(self):
+        for handler in self.handlers:
+            handler.force_flush()
+
+    def __monitor(self):
+        while True:
+            record = self.queue.get()
+            while record is not self.__sentinel:
+                self.__handle(record)
+                try:
+                    record = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            self.__flush()
+            if record is self.__sentinel:
+                return
+
+
+class _MaxLevelFilter(logging.Filter):
+    """Filters out records at or above 'level'."""
+
+    def __init__(self, level):
+        logging.Filter.__init__(self)
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno < self.level
+
+
+def get_level(options):
+    """Returns the logging level matching the verbose/debug options."""
+    if options.debug:
+        return logging.DEBUG
+    if options.verbose:
+        return logging.INFO
+    return logging.WARNING
+
+
+def setup_logging(options):
+    """Configures the gateway loggers from the parsed options.
+    Records are queued and written by a background thread, either to
+    'options.log_file' or to stdout (stderr for errors).
+    Arguments:
+    options : container object with the log options
+    (debug, verbose, log_file, log_payload_limit, log_payload_sample).
+    """
+    global _payload_limit, _listener
+    stop_logging()
+    _payload_limit = options.log_payload_limit
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = []
+    if options.log_file:
+        file_handler = BufferedStreamHandler(open(options.log_file, "a"))
+        handlers.append(file_handler)
+    else:
+        stdout_handler = BufferedStreamHandler(sys.stdout)
+        stdout_handler.addFilter(_MaxLevelFilter(logging.ERROR))
+        stderr_handler = BufferedStreamHandler(sys.stderr)
+        stderr_handler.setLevel(logging.ERROR)
+        handlers.extend([stdout_handler, stderr_handler])
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue = Queue.Queue()
+    _listener = QueueListener(queue, handlers)
+    _listener.start()
+
+    package_logger = logging.getLogger(PACKAGE_LOGGER_NAME)
+    for handler in list(package_logger.handlers):
+        package_logger.removeHandler(handler)
+    package_logger.addHandler(QueueHandler(queue))
+    package_logger.setLevel(get_level(options))
+    package_logger.propagate = False
+
+    for name in list(logging.Logger.manager.loggerDict):
+        if name.startswith(PACKAGE_LOGGER_NAME + ".") and \
+                name.endswith("." + PAYLOAD_LOGGER_SUFFIX):
+            set_payload_sampling(logging.getLogger(name),
+                                 options.log_payload_sample)
+
+
+def set_payload_sampling(payload_logger, rate):
+    """Replaces the sampling filter of a payload logger."""
+    for log_filter in list(payload_logger.filters):
+        if isinstance(log_filter, PayloadSampler):
+            payload_logger.removeFilter(log_filter)
+    if rate > 1:
+        payload_logger.addFilter(PayloadSampler(rate))
+
+
+def stop_logging():
+    """Flushes and stops the log listener thread (if running)."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -2,20 +2,127 @@
 notification.py
 """
 
+import logging
+from collections import OrderedDict
+
+from . import attachments
 from . import common
 from .channel import ChannelMember, PendingChannel, Channel, DirectChannel
 
 
+LOG = logging.getLogger(__name__)
+# Seconds a 'channel' notification waits for its first 'message'
+PENDING_CHANNEL_TTL = 300
+# Seconds the events of an unknown channel are kept (see ReorderBuffer)
+REORDER_BUFFER_TTL = PENDING_CHANNEL_TTL
+# Unknown channels with buffered events (the oldest one is dropped)
+REORDER_BUFFER_MAX_CHANNELS = 100
+# Buffered events per channel (newer events are dropped)
+REORDER_BUFFER_MAX_EVENTS = 500
+# Kinds of buffered events
+EVENT_MESSAGE = "message"
+EVENT_MEMBER = "member"
+
+
+class ReorderBuffer(object):
+    """Holds the events (regular messages and member events) that arrive
+    before their channel (or while the members of an evicted channel are
+    reloaded), per channelId and in arrival order, until the channel is
+    added or for REORDER_BUFFER_TTL seconds.
+    """
+
+    def __init__(self, session):
+        """Arguments:
+        session : FlowSession instance.
+        """
+        self.session = session
+        self.__channels = OrderedDict()  # channelId --> (Timer, events)
+
+    def __len__(self):
+        return sum(len(events) for (_, events) in self.__channels.values())
+
+    def __contains__(self, channel_id):
+        return channel_id in self.__channels
+
+    def add(self, channel_id, kind, data):
+        """Buffers an event of an unknown (or evicted) channel.
+        Arguments:
+        channel_id : string, channelId.
+        kind : EVENT_MESSAGE (data: Flow message dict) or
+        EVENT_MEMBER (data: member accountId).
+        """
+        stats = self.session.gateway.stats
+        if channel_id not in self.__channels:
+            if len(self.__channels) >= REORDER_BUFFER_MAX_CHANNELS:
+                (oldest_channel_id, oldest_entry) = \
+                    self.__channels.popitem(last=False)
+                self.__drop(oldest_channel_id, oldest_entry,
+                            "reorder.overflow")
+            self.__channels[channel_id] = (
+                self.session.gateway.timers.schedule(
+                    REORDER_BUFFER_TTL, self.expire, channel_id),
+                [])
+        events = self.__channels[channel_id][1]
+        if len(events) >= REORDER_BUFFER_MAX_EVENTS:
+            stats.incr("reorder.overflow")
+            return
+        events.append((kind, data))
+        stats.incr("reorder.buffered")
+
+    def pop(self, channel_id):
+        """Returns (and forgets) the buffered events of a channel, in
+        arrival order, messages deduplicated by id.
+        """
+        if channel_id not in self.__channels:
+            return []
+        (timer, events) = self.__channels.pop(channel_id)
+        self.session.gateway.timers.cancel(timer)
+        message_ids = set()
+        unique_events = []
+        for (kind, data) in events:
+            if kind == EVENT_MESSAGE:
+                if data["id"] in message_ids:
+                    self.session.gateway.stats.incr("reorder.duplicates")
+                    continue
+                message_ids.add(data["id"])
+            unique_events.append((kind, data))
+        return unique_events
+
+    def discard(self, channel_id):
+        """Drops the buffered events of a channel loaded from Flow
+        (its members and history already include them).
+        """
+        if channel_id in self.__channels:
+            self.__drop(channel_id, self.__channels.pop(channel_id),
+                        "reorder.discarded")
+
+    def expire(self, channel_id):
+        """Timer callback, drops the events of a channel that
+        was not added in time.
+        """
+        if channel_id in self.__channels:
+            self.__drop(channel_id, self.__channels.pop(channel_id),
+                        "reorder.expired")
+
+    def __drop(self, channel_id, entry, stat_name):
+        """Drops the buffered (Timer, events) entry of a channel."""
+        (timer, events) = entry
+        self.session.gateway.timers.cancel(timer)
+        self.session.gateway.stats.incr(stat_name, len(events))
+        LOG.debug("Dropped %d buffered event(s) of channel %s (%s).",
+                  len(events), channel_id, stat_name)
+
+
 class NotificationHandler(object):
     """A Flow notifications handler.
     It implements callback methods to deal with Flow notifications.
     """
 
-    def __init__(self, gateway):
+    def __init__(self, session):
         """Arguments:
-        gateway : FlowIRCGateway instance.
+        session : FlowSession instance.
         """
-        self.gateway = gateway
+        self.session = session
 
     def org_notification(self, organizations_data):
         """Processes 'org' notifications."""
@@ -25,11 +132,12 @@ class NotificationHandler(object):
             organization_name = org["name"]
             assert oid
             assert organization_name
-            self.gateway.organizations[oid] = organization_name
-            self.gateway.get_channels(oid, organization_name)
-            for channel in self.gateway.channels.values():
+            self.session.organizations[oid] = organization_name
+            self.session.directory_changed()
+            self.session.get_channels(oid, organization_name)
+            for channel in self.session.channels.values():
                 if channel.organization_id == oid:
-                    for client in self.gateway.clients.values():
+                    for client in self.session.clients.values():
                         client.send_channel_data(channel)
 
     def channel_notification(self, channels_data):
@@ -40,14 +148,29 @@ class NotificationHandler(object):
             channel_id = channel_data["id"]
             assert oid
             assert channel_id
-            channel = self.gateway.get_channel(channel_id)
-            if channel or oid not in self.gateway.organizations:
+            channel = self.session.get_channel(channel_id)
+            if channel or oid not in self.session.organizations:
                 # If existing channel or unknown organization, then ignore
                 # notification
                 continue
-            organization_name = self.gateway.organizations[oid]
-            self.gateway.pending_channels[channel_id] = PendingChannel(
+            organization_name = self.session.organizations[oid]
+            if not self.session.gateway.subscriptions.wants_org(
+                    organization_name):
+                self.session.unsubscribe_channel(channel_id)
+                continue
+            self.session.pending_channels[channel_id] = PendingChannel(
                 channel_id, "", oid, organization_name)
+            self.session.gateway.timers.schedule(
+                PENDING_CHANNEL_TTL, self.expire_pending_channel, channel_id)
+
+    def expire_pending_channel(self, channel_id):
+        """Timer callback, drops a pending channel that never
+        received its first 'message' notification.
+        """
+        if channel_id in self.session.pending_channels:
+            del self.session.pending_channels[channel_id]
+            self.session.gateway.stats.incr("pending_channels.expired")
+            LOG.debug("Pending channel %s expired.", channel_id)
 
     def process_channel_message(self, message):
         """Processes the 'ChannelMessages' attribute
@@ -60,31 +183,78 @@ class NotificationHandler(object):
         assert channel_name or direct_channel
         # ChannelMessage notifications may arrive from new_direct_conversation
         # started by the client
-        if channel_id not in self.gateway.pending_channels:
+        if channel_id not in self.session.pending_channels or \
+                channel_id in self.session.loading_channels:
+            return
+        pending_channel = self.session.pending_channels[channel_id]
+        if not self.session.gateway.subscriptions.wants_channel(
+                pending_channel.org_name, channel_name, direct_channel):
+            self.session.unsubscribe_channel(channel_id)
             return
-        pending_channel = self.gateway.pending_channels[channel_id]
         if direct_channel:
             channel = DirectChannel(
-                self.gateway,
+                self.session,
                 channel_id,
                 pending_channel.oid,
                 pending_channel.org_name)
         else:
             channel = Channel(
-                self.gateway,
+                self.session,
                 channel_id,
                 channel_name,
                 pending_channel.oid,
                 pending_channel.org_name)
-            self.gateway.check_channel_collision(channel)
+            self.session.check_channel_collision(channel)
 
-        self.gateway.get_channel_members(channel)
+        # (a ChannelMessage received while the members are loaded, or
+        # retried, does not load them again)
+        self.session.loading_channels.add(channel_id)
+        self.session.gateway.call_flow_with_retry(
+            "enumerate_channel_members",
+            lambda: self.session.get_channel_members(channel),
+            lambda _: self.add_new_channel(channel),
+            on_failure=lambda _: self.session.loading_channels.discard(
+                channel_id))
 
-        self.gateway.add_channel(channel)
-        del self.gateway.pending_channels[channel_id]
+    def add_new_channel(self, channel):
+        """Adds a new channel (with its members loaded) to the session,
+        sends its JOINs to the IRC clients and then the events that
+        arrived before the channel.
+        """
+        self.session.add_channel(channel)
+        self.session.pending_channels.pop(channel.channel_id, None)
+        self.session.loading_channels.discard(channel.channel_id)
 
-        for client in self.gateway.clients.values():
+        for client in self.session.clients.values():
             client.send_channel_join_commands(channel)
+        self.process_buffered_events(channel)
+
+    def process_buffered_events(self, channel):
+        """Processes the events of 'channel' held in the reorder buffer."""
+        buffered_events = self.session.reorder_buffer.pop(channel.channel_id)
+        for (kind, data) in buffered_events:
+            if kind == EVENT_MEMBER:
+                self.process_member(channel, data)
+            else:
+                self.process_regular_message(data)
+        self.session.gateway.stats.incr(
+            "reorder.flushed", len(buffered_events))
+
+    def waits_for_members(self, channel):
+        """Returns True if the events of 'channel' must wait for its
+        members to be reloaded (see defer_until_reloaded).
+        """
+        return channel.evicted or \
+            channel.channel_id in self.session.reorder_buffer
+
+    def defer_until_reloaded(self, channel, kind, data):
+        """Buffers an event of an evicted channel (see ReorderBuffer.add)
+        until its members are reloaded from Flow in the background.
+        """
+        self.session.reorder_buffer.add(channel.channel_id, kind, data)
+        if channel.channel_id not in self.session.reloading_channels:
+            self.session.reload_channel(
+                channel, lambda: self.process_buffered_events(channel))
 
     def process_regular_message(self, message):
         """Processes the 'RegularMessages' attribute
@@ -92,28 +262,47 @@ class NotificationHandler(object):
         """
         sender_account_id = message["senderAccountId"]
         channel_id = message["channelId"]
-        message_text = message["text"]
         assert sender_account_id
         assert channel_id
-        channel = self.gateway.get_channel(channel_id)
-        # 'channel' notification not received yet
-        # (this can happen on some occasions, TODO: investigate)
+        channel = self.session.get_channel(channel_id)
+        if not channel and channel_id in self.session.unsubscribed_channels:
+            return
+        if channel and self.waits_for_members(channel):
+            self.defer_until_reloaded(channel, EVENT_MESSAGE, message)
+            return
+        self.session.store_messages([message], channel)
+        # 'channel' notification not received yet, the message is sent
+        # once the channel is added
         if not channel:
+            self.session.reorder_buffer.add(
+                channel_id, EVENT_MESSAGE, message)
             return
+        channel.touch()
         sender_member = channel.get_member_from_account_id(sender_account_id)
         assert sender_member
-        if self.gateway.show_timestamps:
+        message_text = attachments.message_text(
+            self.session.gateway, self.session, channel, message)
+        if self.session.show_timestamps:
             message_timestamp = common.get_message_timestamp_string(
                 message["creationTime"])
             message_text = message_timestamp + " " + message_text
         # IRC does not support newline within messages
         message_text = message_text.replace("\n", "\\n")
-        self.gateway.notify_clients(":%s!%s@%s PRIVMSG %s :%s" %
+        # Messages sent from an IRC client are echoed apart to it
+        (sender_client, label) = self.session.sent_messages.pop(
+            message["id"], (None, None))
+        mark = (channel_id, message["id"], message["creationTime"])
+        self.session.notify_clients(":%s!%s@%s PRIVMSG %s :%s" %
                                     (sender_member.get_irc_nickname(),
                                      sender_member.user,
                                      sender_member.host,
                                      channel.get_irc_name(),
-                                     message_text))
+                                     message_text),
+                                    channel.get_irc_name(),
+                                    mark,
+                                    sender_client)
+        if sender_client in self.session.clients.values():
+            sender_client.echo_message(channel, message, label, mark)
 
     def message_notification(self, messages_data):
         """Processes 'message' notifications."""
@@ -130,10 +319,16 @@ class NotificationHandler(object):
     def channel_member_notification(self, channel_members_data):
         """Processes 'channel-member-event' notifications."""
         for member_data in channel_members_data:
-            channel = self.gateway.get_channel(member_data["channelId"])
+            channel = self.session.get_channel(member_data["channelId"])
+            if not channel and member_data["channelId"] in \
+                    self.session.unsubscribed_channels:
+                continue
             # A 'channel-member-event' may arrive
             # before 'channel' and 'message' notifications
             if not channel:
+                self.session.reorder_buffer.add(
+                    member_data["channelId"], EVENT_MEMBER,
+                    member_data["accountId"])
                 continue
             self.process_member(channel, member_data["accountId"])
 
@@ -143,15 +338,18 @@ class NotificationHandler(object):
         channel : Channel instance
         member_account_id : string, new member's accountId
         """
+        if self.waits_for_members(channel):
+            self.defer_until_reloaded(channel, EVENT_MEMBER, member_account_id)
+            return
         if channel.get_member_from_account_id(member_account_id):
             return
-        username = self.gateway.get_username_from_id(member_account_id)
+        username = self.session.get_username_from_id(member_account_id)
         assert username
         channel_member = ChannelMember(username,
                                        member_account_id,
                                        channel.organization_name)
         channel.add_member(channel_member)
-        self.gateway.notify_clients(
+        self.session.notify_clients(
             ":%s!%s@%s JOIN :%s" %
             (channel_member.get_irc_nickname(),
              channel_member.user,
@@ -0,0 +1,227 @@
+"""
+outbox.py
+"""
+
+import json
+import logging
+import os
+from collections import deque
+
+from flow import Flow
+
+from . import common
+from . import timers
+
+
+LOG = logging.getLogger(__name__)
+# Acknowledged entries in the log before it is rewritten
+OUTBOX_COMPACT_ACKS = 1000
+# Send attempts before a message is dropped (about 5 minutes of retries)
+OUTBOX_RETRY_ATTEMPTS = 10
+# Record types of the log
+RECORD_ADD = "add"
+RECORD_ACK = "ack"
+
+
+class Outbox(object):
+    """Durable outbox of the messages sent by the IRC clients of a session.
+    Messages are appended to a log file (one JSON record per line) and
+    sent to Flow from a background task, in order for each channel: the
+    next message of a channel is only sent once the previous one was
+    (Flow errors are retried with backoff, see
+    FlowIRCGateway.call_flow_with_retry). Sent messages get an 'ack'
+    record, the log is truncated when nothing is pending and rewritten
+    after OUTBOX_COMPACT_ACKS acknowledgements.
+    fsync() is batched: the log is synced once before each send, so all
+    the messages accepted in a main loop tick cost one fsync().
+    The pending messages of the log are sent again on startup.
+    """
+
+    def __init__(self, session, path):
+        """Arguments:
+        session : FlowSession instance (with its Flow service started).
+        path : string, path of the log file.
+        Raises IOError/OSError if the log cannot be opened.
+        """
+        self.session = session
+        self.path = path
+        self.__queues = {}  # channelId --> deque of pending entries
+        self.__next_id = 1
+        self.__on_sent = {}  # entry id --> callback (see add())
+        self.__acked = 0  # 'ack' records in the log
+        self.__dirty = False  # records written since the last fsync()
+        self.__log = None
+        pending = self.__load()
+        self.__log = open(path, "a")
+        if self.__acked:
+            self.__rewrite(pending)
+        for entry in pending:
+            self.__enqueue(entry)
+        if pending:
+            LOG.warning("Outbox '%s': resending %d message(s).",
+                        path, len(pending))
+
+    def __load(self):
+        """Returns the pending entries of the log, in order."""
+        entries = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of the log
+                    LOG.warning("Outbox '%s': skipping bad record %r.",
+                                self.path, line)
+                    continue
+                if record["type"] == RECORD_ADD:
+                    entries[record["id"]] = record
+                elif record["type"] == RECORD_ACK:
+                    entries.pop(record["id"], None)
+                    self.__acked += 1
+                self.__next_id = max(self.__next_id, record["id"] + 1)
+        return [entries[entry_id] for entry_id in sorted(entries)]
+
+    def __write(self, record):
+        """Appends a record to the log (fsync() is left to sync())."""
+        self.__log.write(json.dumps(record) + "\n")
+        self.__log.flush()
+        self.__dirty = True
+
+    def __rewrite(self, pending):
+        """Replaces the log with the 'pending' entries only."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as log:
+            for entry in pending:
+                log.write(json.dumps(entry) + "\n")
+            log.flush()
+            os.fsync(log.fileno())
+        os.rename(temp_path, self.path)
+        self.__log.close()
+        self.__log = open(self.path, "a")
+        self.__acked = 0
+        self.__dirty = False
+        self.session.gateway.stats.incr("outbox.compactions")
+
+    def sync(self):
+        """fsync()s the log if records were written since the last call."""
+        if self.__dirty:
+            os.fsync(self.__log.fileno())
+            self.__dirty = False
+            self.session.gateway.stats.incr("outbox.syncs")
+
+    def close(self):
+        """Syncs and closes the log."""
+        if self.__log:
+            self.sync()
+            self.__log.close()
+            self.__log = None
+
+    def pending(self):
+        """Returns the number of messages waiting to be sent."""
+        return sum(len(queue) for queue in self.__queues.values())
+
+    def add(self, channel, message_text, on_sent=None):
+        """Queues a message for 'channel' (Channel instance).
+        'on_sent(message_id)' is called once it is sent (not for the
+        messages resent from the log on startup).
+        """
+        entry = {
+            "type": RECORD_ADD,
+            "id": self.__next_id,
+            "oid": channel.organization_id,
+            "cid": channel.channel_id,
+            "text": message_text,
+        }
+        self.__next_id += 1
+        if on_sent:
+            self.__on_sent[entry["id"]] = on_sent
+        self.__write(entry)
+        self.session.gateway.stats.incr("outbox.added")
+        self.__enqueue(entry)
+
+    def __enqueue(self, entry):
+        """Adds 'entry' to its channel queue, starting the delivery
+        if the queue was idle.
+        """
+        queue = self.__queues.setdefault(entry["cid"], deque())
+        queue.append(entry)
+        if len(queue) == 1:
+            self.session.gateway.scheduler.add_task(
+                self.__deliver(entry["cid"]))
+
+    def __deliver(self, channel_id):
+        """Background task that sends the first message of a channel
+        queue (one step, retries run on the gateway timers).
+        """
+        if self.__log is None:  # closed
+            return
+        self.sync()
+        entry = self.__queues[channel_id][0]
+        self.session.gateway.call_flow_with_retry(
+            "send_message",
+            lambda: self.__send(entry),
+            lambda message_id: self.__sent(entry, message_id),
+            backoff=timers.Backoff(max_attempts=OUTBOX_RETRY_ATTEMPTS),
+            on_failure=lambda flow_err: self.__failed(entry, flow_err))
+        yield
+
+    def __send(self, entry):
+        """Sends 'entry' to Flow."""
+        if self.__log is None:
+            raise Flow.FlowError("outbox closed")
+        message_id = self.session.flow_service.send_message(
+            entry["oid"], entry["cid"], entry["text"])
+        if not message_id:
+            raise Flow.FlowError("message not sent")
+        return message_id
+
+    def __sent(self, entry, message_id):
+        """Called once 'entry' was sent."""
+        self.session.gateway.stats.incr("outbox.sent")
+        on_sent = self.__on_sent.pop(entry["id"], None)
+        if on_sent:
+            on_sent(message_id)
+        self.__acknowledge(entry)
+
+    def __acknowledge(self, entry):
+        """Acknowledges the first message of a channel queue and
+        goes on with the next one.
+        """
+        if self.__log is None:
+            return
+        self.__write({"type": RECORD_ACK, "id": entry["id"]})
+        self.__acked += 1
+        queue = self.__queues[entry["cid"]]
+        queue.popleft()
+        if queue:
+            self.session.gateway.scheduler.add_task(
+                self.__deliver(entry["cid"]))
+        else:
+            del self.__queues[entry["cid"]]
+        if not self.__queues:
+            # Nothing pending: the whole log can go
+            self.__log.truncate(0)
+            self.__acked = 0
+        elif self.__acked >= OUTBOX_COMPACT_ACKS:
+            self.__rewrite(sorted(
+                (pending for queue in self.__queues.values()
+                 for pending in queue),
+                key=lambda pending: pending["id"]))
+
+    def __failed(self, entry, flow_err):
+        """Drops a message that could not be sent (retries exhausted)
+        and tells the IRC clients.
+        """
+        self.session.gateway.stats.incr("outbox.dropped")
+        self.__on_sent.pop(entry["id"], None)
+        channel = self.session.get_channel(entry["cid"])
+        self.session.notify_clients(
+            ":%s NOTICE %s :Message to %s could not be sent (%s): %s" % (
+                self.session.gateway.name,
+                common.irc_escape(self.session.flow_username),
+                channel.get_irc_name() if channel else entry["cid"],
+                flow_err,
+                entry["text"]))
+        self.__acknowledge(entry)
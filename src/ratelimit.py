@@ -0,0 +1,94 @@
+"""
+ratelimit.py
+"""
+
+import time
+
+
+# Command classes
+MESSAGES = "messages"  # sent to Flow
+QUERIES = "queries"  # scans of the session model (or Flow/store queries)
+OTHER = "other"
+
+COMMAND_CLASSES = {
+    "BATCH": MESSAGES,
+    "NOTICE": MESSAGES,
+    "PRIVMSG": MESSAGES,
+    "CHATHISTORY": QUERIES,
+    "LIST": QUERIES,
+    "LUSERS": QUERIES,
+    "MOTD": QUERIES,
+    "SEARCH": QUERIES,
+    "WHO": QUERIES,
+    "WHOIS": QUERIES,
+}
+# Never limited (keepalive and disconnection)
+EXEMPT_COMMANDS = frozenset(["PING", "PONG", "QUIT"])
+# Classes whose excess commands are rejected (RPL_TRYAGAIN), the
+# others are delayed until the client gets tokens again
+REJECTED_CLASSES = frozenset([QUERIES])
+
+# Default "BURST/RATE" limits: BURST commands at once, then RATE per second
+DEFAULT_LIMITS = {
+    MESSAGES: "50/10",
+    QUERIES: "10/1",
+    OTHER: "20/5",
+}
+# Unprocessed input (bytes) beyond which a client is disconnected
+MAX_PENDING_INPUT = 2 ** 16
+
+
+def parse_limit(value):
+    """Parses a 'BURST/RATE' limit ('0' for no limit).
+    Returns a (burst, rate) tuple, or 'None' for no limit.
+    Raises ValueError if 'value' is not valid.
+    """
+    if value.strip() == "0":
+        return None
+    burst, _, rate = value.partition("/")
+    (burst, rate) = (int(burst), float(rate))
+    if burst < 1 or rate <= 0:
+        raise ValueError("bad rate limit %r" % value)
+    return (burst, rate)
+
+
+def command_class(command):
+    """Returns the class of an IRC command, 'None' if it is exempt."""
+    if command in EXEMPT_COMMANDS:
+        return None
+    return COMMAND_CLASSES.get(command, OTHER)
+
+
+class TokenBucket(object):
+    """Token bucket: holds up to 'burst' tokens, refilled at 'rate'
+    tokens per second, each command takes one.
+    """
+
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self, now=None):
+        """Takes a token.
+        Returns 0 if there was one, otherwise the seconds until there is
+        one (and no token is taken).
+        """
+        now = now or time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def client_buckets(limits):
+    """Returns the buckets of a client: command class --> TokenBucket.
+    Arguments:
+    limits : dict, command class --> (burst, rate) or 'None'.
+    """
+    return dict((command_class_name, TokenBucket(*limit))
+                for command_class_name, limit in limits.items() if limit)
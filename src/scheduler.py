@@ -0,0 +1,246 @@
+"""
+scheduler.py
+"""
+
+import logging
+import time
+from collections import deque
+
+
+LOG = logging.getLogger(__name__)
+
+# Work classes
+NOTIFICATIONS = "notifications"
+READS = "reads"
+WRITES = "writes"
+TASKS = "tasks"
+
+DEFAULT_TIME_SLICE = 0.02  # seconds per work class and tick
+DEFAULT_NOTIFICATION_BUDGET = 20  # notifications per tick
+SOCKET_BUDGET = 64  # socket events (reads or writes) per tick
+TASK_BUDGET = 16  # background task steps per tick
+# Budgets adapt between base / BUDGET_RANGE and base * BUDGET_RANGE
+BUDGET_RANGE = 8
+
+
+class Budget(object):
+    """Item and time budget of a work class for one scheduler tick."""
+
+    def __init__(self, items, time_slice):
+        """Arguments:
+        items : integer, base number of work items per tick.
+        time_slice : float, maximum seconds per tick.
+        """
+        self.base_items = items
+        self.items = items
+        self.min_items = max(1, items // BUDGET_RANGE)
+        self.max_items = items * BUDGET_RANGE
+        self.time_slice = time_slice
+        self.used = 0
+        self.__deadline = 0
+
+    def start(self):
+        """Starts a new tick."""
+        self.used = 0
+        self.__deadline = time.time() + self.time_slice
+
+    def available(self):
+        """Returns True if the budget allows one more work item.
+        At least one item per tick is always allowed.
+        """
+        if self.used == 0:
+            return True
+        return self.used < self.items and time.time() < self.__deadline
+
+    def spend(self):
+        """Accounts one work item."""
+        self.used += 1
+
+    def grow(self):
+        """Doubles the budget (up to max_items)."""
+        self.items = min(self.max_items, self.items * 2)
+
+    def shrink(self):
+        """Halves the budget (down to min_items)."""
+        self.items = max(self.min_items, self.items // 2)
+
+    def relax(self):
+        """Moves the budget one step back towards its base."""
+        if self.items > self.base_items:
+            self.items = max(self.base_items, self.items // 2)
+        elif self.items < self.base_items:
+            self.items = min(self.base_items, self.items * 2)
+
+
+class WorkScheduler(object):
+    """Cooperative scheduler for the gateway main loop.
+    Each tick, Flow notifications, socket reads, socket writes and
+    background tasks get an item and time budget so that none of them
+    can starve the others. Budgets adapt at the end of each tick:
+    - A work class that could not finish its queue gets a bigger budget.
+    - Notifications get a smaller budget while the IRC side is backed up
+      (deferred socket events or client output over the high-water mark),
+      since processing notifications produces more IRC output.
+    - Background tasks get a smaller budget while anything else is
+      backed up.
+    """
+
+    def __init__(self, stats, time_slice=DEFAULT_TIME_SLICE,
+                 notification_budget=DEFAULT_NOTIFICATION_BUDGET):
+        """Arguments:
+        stats : stats.Counters instance.
+        time_slice : float, maximum seconds per work class and tick.
+        notification_budget : integer, base notifications per tick.
+        """
+        self.stats = stats
+        self.budgets = {
+            NOTIFICATIONS: Budget(notification_budget, time_slice),
+            READS: Budget(SOCKET_BUDGET, time_slice),
+            WRITES: Budget(SOCKET_BUDGET, time_slice),
+            TASKS: Budget(TASK_BUDGET, time_slice),
+        }
+        self.__tasks = deque()  # generators, one step per next()
+        self.__deferred = {READS: [], WRITES: []}  # sockets left last tick
+        self.__backlog = set()  # work classes that did not finish this tick
+        self.__last_backlog = set()  # same, for the previous tick
+        self.__rotation = 0  # first notification source of the tick
+
+    def configure(self, time_slice, notification_budget):
+        """Applies new time slice and notification budget values
+        (see FlowIRCGateway.reload_config).
+        """
+        for work_class, budget in self.budgets.items():
+            self.budgets[work_class] = Budget(
+                notification_budget if work_class == NOTIFICATIONS
+                else budget.base_items,
+                time_slice)
+
+    def add_task(self, task):
+        """Adds a background task.
+        Arguments:
+        task : generator, each step of the task runs on next().
+        """
+        self.__tasks.append(task)
+
+    def has_backlog(self):
+        """Returns True if there is work left over (from this tick
+        or the previous one).
+        """
+        return bool(self.__backlog or self.__last_backlog or self.__tasks)
+
+    def select_timeout(self, idle_timeout):
+        """Returns the timeout for select(): 0 if there is work left."""
+        return 0 if self.has_backlog() else idle_timeout
+
+    def run_notifications(self, sources, idle_timeout):
+        """Processes Flow notifications within the notifications budget.
+        Sources are served round-robin (one notification each per round,
+        starting with a different source every tick) so that a busy
+        source cannot starve the others.
+        Arguments:
+        sources : list of (process_one, max_items), 'process_one' is a
+        function that processes one notification with the given timeout
+        and returns False if there was none, 'max_items' is the maximum
+        notifications of the source per tick.
+        idle_timeout : float, seconds to wait for notifications (spread
+        between the sources) if there is no other work pending.
+        """
+        if not sources:
+            return
+        budget = self.budgets[NOTIFICATIONS]
+        budget.start()
+        self.__rotation = (self.__rotation + 1) % len(sources)
+        active = sources[self.__rotation:] + sources[:self.__rotation]
+        processed = [0] * len(active)
+        timeout = self.select_timeout(idle_timeout) / len(active)
+        pending = False
+        while active and budget.available():
+            for index, (process_one, max_items) in enumerate(active):
+                if process_one is None:
+                    continue
+                if not budget.available():
+                    break
+                if not process_one(timeout):
+                    active[index] = (None, 0)
+                    continue
+                budget.spend()
+                processed[index] += 1
+                if max_items and processed[index] >= max_items:
+                    self.stats.incr("scheduler.notifications.source_capped")
+                    active[index] = (None, 0)
+                    pending = True
+            timeout = 0
+            if all(process_one is None for process_one, _ in active):
+                break
+        else:
+            pending = True
+        if pending:
+            self.__backlog.add(NOTIFICATIONS)
+
+    def run_sockets(self, kind, sockets, handler):
+        """Handles ready sockets within the READS or WRITES budget.
+        Sockets that were deferred on the previous tick go first.
+        Arguments:
+        kind : READS or WRITES.
+        sockets : list of ready sockets (as returned by select()).
+        handler : function, called with each socket to handle.
+        """
+        budget = self.budgets[kind]
+        budget.start()
+        ready = set(sockets)
+        ordered = [sock for sock in self.__deferred[kind] if sock in ready]
+        first = set(ordered)
+        ordered.extend(sock for sock in sockets if sock not in first)
+        self.__deferred[kind] = []
+        for index, sock in enumerate(ordered):
+            if not budget.available():
+                self.__deferred[kind] = ordered[index:]
+                self.__backlog.add(kind)
+                return
+            handler(sock)
+            budget.spend()
+
+    def run_tasks(self):
+        """Runs background task steps (round-robin) within the TASKS
+        budget. A task that raises an exception is logged and dropped.
+        """
+        budget = self.budgets[TASKS]
+        budget.start()
+        while self.__tasks and budget.available():
+            task = self.__tasks.popleft()
+            try:
+                next(task)
+            except StopIteration:
+                continue
+            except Exception:
+                self.stats.incr("scheduler.task_errors")
+                LOG.exception("Background task %r failed", task)
+                continue
+            finally:
+                budget.spend()
+            self.__tasks.append(task)
+        if self.__tasks:
+            self.__backlog.add(TASKS)
+
+    def end_tick(self, output_backlog):
+        """Adapts the budgets for the next tick.
+        Arguments:
+        output_backlog : boolean, True if IRC clients have output over
+        the high-water mark.
+        """
+        backlog = self.__backlog
+        irc_backlog = output_backlog or READS in backlog or WRITES in backlog
+        for kind, budget in self.budgets.items():
+            if kind in backlog:
+                self.stats.incr("scheduler.%s.backlog_ticks" % kind)
+            if kind == NOTIFICATIONS and irc_backlog:
+                budget.shrink()
+            elif kind == TASKS and (backlog - set([TASKS]) or
+                                    output_backlog):
+                budget.shrink()
+            elif kind in backlog:
+                budget.grow()
+            else:
+                budget.relax()
+        self.__last_backlog = backlog
+        self.__backlog = set()
@@ -0,0 +1,191 @@
+"""
+sendq.py
+"""
+
+from collections import deque
+
+
+# Lanes, in priority order
+CONTROL = 0  # Numeric replies, PING/PONG, ERROR
+LIVE = 1  # Live traffic (notifications from Flow)
+REPLAY = 2  # History replay
+
+POLICY_PAUSE_REPLAY = "pause-replay"
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+POLICIES = (POLICY_PAUSE_REPLAY, POLICY_DROP, POLICY_DISCONNECT)
+
+DEFAULT_LIMIT = 2 ** 20
+DEFAULT_POLICY = POLICY_PAUSE_REPLAY
+# Beyond HARD_LIMIT_FACTOR * limit the client is disconnected
+# whatever the policy is.
+HARD_LIMIT_FACTOR = 4
+# Maximum size of the chunk handed to socket.send()
+CHUNK_SIZE = 2 ** 14
+
+
+class SendQueueFull(Exception):
+    """Raised by SendQueue.push when the client must be disconnected."""
+    pass
+
+
+class SendQueue(object):
+    """Bounded per-client output queue with priority lanes.
+    CONTROL lines are sent before LIVE lines. REPLAY lanes hold iterators
+    of lines which are only advanced while the queued data is below the
+    limit, so history replay is paused (and costs no memory) while the
+    client is slow.
+    When the queued data goes over the limit the policy applies:
+    - POLICY_PAUSE_REPLAY: only replay is paused.
+    - POLICY_DROP: replay is paused and LIVE lines are dropped, a summary
+      of the dropped lines per target is queued once the client catches up.
+    - POLICY_DISCONNECT: SendQueueFull is raised.
+    Lines can be followed by a mark (any object but bytes, e.g. the
+    message the line is for), consume() returns the marks of the lines
+    that were completely sent.
+    """
+
+    def __init__(self, stats, limit=DEFAULT_LIMIT, policy=DEFAULT_POLICY):
+        """Arguments:
+        stats : stats.Counters instance.
+        limit : integer, sendq limit in bytes.
+        policy : string, one of POLICIES.
+        """
+        assert policy in POLICIES
+        self.stats = stats
+        self.limit = limit
+        self.policy = policy
+        self.__lines = (deque(), deque())  # CONTROL and LIVE encoded lines
+        self.__replays = deque()  # iterators of REPLAY lines
+        self.__chunk = b""  # data being sent (may be partially sent)
+        self.__size = 0  # queued bytes, including self.__chunk
+        self.__dropped = {}  # target --> dropped lines count
+        self.__replay_paused = False
+        self.__marks = deque()  # (stream position, mark) of peeked marks
+        self.__peeked = 0  # bytes handed to peek() since the start
+        self.__sent = 0  # bytes consumed since the start
+
+    def __len__(self):
+        return self.__size
+
+    def has_pending_data(self):
+        """Returns True if there is data (or replay) waiting to be sent."""
+        return self.__size > 0 or (
+            bool(self.__replays) and self.__size < self.limit)
+
+    def has_pending_replay(self):
+        """Returns True if a REPLAY iterator is not exhausted yet."""
+        return bool(self.__replays)
+
+    def push(self, line, lane, target=None, mark=None):
+        """Queues an encoded line.
+        Arguments:
+        line : bytes, line to send (including the line separator).
+        lane : CONTROL or LIVE.
+        target : string, channel/nick the line is for (used to summarise
+        dropped lines).
+        mark : object returned by consume() once the line is sent
+        (optional, not for dropped lines).
+        Raises SendQueueFull if the client must be disconnected.
+        """
+        size = len(line)
+        if self.__size + size > self.limit and lane != CONTROL:
+            if self.policy == POLICY_DISCONNECT:
+                self.stats.incr("sendq.disconnects")
+                raise SendQueueFull("SendQ exceeded")
+            if self.policy == POLICY_DROP:
+                self.stats.incr("sendq.dropped_lines")
+                self.stats.incr("sendq.dropped_bytes", size)
+                self.__dropped[target] = self.__dropped.get(target, 0) + 1
+                return
+        if self.__size + size > self.limit * HARD_LIMIT_FACTOR:
+            self.stats.incr("sendq.disconnects")
+            raise SendQueueFull("SendQ exceeded")
+        self.__lines[lane].append(line)
+        if mark is not None:
+            self.__lines[lane].append(mark)
+        self.__size += size
+        self.stats.set_max("sendq.high_water_bytes", self.__size)
+
+    def push_replay(self, lines):
+        """Queues an iterator of encoded REPLAY lines
+        (and marks, see push()).
+        """
+        self.__replays.append(iter(lines))
+
+    def pop_dropped_summary(self):
+        """Returns (and clears) the map target --> dropped lines count,
+        only once the queue is back under the limit.
+        """
+        if not self.__dropped or self.__size >= self.limit:
+            return {}
+        dropped, self.__dropped = self.__dropped, {}
+        return dropped
+
+    def __fill_from_replay(self, chunk, chunk_size):
+        """Appends REPLAY lines to 'chunk' (of 'chunk_size' bytes)
+        while the queue is under the limit.
+        Returns the number of bytes added.
+        """
+        added = 0
+        while self.__replays and chunk_size + added < CHUNK_SIZE:
+            if self.__size + added >= self.limit:
+                if not self.__replay_paused:
+                    self.__replay_paused = True
+                    self.stats.incr("sendq.replay_paused")
+                break
+            self.__replay_paused = False
+            try:
+                line = next(self.__replays[0])
+            except StopIteration:
+                self.__replays.popleft()
+                continue
+            if not isinstance(line, bytes):
+                self.__marks.append((self.__peeked + chunk_size + added, line))
+                continue
+            chunk.append(line)
+            added += len(line)
+        return added
+
+    def peek(self):
+        """Returns the data to hand to socket.send()."""
+        if self.__chunk:
+            return self.__chunk
+        chunk = []
+        chunk_size = 0
+        for lines in self.__lines:
+            # (the mark of the last line is taken even over CHUNK_SIZE)
+            while lines and (chunk_size < CHUNK_SIZE or
+                             not isinstance(lines[0], bytes)):
+                line = lines.popleft()
+                if not isinstance(line, bytes):
+                    self.__marks.append((self.__peeked + chunk_size, line))
+                    continue
+                chunk.append(line)
+                chunk_size += len(line)
+        # Lines popped from the lanes are already accounted in self.__size
+        self.__size += self.__fill_from_replay(chunk, chunk_size)
+        self.__chunk = b"".join(chunk)
+        self.__peeked += len(self.__chunk)
+        return self.__chunk
+
+    def consume(self, sent):
+        """Removes the first 'sent' bytes returned by peek().
+        Returns the list of marks of the lines sent.
+        """
+        self.__chunk = self.__chunk[sent:]
+        self.__size -= sent
+        self.__sent += sent
+        self.stats.incr("sendq.bytes_sent", sent)
+        marks = []
+        while self.__marks and self.__marks[0][0] <= self.__sent:
+            marks.append(self.__marks.popleft()[1])
+        return marks
+
+    def pending_data(self):
+        """Returns all the queued data (pending replays are not included).
+        Used to hand the client over to another process.
+        """
+        return b"".join([self.__chunk] +
+                        [line for lines in self.__lines for line in lines
+                         if isinstance(line, bytes)])
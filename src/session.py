@@ -0,0 +1,932 @@
+"""
+session.py
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from flow import Flow
+
+from . import common
+from . import outbox
+from . import sendq
+from . import startup
+from . import store
+from . import watchdog
+from .channel import ChannelMember, Channel, DirectChannel, \
+    HistoryNotLoaded, MembersNotLoaded
+from .notification import NotificationHandler, ReorderBuffer, \
+    PENDING_CHANNEL_TTL
+
+
+LOG = logging.getLogger(__name__)
+# Cached reply blocks per session (see FlowSession.cached_replies)
+REPLY_CACHE_MAX_ENTRIES = 256
+# Messages sent from IRC waiting for their Flow notification
+# (see FlowSession.track_sent_message)
+SENT_MESSAGES_MAX = 1000
+
+# Configuration of a Flow account hosted by the gateway
+# (see flow_irc_gateway.read_accounts_from_config)
+AccountConfig = namedtuple(
+    "AccountConfig", [
+        "name",  # IRC login (PASS/SASL) name, empty in single-account mode
+        "username",  # Flow username
+        "password",  # IRC PASS/SASL password, 'None' if not required
+        "uri",  # Flow account gateway uri
+        "db",  # Flow database directory
+        "attachment_dir",  # Flow local attachments directory
+        "max_clients",  # IRC clients limit (0 for no limit)
+        "sendq_limit",  # per-client sendq limit in bytes
+        "notification_budget",  # Flow notifications per main loop tick
+    ])
+
+
+class FlowSession(object):
+    """A Flow account session hosted by the gateway.
+    It holds the account's Flow service, its model (organizations,
+    channels, members), its notification callbacks and its IRC clients.
+    """
+
+    def __init__(self, gateway, account):
+        """Arguments:
+        gateway : FlowIRCGateway instance.
+        account : AccountConfig instance.
+        """
+        self.gateway = gateway
+        self.account = account
+        self.show_timestamps = gateway.show_timestamps
+
+        self.channels = {}  # channelId --> Channel instance.
+        self.clients = {}  # Socket --> IRCClient instance.
+        self.organizations = {}  # orgId --> Organization Name
+        self.pending_channels = {}  # channelId --> PendingChannel instance
+        # channelIds of the pending channels whose members are being
+        # loaded (see NotificationHandler.process_channel_message)
+        self.loading_channels = set()
+        # Events of channels not known yet
+        self.reorder_buffer = ReorderBuffer(self)
+        # channelIds excluded by the subscription rules
+        self.unsubscribed_channels = set()
+
+        self.client_connected = True
+        # The organizations and channels are loaded and kept up to date
+        # by the notifications (see get_orgs_and_channels)
+        self.model_loaded = False
+        self.flow_service = None
+        self.flow_initialized = False
+        # True while the Flow service starts in the background
+        # (see start_flow_service)
+        self.flow_starting = False
+        self.waiting_clients = []  # IRCClients waiting for the start
+        self.__starter = None  # threading.Thread starting the service
+        self.__start_error = None  # Flow.FlowError of the background start
+        self.flow_username = ""
+        self.flow_account_id = ""
+        self.notification_handler = NotificationHandler(self)
+        self.outbox = None  # outbox.Outbox instance (with 'outbox-dir')
+        # Lookup indexes, built on demand (see directory_changed)
+        self.__channels_by_irc_name = None  # IRC name --> Channel
+        self.__members_by_nickname = None  # IRC nickname --> ChannelMember
+        self.__direct_channels = None  # other member IRC nick --> DM
+        self.__oids_by_name = None  # organization name --> orgId
+        self.__peer_account_ids = {}  # Flow username --> accountId
+        # Incremented on every change of the channels, members or
+        # organizations (see directory_changed)
+        self.model_version = 0
+        self.__reply_cache = {}  # key --> encoded reply block
+        self.__reply_cache_version = 0
+        # messageId --> (IRCClient, label) of the messages sent from IRC
+        self.sent_messages = OrderedDict()
+        # channelIds whose Flow history is in the message store (and kept
+        # up to date by the notifications) since the session started
+        self.synced_channels = set()
+        self.__backfilling = False  # see start_history_backfill
+        # channelId --> creationTime of the latest message seen
+        # (see channels_by_activity)
+        self.__latest_message_times = {}
+        # channelId --> functions called once the members of an evicted
+        # channel are reloaded (see reload_channel)
+        self.reloading_channels = {}
+
+    def terminate(self):
+        """Terminates the Flow service."""
+        if self.__starter:
+            # (the service being started is terminated once it is up)
+            self.__starter.join()
+        if self.outbox:
+            self.outbox.close()
+        if self.flow_service:
+            self.flow_service.terminate()
+
+    def directory_changed(self):
+        """Drops the member and organization lookup indexes (and the
+        cached replies), to be called when channels, channel members or
+        organizations change.
+        """
+        self.model_version += 1
+        self.__members_by_nickname = None
+        self.__direct_channels = None
+        self.__oids_by_name = None
+
+    def cached_replies(self, key, render):
+        """Returns the reply block for 'key', rendered with 'render()'
+        (a function returning the encoded block) only if the model
+        changed since it was cached.
+        """
+        if self.__reply_cache_version != self.model_version:
+            self.__reply_cache = {}
+            self.__reply_cache_version = self.model_version
+        block = self.__reply_cache.get(key)
+        if block is None:
+            self.gateway.stats.incr("replies.cache_misses")
+            if len(self.__reply_cache) >= REPLY_CACHE_MAX_ENTRIES:
+                self.__reply_cache = {}
+            block = self.__reply_cache[key] = render()
+        else:
+            self.gateway.stats.incr("replies.cache_hits")
+        return block
+
+    def drop_reply_cache(self):
+        """Drops the cached reply blocks (see eviction.ChannelEvictor),
+        they are rendered again on demand.
+        Returns the size of the dropped blocks in bytes.
+        """
+        size = sum(len(block) for block in self.__reply_cache.values())
+        self.__reply_cache = {}
+        return size
+
+    def __build_member_indexes(self):
+        """Builds the member and direct conversation indexes."""
+        self.__members_by_nickname = {}
+        self.__direct_channels = {}
+        for channel in self.channels.values():
+            # (the members of evicted channels are not reloaded for this)
+            for member in channel.loaded_members():
+                self.__members_by_nickname.setdefault(
+                    member.get_irc_nickname(), member)
+            if isinstance(channel, DirectChannel) and \
+                    len(channel.members) == 2:
+                other_nickname = \
+                    channel.get_other_dc_member().get_irc_nickname()
+                # Prefer the conversations started from IRC
+                if channel.created_on_irc_session or \
+                        other_nickname not in self.__direct_channels:
+                    self.__direct_channels[other_nickname] = channel
+
+    def get_member(self, irc_nickname):
+        """Gets a channel member from its IRC nickname.
+        Arguments:
+        irc_nickname : string, IRC nickname of a 'ChannelMember'.
+        Returns a ChannelMember instance or 'None' if not found.
+        """
+        if self.__members_by_nickname is None:
+            self.__build_member_indexes()
+        return self.__members_by_nickname.get(irc_nickname)
+
+    def get_oid_from_name(self, org_name):
+        """Returns an the orgId given an organization name.
+        Arguments:
+        org_name : string, organization name (or its IRC escaped form,
+        as in the member nicknames).
+        Returns an empty string if not found.
+        """
+        if self.__oids_by_name is None:
+            self.__oids_by_name = {}
+            for oid, oname in self.organizations.iteritems():
+                self.__oids_by_name.setdefault(common.irc_escape(oname), oid)
+            for oid, oname in self.organizations.iteritems():
+                self.__oids_by_name[oname] = oid
+        return self.__oids_by_name.get(org_name, "")
+
+    def get_member_account_id(self, username):
+        """Returns an accountId string from Flow given the username.
+        Arguments:
+        username : string, Flow username of the account.
+        Returns an empty string if not found.
+        """
+        if username in self.__peer_account_ids:
+            return self.__peer_account_ids[username]
+        try:
+            member_peer_data = self.flow_service.get_peer(username)
+            if member_peer_data:
+                self.__peer_account_ids[username] = \
+                    member_peer_data["accountId"]
+                return member_peer_data["accountId"]
+        except Flow.FlowError as flow_err:
+            LOG.debug("get_peer: '%s'", flow_err)
+        return ""
+
+    def transmit_message_to_channel(self, channel, message_text,
+                                    client=None, label=None):
+        """Sends a message using Flow.send_message
+        (through the outbox if there is one).
+        Arguments:
+        channel : Channel instance
+        message_test : Text to be sent to the channel.
+        client : IRCClient instance that sent the message (its echo is
+        handled apart, see track_sent_message).
+        label : string, IRCv3 'label' tag of the client command.
+        Returns True if the message was sent successfully (or queued).
+        """
+        channel.touch()
+        if self.outbox:
+            try:
+                self.outbox.add(
+                    channel, message_text,
+                    lambda message_id: self.track_sent_message(
+                        message_id, client, label))
+                return True
+            except (IOError, OSError) as io_err:
+                LOG.error("Outbox: %s", io_err)
+                return False
+        try:
+            message_id = self.flow_service.send_message(
+                channel.organization_id,
+                channel.channel_id,
+                message_text)
+            self.track_sent_message(message_id, client, label)
+            return message_id != ""
+        except Flow.FlowError as flow_err:
+            LOG.debug("send_message: '%s'", flow_err)
+            return False
+
+    def track_sent_message(self, message_id, client, label):
+        """Records the id of a message sent by 'client', so that its Flow
+        notification is echoed to the client only if it negotiated
+        'echo-message' (see IRCClient.echo_message).
+        """
+        if not message_id or not client:
+            return
+        self.sent_messages[message_id] = (client, label)
+        if len(self.sent_messages) > SENT_MESSAGES_MAX:
+            self.sent_messages.popitem(last=False)
+
+    def get_direct_channel(self, irc_nickname, username, organization_name):
+        """Returns the direct conversation with a member: an existing one
+        (started from IRC or loaded from Flow), otherwise a new one.
+        Arguments:
+        irc_nickname : string, IRC nickname of the member.
+        username, organization_name : strings, parts of 'irc_nickname'.
+        Returns 'None' if the direct conversation could not be created.
+        """
+        if self.__direct_channels is None:
+            self.__build_member_indexes()
+        channel = self.__direct_channels.get(irc_nickname)
+        if channel:
+            self.gateway.stats.incr("directory.dm_reused")
+            return channel
+        member = self.get_member(irc_nickname)
+        if member:
+            if member.account_id == self.flow_account_id:
+                return None
+            member_account_id = member.account_id
+        else:
+            # This is an unknown member to this gateway,
+            # try to get the peer data
+            member_account_id = self.get_member_account_id(username)
+        oid = self.get_oid_from_name(organization_name)
+        if not member_account_id or not oid:
+            return None
+        self.gateway.stats.incr("directory.dm_created")
+        return self.create_direct_channel(
+            member_account_id, username, oid, organization_name)
+
+    def create_direct_channel(self,
+                              account_id,
+                              account_username,
+                              oid,
+                              organization_name):
+        """Creates a direct conversation channel.
+        Arguments:
+        account_id : string, receiver's accountId.
+        account_username : string, receiver's username.
+        oid : string, orgId the two members share.
+        organization_name : Name of the Organization the two members share.
+        Returns a 'Channel' instance.
+        If there's an error in the channel creation, then 'None' is returned.
+        """
+        direct_conversation_channel = None
+        try:
+            direct_conversation_cid = \
+                self.flow_service.new_direct_conversation(
+                    oid,
+                    account_id)
+            if direct_conversation_cid:
+                direct_conversation_channel = DirectChannel(
+                    self,
+                    direct_conversation_cid,
+                    oid,
+                    organization_name,
+                    True)
+                current_user = ChannelMember(
+                    self.flow_username,
+                    self.flow_account_id,
+                    organization_name)
+                other_member = ChannelMember(
+                    account_username, account_id, organization_name)
+                direct_conversation_channel.add_member(current_user)
+                direct_conversation_channel.add_member(other_member)
+                self.add_channel(direct_conversation_channel)
+        except Flow.FlowError as flow_err:
+            LOG.debug("NewDirectConversation: '%s'", flow_err)
+        return direct_conversation_channel
+
+    def get_channel(self, channel_id):
+        """Returns a 'Channel' instance given a channelId.
+        Returns 'None' if not found.
+        """
+        try:
+            return self.channels[channel_id]
+        except KeyError:
+            return None
+
+    def get_channel_from_irc_name(self, channel_irc_name):
+        """Returns a 'Channel' instance given the IRC name.
+        Returns 'None' if not found.
+        """
+        if self.__channels_by_irc_name is None:
+            self.__channels_by_irc_name = {}
+            for channel in self.channels.values():
+                self.__channels_by_irc_name.setdefault(
+                    channel.get_irc_name(), channel)
+        return self.__channels_by_irc_name.get(channel_irc_name)
+
+    def check_channel_collision(self, channel):
+        """Checks and sets if a 'Channel'
+        instance IRC name collides with other channel.
+        """
+        if self.get_channel_from_irc_name(channel.get_irc_name()):
+            channel.name_collides = True
+
+    def get_channels(self, oid, org_name):
+        """Loads all channels of a given organization (the ones excluded
+        by the subscription rules are only recorded, see
+        unsubscribe_channel).
+        Arguments:
+        oid : string, orgId of the Organization
+        org_name : string, Name of the Organization
+        """
+        channels = self.flow_service.enumerate_channels(oid)
+        for channel in channels:
+            channel_name = channel["name"]
+            direct_channel = channel["purpose"] == "direct message"
+            if not self.gateway.subscriptions.wants_channel(
+                    org_name, channel_name, direct_channel):
+                self.unsubscribe_channel(channel["id"])
+                continue
+            if direct_channel:
+                irc_channel = DirectChannel(
+                    self, channel["id"], oid, org_name)
+            else:
+                irc_channel = Channel(
+                    self, channel["id"], channel_name, oid, org_name)
+                self.check_channel_collision(irc_channel)
+            self.get_channel_members(irc_channel)
+            self.add_channel(irc_channel)
+            self.reorder_buffer.discard(irc_channel.channel_id)
+
+    def unsubscribe_channel(self, channel_id):
+        """Records a channel excluded by the subscription rules, its
+        notifications are ignored.
+        """
+        if channel_id not in self.unsubscribed_channels:
+            self.unsubscribed_channels.add(channel_id)
+            self.gateway.stats.incr("subscriptions.skipped_channels")
+        self.pending_channels.pop(channel_id, None)
+        self.reorder_buffer.discard(channel_id)
+
+    def get_orgs_and_channels(self):
+        """Loads all Organizations and Channels the account is member of."""
+        self.organizations = {}
+        self.channels = {}
+        self.__channels_by_irc_name = None
+        self.directory_changed()
+        orgs = self.flow_service.enumerate_orgs()
+        for org in orgs:
+            oid = org["id"]
+            org_name = org["name"]
+            self.organizations[oid] = org_name
+            self.get_channels(oid, org_name)
+        self.model_loaded = True
+
+    def get_local_account(self):
+        """Returns the first local Flow account on this device.
+        It returns the username string.
+        Returns 'None' if there is no account on the device.
+        """
+        local_accounts = self.flow_service.enumerate_local_accounts()
+        if not local_accounts:
+            return None
+        return local_accounts[0]["username"]
+
+    def register_callbacks(self):
+        """Registers all the notification types this gateway supports."""
+        self.flow_service.register_callback(
+            Flow.ORG_NOTIFICATION,
+            self.notification_handler.org_notification)
+        self.flow_service.register_callback(
+            Flow.CHANNEL_NOTIFICATION,
+            self.notification_handler.channel_notification)
+        self.flow_service.register_callback(
+            Flow.MESSAGE_NOTIFICATION,
+            self.notification_handler.message_notification)
+        self.flow_service.register_callback(
+            Flow.CHANNEL_MEMBER_NOTIFICATION,
+            self.notification_handler.channel_member_notification)
+
+    def unregister_callbacks(self):
+        """Unregisters all the notification types this gateway supports."""
+        self.flow_service.unregister_callback(Flow.ORG_NOTIFICATION)
+        self.flow_service.unregister_callback(Flow.CHANNEL_NOTIFICATION)
+        self.flow_service.unregister_callback(Flow.MESSAGE_NOTIFICATION)
+        self.flow_service.unregister_callback(Flow.CHANNEL_MEMBER_NOTIFICATION)
+
+    def initialize_flow_service(self, options):
+        """Initializes the Flow Service by logging into the user
+        account and starting up the Flow session.
+        Arguments:
+        options : container object with the Flow options (flowappglue,
+        debug, server, port, schema), the account specific ones are
+        taken from self.account.
+        """
+        self.flow_initialized = False
+        try:
+            self.__start_flow_service(options)
+        except Flow.FlowError as flow_err:
+            LOG.error("Flow Initialization (%s): '%s'",
+                      self.account.name or self.account.username, flow_err)
+            return
+        self.__open_outbox(options)
+
+    def start_flow_service(self, options):
+        """Starts the Flow service (see initialize_flow_service) in a
+        background thread, so that the gateway goes on serving its IRC
+        clients meanwhile. 'flow_starting' is True until
+        finish_flow_service_start() sees the thread done.
+        """
+        def run():
+            """Thread function, keeps the Flow.FlowError (if any)."""
+            try:
+                self.__start_flow_service(options)
+            except Flow.FlowError as flow_err:
+                self.__start_error = flow_err
+
+        self.flow_initialized = False
+        self.flow_starting = True
+        self.__start_error = None
+        self.__starter = threading.Thread(
+            target=run, name="flow-start-%s" % self.account.name)
+        self.__starter.daemon = True
+        self.__starter.start()
+
+    def finish_flow_service_start(self, options):
+        """Completes the background start of the Flow service
+        (on the main thread) once it is over.
+        Returns False if the service is still starting.
+        """
+        if self.__starter.is_alive():
+            return False
+        self.__starter.join()
+        self.__starter = None
+        self.flow_starting = False
+        if self.__start_error:
+            LOG.error("Flow Initialization (%s): '%s'",
+                      self.account.name or self.account.username,
+                      self.__start_error)
+        else:
+            self.__open_outbox(options)
+        return True
+
+    def __start_flow_service(self, options):
+        """Starts flowappglue and the Flow session of the account
+        (the startup timing of the first session is recorded).
+        Raises Flow.FlowError if the service cannot be started.
+        """
+        timer = self.gateway.startup
+        spawn_started = time.time()
+        self.flow_username = self.account.username
+        # (the Flow calls of the main thread are reported on stalls)
+        self.flow_service = watchdog.TracedFlow(
+            Flow(
+                "",
+                "",
+                options.flowappglue,
+                options.debug,
+                options.server,
+                options.port,
+                self.account.db,
+                options.schema,
+                self.account.attachment_dir),
+            self.gateway.watchdog)
+        start_up_started = time.time()
+        timer.record(startup.GLUE_SPAWN, spawn_started, start_up_started)
+        if not self.flow_username:
+            self.flow_username = self.get_local_account()
+        if not self.flow_username:
+            raise Flow.FlowError("Local account not found.")
+        self.flow_service.start_up(self.flow_username, self.account.uri)
+        timer.record(startup.START_UP, start_up_started, time.time())
+
+    def __open_outbox(self, options):
+        """Opens the outbox of the account (with 'outbox-dir') and
+        marks the session as initialized.
+        """
+        try:
+            if options.outbox_dir:
+                self.outbox = outbox.Outbox(self, os.path.join(
+                    options.outbox_dir, "%s.outbox" % self.flow_username))
+            self.flow_initialized = True
+        except (IOError, OSError) as io_err:
+            LOG.error("Could not open the outbox (%s): %s",
+                      self.account.name or self.account.username, io_err)
+
+    def process_one_notification(self, timeout):
+        """Processes one Flow notification of this session.
+        Returns False if there was none within 'timeout' seconds.
+        """
+        return self.flow_service.process_one_notification(timeout)
+
+    def add_channel(self, channel):
+        """Adds a 'Channel' instance to the session's channel list."""
+        self.channels[channel.channel_id] = channel
+        if self.__channels_by_irc_name is not None:
+            self.__channels_by_irc_name.setdefault(
+                channel.get_irc_name(), channel)
+        self.directory_changed()
+
+    def add_client(self, client):
+        """Adds a registered 'IRCClient' instance to the session.
+        Returns False if the account's client limit was reached.
+        """
+        if self.account.max_clients and \
+                len(self.clients) >= self.account.max_clients:
+            self.gateway.stats.incr("sessions.clients_rejected")
+            return False
+        self.clients[client.client_socket] = client
+        return True
+
+    def remove_client(self, client):
+        """Removes 'Client' instance 'client' from the clients map.
+        The session stops processing notifications until reconnection,
+        unless there is a message store to keep up to date.
+        """
+        if client.client_socket not in self.clients:
+            return
+        del self.clients[client.client_socket]
+        if not self.clients and not self.gateway.store:
+            self.unregister_callbacks()
+            self.client_connected = False
+            # (reloaded on the next registration)
+            self.model_loaded = False
+
+    def notify_clients(self, irc_msg, target=None, mark=None, exclude=None):
+        """Sends 'msg' string to all IRC client connections.
+        Arguments:
+        irc_msg : string, IRC message.
+        target : string, channel/nick the message is for.
+        mark : read marker moved once the message is sent (optional,
+        see IRCClient.message).
+        exclude : IRCClient instance not to send the message to.
+        """
+        for client in self.clients.values():
+            if client is not exclude:
+                client.message(irc_msg, sendq.LIVE, target, mark)
+
+    def get_username_from_id(self, account_id):
+        """Returns the username of a given account.
+        Arguments:
+        account_id : string
+        """
+        peer_data = self.flow_service.get_peer_from_id(account_id)
+        return peer_data["username"] if peer_data else ""
+
+    def get_channel_members(self, channel):
+        """Retrieves (via Flow.enumerate_channel_members) and sets
+        all channel members on a given 'Channel' instance.
+        """
+        members = self.flow_service.enumerate_channel_members(
+            channel.channel_id)
+        for member in members:
+            account_id = member["accountId"]
+            if channel.get_member_from_account_id(account_id):
+                # Already loaded (e.g. retried call)
+                continue
+            account_username = self.get_username_from_id(account_id)
+            assert account_username
+            if account_username == self.flow_username:
+                self.flow_account_id = account_id
+            channel_member = ChannelMember(
+                account_username, account_id, channel.organization_name)
+            channel.add_member(channel_member)
+
+    def rehydrate_channel(self, channel):
+        """Reloads the members of an evicted channel from Flow
+        (see Channel.evict()).
+        Raises MembersNotLoaded if Flow fails, the channel stays evicted
+        (and the reload is tried again on the next use).
+        """
+        try:
+            self.reload_channel_members(channel)
+        except Flow.FlowError as flow_err:
+            LOG.error("Could not reload the members of %s: '%s'",
+                      channel.get_irc_name(), flow_err)
+            raise MembersNotLoaded("members of %s not available: %s" %
+                                   (channel.get_irc_name(), flow_err))
+
+    def reload_channel_members(self, channel):
+        """Reloads the members of an evicted channel from Flow.
+        Raises Flow.FlowError if Flow fails (the channel stays evicted).
+        """
+        channel.evicted = False
+        channel.touch()
+        try:
+            self.get_channel_members(channel)
+        except Flow.FlowError:
+            channel.evicted = True
+            raise
+        self.gateway.stats.incr("eviction.channels_reloaded")
+
+    def reload_channel(self, channel, on_loaded):
+        """Reloads the members of an evicted channel in the background
+        (retried with backoff, see FlowIRCGateway.call_flow_with_retry),
+        without blocking on Flow, then calls 'on_loaded()'. A reload
+        already in progress is shared.
+        """
+        channel_id = channel.channel_id
+        if channel_id in self.reloading_channels:
+            self.reloading_channels[channel_id].append(on_loaded)
+            return
+        self.reloading_channels[channel_id] = [on_loaded]
+
+        def loaded(_):
+            """Calls the functions waiting for the members."""
+            for callback in self.reloading_channels.pop(channel_id, []):
+                callback()
+
+        def failed(_):
+            """Drops the waiting functions."""
+            self.reloading_channels.pop(channel_id, None)
+        self.gateway.call_flow_with_retry(
+            "enumerate_channel_members",
+            lambda: self.reload_channel_members(channel),
+            loaded, on_failure=failed)
+
+    def store_messages(self, messages, channel=None):
+        """Adds Flow messages to the message store (if any).
+        Arguments:
+        messages : list of Flow message dicts.
+        channel : 'Channel' instance of the messages, if known (its IRC
+        name and member nicknames are indexed for the search).
+        """
+        for message in messages:
+            if message["creationTime"] > self.__latest_message_times.get(
+                    message["channelId"], 0):
+                self.__latest_message_times[message["channelId"]] = \
+                    message["creationTime"]
+        if not self.gateway.store:
+            return
+        channel_name = ""
+        sender_names = {}
+        if channel:
+            channel_name = channel.get_irc_name()
+            # (the members of evicted channels are not reloaded for this)
+            for member in channel.loaded_members():
+                sender_names[member.account_id] = member.get_irc_nickname()
+        new_messages = self.gateway.store.add_messages(
+            messages, channel_name, sender_names)
+        self.gateway.stats.incr("store.messages_added", new_messages)
+
+    def sync_channel(self, channel):
+        """Loads the Flow history of 'channel' into the message store,
+        once per session: afterwards the notifications keep it up to date.
+        """
+        if channel.channel_id in self.synced_channels:
+            self.gateway.stats.incr("store.history_hits")
+            return
+        self.gateway.stats.incr("store.history_fetches")
+        self.store_messages(self.flow_service.enumerate_messages(
+            channel.organization_id, channel.channel_id), channel)
+        self.synced_channels.add(channel.channel_id)
+
+    def start_history_backfill(self):
+        """Starts loading the Flow history of the channels into the
+        message store in the background (see backfill_history), for the
+        search. Does nothing without a message store or while the
+        backfill is running.
+        """
+        if not self.gateway.store or self.__backfilling:
+            return
+        self.__backfilling = True
+        self.gateway.scheduler.add_task(self.backfill_history())
+
+    def backfill_history(self):
+        """Background task that loads the Flow history of one channel
+        per step (see sync_channel), the most active channels first.
+        """
+        try:
+            for channel in self.channels_by_activity():
+                if channel.channel_id in self.synced_channels or \
+                        channel.channel_id not in self.channels:
+                    continue
+                try:
+                    self.sync_channel(channel)
+                except Flow.FlowError as flow_err:
+                    # (loaded when it is needed, see get_history)
+                    self.gateway.stats.incr("store.backfill_errors")
+                    LOG.warning("Could not load the history of %s: '%s'",
+                                channel.get_irc_name(), flow_err)
+                yield
+        finally:
+            self.__backfilling = False
+
+    def unsynced_channel_count(self):
+        """Returns the number of channels whose Flow history is not
+        in the message store yet (see backfill_history).
+        """
+        return len(set(self.channels) - self.synced_channels)
+
+    def __history_not_loaded(self, channel, flow_err):
+        """Returns the HistoryNotLoaded exception of a Flow error raised
+        while loading the history of 'channel'.
+        """
+        self.gateway.stats.incr("store.history_errors")
+        LOG.error("Could not load the history of %s: '%s'",
+                  channel.get_irc_name(), flow_err)
+        return HistoryNotLoaded("history of %s not available: %s" %
+                                (channel.get_irc_name(), flow_err))
+
+    def __sync_channel_history(self, channel):
+        """sync_channel(), raises HistoryNotLoaded if Flow fails."""
+        try:
+            self.sync_channel(channel)
+        except Flow.FlowError as flow_err:
+            raise self.__history_not_loaded(channel, flow_err)
+
+    def __enumerate_channel_messages(self, channel):
+        """Returns the Flow messages of 'channel'.
+        Raises HistoryNotLoaded if Flow fails.
+        """
+        try:
+            return self.flow_service.enumerate_messages(
+                channel.organization_id, channel.channel_id)
+        except Flow.FlowError as flow_err:
+            raise self.__history_not_loaded(channel, flow_err)
+
+    def get_message(self, channel, message_id):
+        """Returns the message of 'channel' with the given id,
+        or 'None' if not found.
+        Raises HistoryNotLoaded if Flow fails.
+        """
+        if self.gateway.store:
+            self.__sync_channel_history(channel)
+            message = self.gateway.store.get_message(message_id)
+            if message and message["channelId"] == channel.channel_id:
+                return message
+            return None
+        for message in self.__enumerate_channel_messages(channel):
+            if message["id"] == message_id:
+                return message
+        return None
+
+    def get_history(self, channel, limit, before=None, after=None,
+                    oldest_first=False):
+        """Returns messages of 'channel' in chronological order, from the
+        message store if there is one (Flow is only queried the first
+        time in the session), otherwise from Flow.
+        Arguments: see store.MessageStore.get_messages.
+        Raises HistoryNotLoaded if Flow fails.
+        """
+        if self.gateway.store:
+            self.__sync_channel_history(channel)
+            return self.gateway.store.get_messages(
+                channel.channel_id, limit, before, after, oldest_first)
+        messages = sorted(
+            self.__enumerate_channel_messages(channel),
+            key=lambda message: message["creationTime"])
+        if messages:
+            self.__latest_message_times[channel.channel_id] = max(
+                self.__latest_message_times.get(channel.channel_id, 0),
+                messages[-1]["creationTime"])
+        messages = [message for message in messages
+                    if (before is None or message["creationTime"] < before)
+                    and (after is None or message["creationTime"] > after)]
+        if not limit:
+            return messages
+        return messages[:limit] if oldest_first else messages[-limit:]
+
+    def channels_by_activity(self):
+        """Returns the channels, the one with the latest message first
+        (from the message store and the messages seen in this session),
+        the channels without known messages last, by IRC name.
+        """
+        latest_times = {}
+        if self.gateway.store:
+            latest_times = self.gateway.store.get_latest_message_times()
+        for channel_id, creation_time in \
+                self.__latest_message_times.iteritems():
+            if creation_time > latest_times.get(channel_id, 0):
+                latest_times[channel_id] = creation_time
+        return sorted(
+            self.channels.values(),
+            key=lambda channel: (-latest_times.get(channel.channel_id, 0),
+                                 channel.get_irc_name()))
+
+    def get_read_marker(self, client_id, channel):
+        """Returns the creationTime of the last message of 'channel'
+        delivered to (or marked read by) the 'client_id' client identity,
+        'None' if unknown (or without message store).
+        """
+        if not self.gateway.store:
+            return None
+        marker = self.gateway.store.get_read_marker(
+            self.flow_username, client_id, channel.channel_id)
+        return marker[1] if marker else None
+
+    def set_read_markers(self, client_id, markers):
+        """Moves read markers of the 'client_id' client identity forward.
+        Arguments:
+        client_id : string, client identity.
+        markers : list of (channelId, messageId, creationTime) tuples.
+        """
+        if not self.gateway.store or not markers:
+            return
+        latest = {}  # channelId --> marker, only the latest is stored
+        for marker in markers:
+            if marker[0] not in latest or marker[2] > latest[marker[0]][2]:
+                latest[marker[0]] = marker
+        self.gateway.store.set_read_markers(
+            self.flow_username, client_id, latest.values())
+        self.gateway.stats.incr("store.read_markers_updated", len(latest))
+
+    def search(self, text, limit, offset=0):
+        """Searches the stored messages of the session channels
+        (Flow is not queried, the history is stored in the background,
+        see backfill_history).
+        Arguments:
+        text : string, search words (see store.build_search_query).
+        limit, offset : integers, page of results.
+        Returns a list of (Channel instance, message dict) tuples,
+        best matches first.
+        Raises sqlite3.OperationalError if the search is not valid.
+        """
+        query = store.build_search_query(text)
+        if not query:
+            return []
+        messages = self.gateway.store.search(
+            query, self.channels.keys(), limit, offset)
+        return [(self.channels[message["channelId"]], message)
+                for message in messages]
+
+    def snapshot(self):
+        """Returns the picklable state of the session model
+        (see handoff.HandoffServer).
+        """
+        return {
+            "organizations": self.organizations,
+            "channels": self.channels.values(),
+            "pending_channels": self.pending_channels,
+            "unsubscribed_channels": self.unsubscribed_channels,
+            "flow_account_id": self.flow_account_id,
+            "model_loaded": self.model_loaded,
+        }
+
+    def restore(self, snapshot):
+        """Restores the session model from snapshot() of another process
+        (instead of loading it from Flow).
+        """
+        self.organizations = snapshot["organizations"]
+        self.flow_account_id = snapshot["flow_account_id"]
+        self.channels = {}
+        self.__channels_by_irc_name = None
+        for channel in snapshot["channels"]:
+            channel.session = self
+            self.add_channel(channel)
+        self.pending_channels = snapshot["pending_channels"]
+        self.unsubscribed_channels = snapshot.get(
+            "unsubscribed_channels", set())
+        for channel_id in self.pending_channels:
+            self.gateway.timers.schedule(
+                PENDING_CHANNEL_TTL,
+                self.notification_handler.expire_pending_channel,
+                channel_id)
+        self.model_loaded = snapshot.get("model_loaded", True)
+
+    def reconcile_orgs(self):
+        """Background task that loads the organizations
+        missed by 'org' notifications.
+        """
+        try:
+            orgs = self.flow_service.enumerate_orgs()
+        except Flow.FlowError as flow_err:
+            LOG.debug("enumerate_orgs: '%s'", flow_err)
+            return
+        yield
+        new_orgs = [org for org in orgs
+                    if org["id"] not in self.organizations]
+        if new_orgs:
+            self.gateway.stats.incr("refresh.new_orgs", len(new_orgs))
+            self.notification_handler.org_notification(new_orgs)
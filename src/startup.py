@@ -0,0 +1,59 @@
+"""
+startup.py
+"""
+
+import logging
+import time
+
+
+LOG = logging.getLogger(__name__)
+# Process start time: this module is the first one imported by
+# flow_irc_gateway (the IMPORT phase starts here)
+STARTED = time.time()
+# Startup phases
+IMPORT = "import"
+CONFIG = "config"
+LISTEN = "listen"
+GLUE_SPAWN = "glue_spawn"
+START_UP = "start_up"
+FIRST_CLIENT = "first_client"
+
+
+class StartupTimer(object):
+    """Times the phases of the gateway startup, in seconds since the
+    process started. Phases may overlap: the Flow service is started in
+    the background while the IRC listeners are open.
+    The report is logged (and added to the gateway counters, as
+    'startup.<phase>_ms') once the first client is ready.
+    """
+
+    def __init__(self, started):
+        """Arguments:
+        started : float, time.time() when the process started.
+        """
+        self.started = started
+        self.phases = {}  # phase --> (start, end) offsets
+        self.reported = False
+
+    def record(self, phase, start, end):
+        """Records 'phase' from 'start' to 'end' (time.time() values).
+        Only the first run of a phase is recorded (e.g. the Flow service
+        of the first session).
+        """
+        if phase not in self.phases:
+            self.phases[phase] = (start - self.started, end - self.started)
+
+    def report(self, stats):
+        """Logs the startup phases (once) and adds their durations
+        to 'stats' (stats.Counters instance).
+        """
+        if self.reported:
+            return
+        self.reported = True
+        phases = sorted(self.phases.items(), key=lambda item: item[1][1])
+        for phase, (start, end) in phases:
+            stats.set_max("startup.%s_ms" % phase,
+                          int(round((end - start) * 1000)))
+        LOG.info("Startup timing: %s.", ", ".join(
+            "%s %.3fs (%.3f-%.3f)" % (phase, end - start, start, end)
+            for phase, (start, end) in phases))
@@ -0,0 +1,41 @@
+"""
+stats.py
+"""
+
+
+class Counters(object):
+    """Named gateway counters (monotonic counts and high-water marks)."""
+
+    def __init__(self):
+        self.__values = {}  # counter name --> integer
+        self.__high_water = set()  # names of the high-water mark counters
+
+    def incr(self, name, amount=1):
+        """Increments counter 'name' by 'amount'."""
+        self.__values[name] = self.__values.get(name, 0) + amount
+
+    def set_max(self, name, value):
+        """Sets counter 'name' to 'value' if it is higher than the current
+        value (used for high-water marks).
+        """
+        self.__high_water.add(name)
+        if value > self.__values.get(name, 0):
+            self.__values[name] = value
+
+    def get(self, name):
+        """Returns the value of counter 'name' (0 if never set)."""
+        return self.__values.get(name, 0)
+
+    def snapshot(self):
+        """Returns a sorted list of (name, value) tuples."""
+        return sorted(self.__values.items())
+
+    def merge(self, other):
+        """Adds the counters of 'other' Counters instance
+        (high-water marks keep the highest value).
+        """
+        for name, value in other.snapshot():
+            if name in other.__high_water:
+                self.set_max(name, value)
+            else:
+                self.incr(name, value)
@@ -0,0 +1,294 @@
+"""
+store.py
+"""
+
+import json
+import logging
+import sqlite3
+
+
+LOG = logging.getLogger(__name__)
+
+# Schema migrations, MIGRATIONS[N] upgrades the database from
+# version N to N + 1 (the version is kept in 'PRAGMA user_version').
+MIGRATIONS = [
+    [
+        "CREATE TABLE messages ("
+        "  id TEXT PRIMARY KEY,"
+        "  channel_id TEXT NOT NULL,"
+        "  sender_account_id TEXT NOT NULL,"
+        "  text TEXT NOT NULL,"
+        "  creation_time INTEGER NOT NULL)",
+        "CREATE INDEX messages_channel_time "
+        "ON messages (channel_id, creation_time)",
+    ],
+    # (the full-text index, created apart, see SEARCH_INDEX)
+    [],
+    [
+        # Last message delivered to (or marked read by) each client
+        # identity of an account, per channel
+        "CREATE TABLE read_markers ("
+        "  account TEXT NOT NULL,"
+        "  client TEXT NOT NULL,"
+        "  channel_id TEXT NOT NULL,"
+        "  message_id TEXT NOT NULL,"
+        "  creation_time INTEGER NOT NULL,"
+        "  PRIMARY KEY (account, client, channel_id))",
+    ],
+    [
+        # JSON list of the message attachments (NULL if none)
+        "ALTER TABLE messages ADD COLUMN attachments TEXT",
+    ],
+]
+# Full-text index of the messages (same rowid as 'messages'),
+# contentless: results are rendered from 'messages' and the model.
+# It is not a migration since SQLite may be built without FTS5
+# (only the search is disabled then).
+SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5("
+    "  text, sender, channel, content='')",
+    "INSERT INTO messages_fts (rowid, text, sender, channel) "
+    "SELECT rowid, text, '', '' FROM messages",
+]
+MESSAGE_COLUMNS = \
+    "id, channel_id, sender_account_id, text, creation_time, attachments"
+# Search filters --> messages_fts column
+SEARCH_FILTERS = {"from:": "sender", "in:": "channel"}
+
+
+def build_search_query(text):
+    """Returns the FTS5 query for a user search string.
+    Each word must match (as a literal, FTS5 operators are not
+    interpreted), words prefixed with 'from:' or 'in:' only match
+    the sender or the channel.
+    Returns an empty string if there is nothing to search.
+    """
+    terms = []
+    for word in text.split():
+        column = None
+        for prefix, filter_column in SEARCH_FILTERS.items():
+            if word.lower().startswith(prefix):
+                column = filter_column
+                word = word[len(prefix):]
+        if not word:
+            continue
+        term = '"%s"' % word.replace('"', '""')
+        terms.append("%s : %s" % (column, term) if column else term)
+    return " ".join(terms)
+
+
+def row_to_message(row):
+    """Returns a Flow-like message dict from a 'messages' row."""
+    message = {
+        "id": row[0],
+        "channelId": row[1],
+        "senderAccountId": row[2],
+        "text": row[3],
+        "creationTime": row[4],
+    }
+    if row[5]:
+        message["attachments"] = json.loads(row[5])
+    return message
+
+
+class MessageStore(object):
+    """Local SQLite (WAL mode) store of the Flow channel messages.
+    Messages are deduplicated by their id and indexed by
+    (channelId, creationTime), and by text if FTS5 is available
+    (see 'search_enabled').
+    """
+
+    def __init__(self, path):
+        """Arguments:
+        path : string, path of the SQLite database file.
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: commits do not fsync, the database stays consistent
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.__migrate()
+        self.search_enabled = self.__open_search_index()
+        # channelIds a search is restricted to (see search())
+        self.conn.execute(
+            "CREATE TEMP TABLE search_channels (channel_id TEXT PRIMARY KEY)")
+
+    def __migrate(self):
+        """Applies the pending schema migrations."""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for statements in MIGRATIONS[version:]:
+            with self.conn:
+                for statement in statements:
+                    self.conn.execute(statement)
+                version += 1
+                self.conn.execute("PRAGMA user_version=%d" % version)
+
+    def __open_search_index(self):
+        """Creates the full-text index (see SEARCH_INDEX) if it does not
+        exist yet.
+        Returns False if FTS5 is not available.
+        """
+        try:
+            if self.conn.execute(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE name = 'messages_fts'").fetchone():
+                self.conn.execute("SELECT rowid FROM messages_fts LIMIT 0")
+                return True
+            with self.conn:
+                for statement in SEARCH_INDEX:
+                    self.conn.execute(statement)
+        except sqlite3.OperationalError as fts_err:
+            LOG.warning("Message search disabled (FTS5 not available: %s).",
+                        fts_err)
+            return False
+        return True
+
+    def close(self):
+        """Closes the database."""
+        self.conn.close()
+
+    def add_messages(self, messages, channel_name="", sender_names=None):
+        """Stores (and indexes) Flow messages, already stored ones
+        are ignored.
+        Arguments:
+        messages : list of Flow message dicts (id, channelId,
+        senderAccountId, text, creationTime and optional attachments).
+        channel_name : string, IRC name of the channel (for the search).
+        sender_names : dict, accountId --> IRC nickname (for the search).
+        Returns the number of new messages.
+        """
+        sender_names = sender_names or {}
+        added = 0
+        with self.conn:
+            for message in messages:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO messages (%s) "
+                    "VALUES (?, ?, ?, ?, ?, ?)" % MESSAGE_COLUMNS,
+                    (message["id"],
+                     message["channelId"],
+                     message["senderAccountId"],
+                     message["text"],
+                     int(message["creationTime"]),
+                     json.dumps(message["attachments"])
+                     if message.get("attachments") else None))
+                if not cursor.rowcount:
+                    continue
+                added += 1
+                if not self.search_enabled:
+                    continue
+                self.conn.execute(
+                    "INSERT INTO messages_fts (rowid, text, sender, channel) "
+                    "VALUES (?, ?, ?, ?)",
+                    (cursor.lastrowid,
+                     message["text"],
+                     sender_names.get(message["senderAccountId"], ""),
+                     channel_name))
+        return added
+
+    def search(self, query, channel_ids, limit, offset=0):
+        """Returns the stored messages matching an FTS5 query
+        (see build_search_query), best matches first.
+        Arguments:
+        query : string, FTS5 query.
+        channel_ids : list of channelIds to search in.
+        limit, offset : integers, page of results.
+        Raises sqlite3.OperationalError if the query is not valid
+        (or the search is not enabled).
+        """
+        if not channel_ids:
+            return []
+        # (a table rather than one parameter per channel, there may be
+        # more channels than SQLite query parameters)
+        with self.conn:
+            self.conn.execute("DELETE FROM search_channels")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO search_channels VALUES (?)",
+                ((channel_id,) for channel_id in channel_ids))
+        rows = self.conn.execute(
+            "SELECT %s FROM messages_fts "
+            "JOIN messages ON messages.rowid = messages_fts.rowid "
+            "JOIN search_channels "
+            "ON search_channels.channel_id = messages.channel_id "
+            "WHERE messages_fts MATCH ? "
+            "ORDER BY messages_fts.rank LIMIT ? OFFSET ?" % ", ".join(
+                "messages." + column.strip()
+                for column in MESSAGE_COLUMNS.split(",")),
+            (query, limit, offset))
+        return [row_to_message(row) for row in rows]
+
+    def get_latest_message_times(self):
+        """Returns a dict channelId --> creationTime of the latest
+        stored message of each channel.
+        """
+        return dict(self.conn.execute(
+            "SELECT channel_id, MAX(creation_time) FROM messages "
+            "GROUP BY channel_id"))
+
+    def get_read_marker(self, account, client, channel_id):
+        """Returns the (message_id, creationTime) read marker of a client
+        for a channel, or 'None' if there is none.
+        """
+        return self.conn.execute(
+            "SELECT message_id, creation_time FROM read_markers "
+            "WHERE account = ? AND client = ? AND channel_id = ?",
+            (account, client, channel_id)).fetchone()
+
+    def set_read_markers(self, account, client, markers):
+        """Moves read markers of a client forward (markers older than
+        the stored ones are ignored).
+        Arguments:
+        account : string, Flow username.
+        client : string, client identity.
+        markers : list of (channelId, messageId, creationTime) tuples,
+        messageId may be empty.
+        """
+        with self.conn:
+            for (channel_id, message_id, creation_time) in markers:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO read_markers "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (account, client, channel_id, message_id,
+                     int(creation_time)))
+                self.conn.execute(
+                    "UPDATE read_markers SET message_id = ?, "
+                    "creation_time = ? WHERE account = ? AND client = ? "
+                    "AND channel_id = ? AND creation_time < ?",
+                    (message_id, int(creation_time), account, client,
+                     channel_id, int(creation_time)))
+
+    def get_message(self, message_id):
+        """Returns the stored message with the given id, or 'None'."""
+        row = self.conn.execute(
+            "SELECT %s FROM messages WHERE id = ?" % MESSAGE_COLUMNS,
+            (message_id,)).fetchone()
+        return row_to_message(row) if row else None
+
+    def get_messages(self, channel_id, limit, before=None, after=None,
+                     oldest_first=False):
+        """Returns stored messages of a channel, in chronological order.
+        Arguments:
+        channel_id : string, channelId.
+        limit : integer, maximum number of messages (0 for no limit).
+        before, after : integers, exclusive creationTime bounds (optional).
+        oldest_first : boolean, return the oldest 'limit' messages within
+        the bounds instead of the newest.
+        """
+        query = "SELECT %s FROM messages WHERE channel_id = ?" % \
+            MESSAGE_COLUMNS
+        params = [channel_id]
+        if before is not None:
+            query += " AND creation_time < ?"
+            params.append(before)
+        if after is not None:
+            query += " AND creation_time > ?"
+            params.append(after)
+        query += " ORDER BY creation_time %s" % (
+            "ASC" if oldest_first else "DESC")
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        messages = [row_to_message(row)
+                    for row in self.conn.execute(query, params)]
+        if not oldest_first:
+            messages.reverse()
+        return messages
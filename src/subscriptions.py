@@ -0,0 +1,89 @@
+"""
+subscriptions.py
+"""
+
+import fnmatch
+import re
+
+
+# Prefix of the regular expression patterns (the others are globs)
+REGEXP_PREFIX = "re:"
+
+
+def parse_patterns(value):
+    """Parses a list of name patterns separated by commas or newlines.
+    Patterns are case insensitive globs ('*', '?', '[...]') matching the
+    whole name, or regular expressions searched in the name when prefixed
+    with 're:'.
+    Returns a list of compiled regular expressions.
+    Raises ValueError if a regular expression is not valid.
+    """
+    regexps = []
+    for pattern in re.split(r"[,\n]", value):
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        if pattern.startswith(REGEXP_PREFIX):
+            regexp = pattern[len(REGEXP_PREFIX):]
+        else:
+            regexp = "^" + fnmatch.translate(pattern)
+        try:
+            regexps.append(re.compile(regexp, re.IGNORECASE | re.UNICODE))
+        except re.error as re_err:
+            raise ValueError("bad pattern %r: %s" % (pattern, re_err))
+    return regexps
+
+
+def matches(regexps, name):
+    """Returns True if 'name' matches one of 'regexps'."""
+    return any(regexp.search(name) for regexp in regexps)
+
+
+class Subscriptions(object):
+    """Include/exclude rules of the organizations and channels loaded
+    by the gateway. Channels not subscribed to are never loaded (no
+    members, history or notifications are processed for them).
+    """
+
+    def __init__(self, include_orgs="", exclude_orgs="",
+                 include_channels="", exclude_channels="",
+                 direct_only=False):
+        """Arguments:
+        include_orgs, exclude_orgs : strings, organization name patterns
+        (see parse_patterns), an empty include list includes all.
+        include_channels, exclude_channels : strings, channel name
+        patterns, they do not apply to direct conversations.
+        direct_only : boolean, only load direct conversations.
+        Raises ValueError if a pattern is not valid.
+        """
+        self.include_orgs = parse_patterns(include_orgs)
+        self.exclude_orgs = parse_patterns(exclude_orgs)
+        self.include_channels = parse_patterns(include_channels)
+        self.exclude_channels = parse_patterns(exclude_channels)
+        self.direct_only = direct_only
+
+    def wants_org(self, org_name):
+        """Returns True if the channels of organization 'org_name'
+        may be loaded.
+        """
+        if self.include_orgs and not matches(self.include_orgs, org_name):
+            return False
+        return not matches(self.exclude_orgs, org_name)
+
+    def wants_channel(self, org_name, channel_name, direct_channel):
+        """Returns True if a channel must be loaded.
+        Arguments:
+        org_name : string, name of the channel's organization.
+        channel_name : string, Flow channel name.
+        direct_channel : boolean, True for direct conversations.
+        """
+        if not self.wants_org(org_name):
+            return False
+        if direct_channel:
+            return True
+        if self.direct_only:
+            return False
+        if self.include_channels and \
+                not matches(self.include_channels, channel_name):
+            return False
+        return not matches(self.exclude_channels, channel_name)
@@ -0,0 +1,355 @@
+"""
+supervisor.py
+"""
+
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import time
+from multiprocessing import Pipe, reduction
+
+from . import diagnostics
+from . import logger
+from . import stats
+from . import timers
+
+
+LOG = logging.getLogger(__name__)
+STATS_INTERVAL = 10  # seconds between worker stats reports
+STABLE_UPTIME = 60  # worker uptime (seconds) that resets its restart backoff
+SHUTDOWN_TIMEOUT = 10  # seconds to wait for the workers on shutdown
+
+# Messages between the supervisor and the workers
+MSG_CLIENT = "client"  # (MSG_CLIENT, account_name, state) + socket handle
+MSG_STATS = "stats"  # (MSG_STATS, stats.Counters instance)
+
+
+def worker_for_account(account_name, account_names, workers):
+    """Returns the index of the worker that owns an account.
+    Accounts are spread over the workers by their position in the
+    sorted list of account names, so every process agrees on it.
+    """
+    return sorted(account_names).index(account_name) % workers
+
+
+class WorkerLink(object):
+    """Worker side of the connection with the supervisor."""
+
+    def __init__(self, conn, index, workers, account_names):
+        """Arguments:
+        conn : multiprocessing Connection with the supervisor.
+        index : integer, index of this worker.
+        workers : integer, number of workers.
+        account_names : list of all the account names.
+        """
+        self.conn = conn
+        self.index = index
+        self.workers = workers
+        self.account_names = account_names
+
+    def fileno(self):
+        """Returns the connection file descriptor (for select())."""
+        return self.conn.fileno()
+
+    def owns(self, account_name):
+        """Returns True if this worker hosts 'account_name'."""
+        return worker_for_account(
+            account_name, self.account_names, self.workers) == self.index
+
+    def send_client(self, account_name, state, client_socket):
+        """Hands an IRC client connection over to the supervisor,
+        to be routed to the worker that owns 'account_name'.
+        Arguments:
+        account_name : string, account the client authenticated as.
+        state : dict, client state (see IRCClient.detach).
+        client_socket : socket instance (the caller closes it afterwards).
+        """
+        self.conn.send((MSG_CLIENT, account_name, state))
+        reduction.send_handle(self.conn, client_socket.fileno(), os.getppid())
+
+    def send_stats(self, counters):
+        """Reports the worker counters to the supervisor."""
+        self.conn.send((MSG_STATS, counters))
+
+    def receive_client(self):
+        """Receives an IRC client connection routed by the supervisor.
+        Returns a (state, socket instance) tuple.
+        """
+        _, _, state = self.conn.recv()
+        handle = reduction.recv_handle(self.conn)
+        client_socket = socket.fromfd(
+            handle, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(handle)
+        return state, client_socket
+
+
+class Worker(object):
+    """A worker process, as seen by the supervisor."""
+
+    def __init__(self, index):
+        self.index = index
+        self.pid = 0  # 0 while the worker is not running
+        self.conn = None  # multiprocessing Connection with the worker
+        self.started = 0
+        self.restart_at = 0
+        self.backoff = timers.Backoff(maximum=STABLE_UPTIME)
+        self.stats = stats.Counters()  # last counters reported
+
+
+class Supervisor(object):
+    """Runs the gateway in several worker processes.
+    The supervisor binds nothing itself, the workers inherit the IRC
+    listening sockets and accept connections on them. Each account
+    is hosted by one worker (see worker_for_account), a worker that
+    authenticates a client for an account it does not host hands the
+    connection over (through the supervisor, with the socket passed as
+    SCM_RIGHTS ancillary data) to the worker that does.
+    The supervisor restarts the workers that exit (with backoff) and
+    collects their counters: SIGUSR2 writes a report with the counters
+    of each worker and their totals (SIGUSR1 and SIGUSR2 are forwarded
+    to the workers for their own diagnostics, SIGHUP for their
+    configuration reload).
+    """
+
+    def __init__(self, options, listeners, run_worker, reload_options=None):
+        """Arguments:
+        options : container object with the gateway options.
+        listeners : list of bound IRC listening sockets.
+        run_worker : function, runs the gateway in a worker process,
+        called with (options, listeners, WorkerLink instance).
+        reload_options : function returning the options read again
+        from the config on SIGHUP ('None' if not valid).
+        """
+        self.options = options
+        self.listeners = listeners
+        self.run_worker = run_worker
+        self.reload_options = reload_options
+        self.account_names = [account.name for account in options.accounts]
+        self.workers = [Worker(index) for index in range(options.workers)]
+        self.stats = stats.Counters()
+        self.__terminating = False
+        self.__report_requested = False
+        self.__reload_requested = False
+
+    def install_signal_handlers(self):
+        """Installs the supervisor signal handlers."""
+        signal.signal(signal.SIGINT, self.__terminate_handler)
+        signal.signal(signal.SIGTERM, self.__terminate_handler)
+        signal.signal(signal.SIGUSR1, self.__forward_handler)
+        signal.signal(signal.SIGUSR2, self.__forward_handler)
+        signal.signal(signal.SIGHUP, self.__forward_handler)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        signal.siginterrupt(signal.SIGUSR2, False)
+        signal.siginterrupt(signal.SIGHUP, False)
+
+    def __terminate_handler(self, sig, frame):
+        """Requests the shutdown of the supervisor and its workers."""
+        self.__terminating = True
+
+    def __forward_handler(self, sig, frame):
+        """Forwards diagnostics and reload signals to the workers."""
+        if sig == signal.SIGUSR2:
+            self.__report_requested = True
+        elif sig == signal.SIGHUP:
+            self.__reload_requested = True
+        for worker in self.workers:
+            if worker.pid:
+                os.kill(worker.pid, sig)
+
+    def start(self):
+        """Starts the workers and supervises them until terminated."""
+        self.install_signal_handlers()
+        for worker in self.workers:
+            self.spawn(worker)
+        while not self.__terminating:
+            self.reap()
+            self.restart_workers()
+            if self.__report_requested:
+                self.__report_requested = False
+                self.write_report()
+            if self.__reload_requested:
+                self.__reload_requested = False
+                self.reload()
+            conns = [worker.conn for worker in self.workers if worker.conn]
+            try:
+                (readable, _, _) = select.select(conns, [], [], 1.0)
+            except select.error as select_err:
+                if select_err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for worker in self.workers:
+                if worker.conn and worker.conn in readable:
+                    self.handle_message(worker)
+        self.shutdown()
+
+    def spawn(self, worker):
+        """Forks the process of 'worker'."""
+        parent_conn, child_conn = Pipe()
+        # The log listener thread does not survive fork(), it is stopped
+        # (and its records flushed) and started again on both sides.
+        logger.stop_logging()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            for other in self.workers:
+                if other.conn:
+                    other.conn.close()
+            for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1,
+                        signal.SIGUSR2, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+            logger.setup_logging(self.options)
+            status = 0
+            try:
+                self.run_worker(
+                    self.options,
+                    self.listeners,
+                    WorkerLink(child_conn, worker.index, len(self.workers),
+                               self.account_names))
+            except SystemExit as exit_err:
+                status = exit_err.code if \
+                    isinstance(exit_err.code, int) else 1
+            except Exception:
+                LOG.exception("Worker %d failed", worker.index)
+                status = 1
+            logger.stop_logging()
+            os._exit(status)
+        logger.setup_logging(self.options)
+        child_conn.close()
+        worker.pid = pid
+        worker.conn = parent_conn
+        worker.started = time.time()
+        LOG.info("Started worker %d (pid %d).", worker.index, pid)
+
+    def reload(self):
+        """Reads the config again for the workers started from now on
+        (the running workers reload it on their own SIGHUP). The workers,
+        accounts and IRC ports are kept.
+        """
+        if not self.reload_options:
+            return
+        options = self.reload_options(sys.argv)
+        if not options:
+            LOG.error("Configuration not reloaded (bad config).")
+            return
+        options.workers = self.options.workers
+        options.accounts = self.options.accounts
+        options.startup = self.options.startup
+        options.irc_ports = self.options.irc_ports
+        self.options = options
+        logger.setup_logging(options)
+        LOG.info("Configuration reloaded.")
+
+    def reap(self):
+        """Collects the exited workers and schedules their restart."""
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as os_err:
+                if os_err.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            for worker in self.workers:
+                if worker.pid == pid:
+                    break
+            else:
+                continue
+            worker.pid = 0
+            if worker.conn:
+                worker.conn.close()
+                worker.conn = None
+            if self.__terminating:
+                continue
+            self.stats.incr("workers.exits")
+            if time.time() - worker.started >= STABLE_UPTIME:
+                worker.backoff.attempts = 0
+            delay = worker.backoff.next_delay()
+            worker.restart_at = time.time() + delay
+            LOG.error("Worker %d (pid %d) exited with status %d, "
+                      "restarting in %.1f seconds.",
+                      worker.index, pid, status, delay)
+
+    def restart_workers(self):
+        """Restarts the exited workers whose backoff delay elapsed."""
+        now = time.time()
+        for worker in self.workers:
+            if not worker.pid and worker.restart_at <= now:
+                self.stats.incr("workers.restarts")
+                self.spawn(worker)
+
+    def handle_message(self, worker):
+        """Handles a message from 'worker'."""
+        try:
+            message = worker.conn.recv()
+        except (EOFError, IOError):
+            # The worker exited, it is collected by reap()
+            worker.conn.close()
+            worker.conn = None
+            return
+        if message[0] == MSG_STATS:
+            worker.stats = message[1]
+        elif message[0] == MSG_CLIENT:
+            self.route_client(worker, message[1], message[2])
+
+    def route_client(self, worker, account_name, state):
+        """Passes a client connection handed over by 'worker'
+        to the worker that owns 'account_name'.
+        """
+        handle = reduction.recv_handle(worker.conn)
+        try:
+            owner = self.workers[worker_for_account(
+                account_name, self.account_names, len(self.workers))]
+            if not owner.conn:
+                LOG.warning("Worker %d is down, dropping client "
+                            "of account '%s'.", owner.index, account_name)
+                self.stats.incr("workers.dropped_clients")
+                return
+            owner.conn.send((MSG_CLIENT, account_name, state))
+            reduction.send_handle(owner.conn, handle, owner.pid)
+            self.stats.incr("workers.routed_clients")
+        finally:
+            os.close(handle)
+
+    def write_report(self):
+        """Writes the counters of the supervisor and its workers."""
+        path = diagnostics.report_path(
+            self.options.diagnostics_dir, "workers.txt")
+        totals = stats.Counters()
+        try:
+            with open(path, "w") as report:
+                report.write("== Supervisor ==\n")
+                for name, value in self.stats.snapshot():
+                    report.write("%s: %d\n" % (name, value))
+                for worker in self.workers:
+                    report.write("\n== Worker %d (pid %d) ==\n" %
+                                 (worker.index, worker.pid))
+                    for name, value in worker.stats.snapshot():
+                        report.write("%s: %d\n" % (name, value))
+                    totals.merge(worker.stats)
+                report.write("\n== All workers ==\n")
+                for name, value in totals.snapshot():
+                    report.write("%s: %d\n" % (name, value))
+            LOG.warning("Workers report written to '%s'.", path)
+        except (IOError, OSError) as io_err:
+            LOG.error("Could not write workers report: %s", io_err)
+
+    def shutdown(self):
+        """Terminates the workers and waits for them."""
+        LOG.info("Terminating workers.")
+        for worker in self.workers:
+            if worker.pid:
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        while any(worker.pid for worker in self.workers):
+            self.reap()
+            if time.time() > deadline:
+                for worker in self.workers:
+                    if worker.pid:
+                        os.kill(worker.pid, signal.SIGKILL)
+                deadline = float("inf")
+            time.sleep(0.1)
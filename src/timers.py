@@ -0,0 +1,152 @@
+"""
+timers.py
+"""
+
+import logging
+import random
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TICK = 0.1  # seconds
+DEFAULT_SLOTS = 512
+
+
+class Timer(object):
+    """A timer scheduled on a TimerWheel."""
+    __slots__ = ("callback", "args", "deadline", "rounds", "slot")
+
+    def __init__(self, callback, args, deadline):
+        self.callback = callback
+        self.args = args
+        self.deadline = deadline
+        self.rounds = 0
+        self.slot = None  # set of the wheel holding the timer
+
+    def active(self):
+        """Returns True if the timer is still scheduled."""
+        return self.slot is not None
+
+
+class TimerWheel(object):
+    """Hashed timer wheel driven by the gateway main loop.
+    schedule() and cancel() are O(1), advance() only visits the
+    slots of the elapsed ticks.
+    Timers fire with a resolution of 'tick' seconds.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        """Arguments:
+        tick : float, seconds per slot.
+        slots : integer, number of slots of the wheel.
+        """
+        self.tick = tick
+        self.__slots = [set() for _ in range(slots)]
+        self.__current_tick = int(time.time() / tick)
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def schedule(self, delay, callback, *args):
+        """Schedules 'callback(*args)' to run in 'delay' seconds.
+        Returns a Timer instance (to be used with cancel()).
+        """
+        deadline = time.time() + delay
+        timer = Timer(callback, args, deadline)
+        self.__insert(timer)
+        return timer
+
+    def __insert(self, timer):
+        """Inserts 'timer' in the slot of its deadline."""
+        ticks = max(1, int(timer.deadline / self.tick) - self.__current_tick)
+        timer.rounds = (ticks - 1) // len(self.__slots)
+        timer.slot = self.__slots[(self.__current_tick + ticks) %
+                                  len(self.__slots)]
+        timer.slot.add(timer)
+        self.__count += 1
+
+    def cancel(self, timer):
+        """Cancels 'timer' (does nothing if it already fired)."""
+        if timer and timer.slot is not None:
+            self.__remove(timer)
+
+    def advance(self, now=None):
+        """Fires the timers that expired up to 'now'.
+        Returns the number of timers fired.
+        """
+        now = now or time.time()
+        now_tick = int(now / self.tick)
+        if now_tick - self.__current_tick >= len(self.__slots):
+            # The loop stalled for more than a turn of the wheel
+            expired = self.__rehash(now, now_tick)
+        else:
+            expired = []
+            for tick in range(self.__current_tick + 1, now_tick + 1):
+                slot = self.__slots[tick % len(self.__slots)]
+                for timer in list(slot):
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                    else:
+                        self.__remove(timer)
+                        expired.append(timer)
+        self.__current_tick = max(self.__current_tick, now_tick)
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                LOG.exception("Timer callback %r failed", timer.callback)
+        return len(expired)
+
+    def __remove(self, timer):
+        """Removes 'timer' from its slot."""
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.__count -= 1
+
+    def __rehash(self, now, now_tick):
+        """Returns the expired timers and re-inserts the others.
+        O(timers), only used after a long stall.
+        """
+        timers = [timer for slot in self.__slots for timer in slot]
+        for timer in timers:
+            self.__remove(timer)
+        self.__current_tick = now_tick
+        expired = []
+        for timer in sorted(timers, key=lambda timer: timer.deadline):
+            if timer.deadline <= now:
+                expired.append(timer)
+            else:
+                self.__insert(timer)
+        return expired
+
+
+class Backoff(object):
+    """Exponential backoff with jitter."""
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0,
+                 max_attempts=0):
+        """Arguments:
+        initial : float, first delay in seconds.
+        maximum : float, maximum delay in seconds.
+        factor : float, multiplier applied after each attempt.
+        max_attempts : integer, attempts before giving up (0 for no limit).
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.max_attempts = max_attempts
+        self.attempts = 0
+
+    def next_delay(self):
+        """Returns the delay before the next attempt,
+        or 'None' if there are no attempts left.
+        """
+        if self.max_attempts and self.attempts >= self.max_attempts:
+            return None
+        delay = min(self.maximum,
+                    self.initial * (self.factor ** self.attempts))
+        self.attempts += 1
+        # Jitter, so retries of many calls do not fire together
+        return delay * random.uniform(0.5, 1.0)
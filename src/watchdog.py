@@ -0,0 +1,149 @@
+"""
+watchdog.py
+"""
+
+import logging
+import re
+import sys
+import thread
+import threading
+import time
+import traceback
+
+
+LOG = logging.getLogger(__name__)
+DEFAULT_STALL_THRESHOLD = 5  # seconds
+# Strings shown as they are in the stall reports (ids), the other
+# arguments are redacted
+SAFE_STRING_REGEXP = re.compile(r"^[A-Za-z0-9_-]{0,64}$")
+
+
+def redact(value):
+    """Returns a printable form of a Flow call argument that does not
+    disclose message texts, usernames, passwords, etc.
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return repr(value)
+    if isinstance(value, basestring):
+        if SAFE_STRING_REGEXP.match(value):
+            return repr(value)
+        return "<string, %d chars>" % len(value)
+    if isinstance(value, (list, tuple, set, dict)):
+        return "<%s, %d items>" % (type(value).__name__, len(value))
+    return "<%s>" % type(value).__name__
+
+
+def format_call(call):
+    """Returns 'method(arguments)' for a (method, args, kwargs) call,
+    with the arguments redacted.
+    """
+    (method, args, kwargs) = call
+    arguments = [redact(arg) for arg in args] + \
+        ["%s=%s" % (name, redact(value))
+         for name, value in sorted(kwargs.items())]
+    return "%s(%s)" % (method, ", ".join(arguments))
+
+
+class StallWatchdog(object):
+    """Watches the main loop from a background thread: the main loop
+    calls heartbeat() on each iteration, and an iteration that takes
+    longer than 'threshold' seconds is reported once (main thread stack
+    and Flow calls in progress) to the log and to the 'watchdog.stalls'
+    counter.
+    """
+
+    def __init__(self, stats, threshold=DEFAULT_STALL_THRESHOLD):
+        """Arguments:
+        stats : stats.Counters instance.
+        threshold : float, seconds per loop iteration (0 disables the
+        watchdog).
+        Must be created on the main thread.
+        """
+        self.stats = stats
+        self.threshold = threshold
+        self.main_thread_id = thread.get_ident()
+        # Flow calls in progress on the main thread, outermost first
+        # (see TracedFlow)
+        self.calls = []
+        self.__beat = time.time()
+        self.__stalled = False  # the current iteration was reported
+        self.__thread = None
+
+    def start(self):
+        """Starts the watchdog thread."""
+        self.__beat = time.time()
+        self.__thread = threading.Thread(target=self.__run, name="watchdog")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def heartbeat(self):
+        """Called by the main loop on each iteration."""
+        now = time.time()
+        if self.__stalled:
+            self.__stalled = False
+            self.stats.set_max("watchdog.longest_stall_ms",
+                               int((now - self.__beat) * 1000))
+            LOG.warning("Main loop stall over after %.1f seconds.",
+                        now - self.__beat)
+        self.__beat = now
+
+    def __run(self):
+        """Thread function, checks the heartbeats."""
+        while True:
+            time.sleep(max(self.threshold, 1) / 4.0)
+            if not self.threshold or self.__stalled:
+                continue
+            beat = self.__beat
+            if time.time() - beat > self.threshold:
+                self.__stalled = True
+                self.stats.incr("watchdog.stalls")
+                LOG.warning("%s", self.stall_report(beat))
+
+    def stall_report(self, beat):
+        """Returns the report of a main loop stall that started
+        at 'beat' (a time.time() value).
+        """
+        calls = list(self.calls)
+        lines = ["Main loop stalled for %.1f seconds." % (time.time() - beat)]
+        if calls:
+            lines.append("Flow calls in progress: %s." % " > ".join(
+                format_call(call) for call in calls))
+        else:
+            lines.append("No Flow call in progress.")
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame:
+            lines.append("Main thread stack (most recent call last):")
+            lines.extend(line.rstrip("\n")
+                         for line in traceback.format_stack(frame))
+        return "\n".join(lines)
+
+
+class TracedFlow(object):
+    """Proxy of a Flow instance that records the calls made from the
+    main thread in StallWatchdog.calls while they are in progress.
+    """
+
+    def __init__(self, flow_service, watchdog):
+        """Arguments:
+        flow_service : Flow instance.
+        watchdog : StallWatchdog instance.
+        """
+        self.__flow_service = flow_service
+        self.__watchdog = watchdog
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__flow_service, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        watchdog = self.__watchdog
+
+        def traced(*args, **kwargs):
+            """Calls the Flow method, recorded on the main thread."""
+            if thread.get_ident() != watchdog.main_thread_id:
+                return attribute(*args, **kwargs)
+            watchdog.calls.append((name, args, kwargs))
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                watchdog.calls.pop()
+        return traced
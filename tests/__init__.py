@@ -0,0 +1,9 @@
+"""
+__init__.py
+flow-irc-gateway tests (python -m unittest discover -s tests -t .)
+"""
+
+import logging
+
+# (the tests do not configure the logging)
+logging.getLogger("src").addHandler(logging.NullHandler())
@@ -0,0 +1,166 @@
+"""
+test_attachments.py
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from src import attachments
+from src import stats
+from src import timers
+
+
+class FakeAccount(object):
+
+    def __init__(self, attachment_dir):
+        self.name = ""
+        self.attachment_dir = attachment_dir
+
+
+class FakeFlow(object):
+    """Flow service whose downloads are written by the test."""
+
+    def __init__(self):
+        self.downloads = []  # attachment ids
+
+    def start_attachment_download(self, attachment, *_):
+        self.downloads.append(attachment["id"])
+
+
+class FakeSession(object):
+
+    flow_initialized = True
+
+    def __init__(self, attachment_dir):
+        self.account = FakeAccount(attachment_dir)
+        self.flow_service = FakeFlow()
+
+
+class FakeChannel(object):
+    organization_id = "o1"
+    channel_id = "c1"
+
+
+class FakeGateway(object):
+    """The FlowIRCGateway attributes used by the attachment server,
+    Flow calls succeed at once.
+    """
+
+    def __init__(self, session):
+        self.stats = stats.Counters()
+        self.timers = timers.TimerWheel()
+        self.accounts = {}
+        self.sessions = {"": session}
+
+    @staticmethod
+    def call_flow_with_retry(_, func, on_success, **__):
+        on_success(func())
+
+
+class AttachmentServerTest(unittest.TestCase):
+    """Tests of attachments.AttachmentServer."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = FakeSession(self.directory)
+        self.gateway = FakeGateway(self.session)
+        self.server = attachments.AttachmentServer(self.gateway, 0, 2 ** 20)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def request(self, attachment):
+        """Sends a request for 'attachment' and lets the server read it.
+        Returns the client socket.
+        """
+        url = self.server.link(self.session, FakeChannel(), attachment)
+        client = socket.create_connection(
+            ("localhost", self.server.listener.getsockname()[1]))
+        self.clients.append(client)
+        self.server.socket_readable(self.server.listener)
+        client.sendall(b"GET /%s HTTP/1.1\r\n\r\n" % url.split("/", 3)[3])
+        for sock in self.server.readable_sockets():
+            if sock is not self.server.listener:
+                self.server.socket_readable(sock)
+        return client
+
+    def response(self, client):
+        """Sends the responses and returns the body read by 'client'."""
+        while self.server.writable_sockets():
+            for sock in self.server.writable_sockets():
+                self.server.socket_writable(sock)
+        client.settimeout(1)
+        data = b""
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return data.split(b"\r\n\r\n", 1)[1]
+            data += chunk
+
+    def write_download(self, attachment_id, data):
+        with open(os.path.join(self.directory, attachment_id), "ab") as out:
+            out.write(data)
+
+    def test_known_size(self):
+        """A download is served once it has the attachment size."""
+        attachment = {"id": "a1", "name": "a.txt", "size": 6}
+        self.write_download("a1", b"abc")
+        client = self.request(attachment)
+        self.assertEqual(self.server.writable_sockets(), [])
+        self.write_download("a1", b"def")
+        self.gateway.timers.advance(time.time() + 1)
+        self.assertEqual(self.response(client), b"abcdef")
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.directory, "a1" + attachments.COMPLETE_SUFFIX)))
+
+    def test_unknown_size(self):
+        """A download of unknown size is served once it stops growing."""
+        attachment = {"id": "a2", "name": "a.txt"}
+        self.write_download("a2", b"")
+        client = self.request(attachment)
+        self.write_download("a2", b"abc")
+        self.gateway.timers.advance(
+            time.time() + attachments.DOWNLOAD_SETTLE_TIME + 1)
+        self.assertEqual(self.server.writable_sockets(), [])
+        self.gateway.timers.advance(
+            time.time() + 2 * attachments.DOWNLOAD_SETTLE_TIME + 2)
+        self.assertEqual(self.response(client), b"abc")
+
+    def test_complete_file(self):
+        """A complete file is served without downloading it again."""
+        with open(os.path.join(
+                self.directory, "a3" + attachments.COMPLETE_SUFFIX),
+                "wb") as out:
+            out.write(b"abc")
+        client = self.request({"id": "a3", "name": "a.txt", "size": 3})
+        self.assertEqual(self.response(client), b"abc")
+        self.assertEqual(self.session.flow_service.downloads, [])
+
+    def test_previous_downloads(self):
+        """The complete downloads of a previous process count in the
+        cache size limit, the least recently used are removed.
+        """
+        for (age, name) in enumerate(("new", "old", "older")):
+            path = os.path.join(self.directory,
+                                name + attachments.COMPLETE_SUFFIX)
+            with open(path, "wb") as out:
+                out.write(b"x" * 10)
+            os.utime(path, (time.time() - age, time.time() - age))
+        self.write_download("partial", b"x" * 10)
+        server = attachments.AttachmentServer(self.gateway, 0, 15)
+        server.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            "new" + attachments.COMPLETE_SUFFIX, "partial"])
+        self.assertEqual(self.gateway.stats.get("attachments.evicted"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
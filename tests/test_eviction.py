@@ -0,0 +1,130 @@
+"""
+test_eviction.py
+"""
+
+import unittest
+
+from src import eviction
+from src import stats
+from src import timers
+from src.channel import Channel, ChannelMember, MembersNotLoaded
+
+
+class FakeSession(object):
+    """The FlowSession attributes used by Channel and ChannelEvictor."""
+
+    def __init__(self):
+        self.channels = {}
+        self.reply_cache_size = 0
+        self.rehydrated = []
+
+    def directory_changed(self):
+        pass
+
+    def drop_reply_cache(self):
+        (size, self.reply_cache_size) = (self.reply_cache_size, 0)
+        return size
+
+    def rehydrate_channel(self, channel):
+        self.rehydrated.append(channel)
+        raise MembersNotLoaded("Flow is down")
+
+    def add_channel(self, channel_id, members, last_used):
+        channel = Channel(self, channel_id, channel_id)
+        for index in range(members):
+            channel.add_member(ChannelMember(
+                "user%d" % index, "%s-%d" % (channel_id, index), "org"))
+        channel.last_used = last_used
+        self.channels[channel_id] = channel
+        return channel
+
+
+class FakeGateway(object):
+    """The FlowIRCGateway attributes used by ChannelEvictor."""
+
+    def __init__(self):
+        self.stats = stats.Counters()
+        self.timers = timers.TimerWheel()
+        self.sessions = {}
+
+
+class ChannelEvictorTest(unittest.TestCase):
+    """Tests of eviction.ChannelEvictor."""
+
+    def setUp(self):
+        self.rss = 2 ** 30
+        self.current_rss = eviction.current_rss
+        eviction.current_rss = lambda: self.rss
+        self.gateway = FakeGateway()
+        self.session = FakeSession()
+        self.gateway.sessions["account"] = self.session
+        self.evictor = eviction.ChannelEvictor(
+            self.gateway, 2 ** 20, idle_time=0)
+
+    def tearDown(self):
+        eviction.current_rss = self.current_rss
+
+    def evicted_ids(self):
+        return sorted(channel_id
+                      for channel_id, channel in self.session.channels.items()
+                      if channel.evicted)
+
+    def test_under_budget(self):
+        """Nothing is evicted under the budget."""
+        self.session.add_channel("a", 10, 1)
+        self.rss = 2 ** 19
+        self.evictor.run()
+        self.assertEqual(self.evicted_ids(), [])
+
+    def test_evicts_least_recently_used_batch(self):
+        """A quarter of the loaded members are evicted, least recently
+        used channels first, with the cached replies.
+        """
+        self.session.add_channel("old", 10, 1)
+        self.session.add_channel("older", 10, 0)
+        self.session.add_channel("new", 20, 2)
+        self.session.reply_cache_size = 100
+        self.evictor.run()
+        self.assertEqual(self.evicted_ids(), ["older"])
+        self.assertEqual(self.session.channels["older"].member_count(), 10)
+        self.assertEqual(
+            self.gateway.stats.get("eviction.reply_cache_bytes"), 100)
+
+    def test_rss_not_going_down(self):
+        """The next checks only evict the members loaded again,
+        whatever the RSS is.
+        """
+        self.session.add_channel("a", 10, 0)
+        self.session.add_channel("b", 10, 1)
+        self.session.add_channel("c", 10, 2)
+        self.session.add_channel("d", 10, 3)
+        self.evictor.run()
+        self.assertEqual(self.evicted_ids(), ["a"])
+        self.evictor.run()
+        self.evictor.run()
+        self.assertEqual(self.evicted_ids(), ["a"])
+        self.session.add_channel("e", 10, 4)
+        self.evictor.run()
+        self.assertEqual(self.evicted_ids(), ["a", "b"])
+        self.assertEqual(
+            self.gateway.stats.get("eviction.channels_evicted"), 2)
+        self.assertEqual(self.gateway.stats.get("eviction.over_budget"), 1)
+
+
+class EvictedChannelTest(unittest.TestCase):
+    """Tests of the members of evicted channels."""
+
+    def test_reload_failure(self):
+        """Members that cannot be reloaded raise MembersNotLoaded."""
+        session = FakeSession()
+        channel = session.add_channel("a", 3, 0)
+        channel.evict()
+        self.assertEqual(channel.loaded_members(), set())
+        self.assertEqual(channel.member_count(), 3)
+        self.assertRaises(MembersNotLoaded,
+                          channel.get_member_from_account_id, "a-0")
+        self.assertEqual(session.rehydrated, [channel])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+test_irc_client.py
+"""
+
+import unittest
+
+from src import irc_client
+from src import ratelimit
+from src import sendq
+from src import stats
+from src import timers
+from src.channel import Channel, HistoryNotLoaded
+from src.irc_client import IRCClient
+
+
+class FakeSocket(object):
+    """Client socket that records what is sent."""
+
+    def __init__(self):
+        self.closed = False
+
+    def getpeername(self):
+        return ("127.0.0.1", 4242)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeGateway(object):
+    """The FlowIRCGateway attributes used by IRCClient."""
+
+    def __init__(self, sendq_limit=1024):
+        self.name = "localhost"
+        self.stats = stats.Counters()
+        self.timers = timers.TimerWheel()
+        self.sendq_limit = sendq_limit
+        self.sendq_policy = sendq.POLICY_PAUSE_REPLAY
+        self.rate_limits = dict(
+            (name, ratelimit.parse_limit(limit))
+            for name, limit in ratelimit.DEFAULT_LIMITS.items())
+        self.paste_window = 0
+        self.history_replay_limit = 0
+        self.removed_clients = []
+
+    def remove_client(self, client):
+        self.removed_clients.append(client)
+
+
+class FakeSession(object):
+    """FlowSession whose Flow history cannot be loaded."""
+
+    def __init__(self):
+        self.channel = Channel(self, "c1", "chan", "o1", "O")
+        self.history_calls = []  # get_history() limits
+
+    def get_channel_from_irc_name(self, irc_name):
+        return self.channel if irc_name == self.channel.get_irc_name() \
+            else None
+
+    def get_read_marker(self, *_):
+        return None
+
+    def get_message(self, channel, _):
+        raise HistoryNotLoaded(channel.channel_id)
+
+    def get_history(self, channel, limit, *_, **__):
+        self.history_calls.append(limit)
+        raise HistoryNotLoaded(channel.channel_id)
+
+
+def registered_client(gateway):
+    """Returns an IRCClient attached to a FakeSession."""
+    client = IRCClient(gateway, FakeSocket())
+    client.session = FakeSession()
+    client.nickname = client.client_id = "nick"
+    return client
+
+
+class HistoryTest(unittest.TestCase):
+    """Tests of the history requests when Flow fails."""
+
+    def setUp(self):
+        self.client = registered_client(FakeGateway())
+        self.irc_name = self.client.session.channel.get_irc_name()
+
+    def sent(self):
+        """Returns the lines queued for the client."""
+        return self.client._IRCClient__sendq.peek().splitlines()
+
+    def test_chathistory_fail(self):
+        """CHATHISTORY is answered with FAIL ... MESSAGE_ERROR."""
+        self.client._IRCClient__chathistory(
+            ["LATEST", self.irc_name, "*", "10"])
+        self.client._IRCClient__chathistory(
+            ["BEFORE", self.irc_name, "msgid=m1", "10"])
+        self.assertEqual(self.sent(), [
+            ":localhost FAIL CHATHISTORY MESSAGE_ERROR LATEST %s "
+            ":Could not load the channel history" % self.irc_name,
+            ":localhost FAIL CHATHISTORY MESSAGE_ERROR BEFORE %s "
+            ":Could not load the channel history" % self.irc_name])
+
+    def test_chathistory_limit(self):
+        """Limits under 1 are rejected, others capped."""
+        for limit in ("0", "-1"):
+            self.client._IRCClient__chathistory(
+                ["LATEST", self.irc_name, "*", limit])
+        self.client._IRCClient__chathistory(
+            ["LATEST", self.irc_name, "*", "100000"])
+        self.assertEqual(self.sent()[:2], [
+            ":localhost FAIL CHATHISTORY INVALID_PARAMS LATEST %s "
+            ":Invalid message reference or limit" % self.irc_name] * 2)
+        self.assertEqual(self.client.session.history_calls,
+                         [irc_client.CHATHISTORY_LIMIT])
+
+    def test_replay_stopped(self):
+        """The replay ends without reaching the gateway loop."""
+        self.client.send_channel_messages(self.client.session.channel)
+        self.assertEqual(self.sent(), [])
+        self.assertFalse(self.client._IRCClient__sendq.has_pending_replay())
+
+
+class DisconnectTest(unittest.TestCase):
+    """Tests of IRCClient.disconnect()."""
+
+    def test_disconnect(self):
+        """The client is removed and its socket closed once."""
+        gateway = FakeGateway()
+        client = IRCClient(gateway, FakeSocket())
+        client.disconnect("bye")
+        client.disconnect("again")
+        self.assertTrue(client.client_socket.closed)
+        self.assertEqual(gateway.removed_clients, [client])
+        self.assertEqual(client.write_queue_size(), len(b"ERROR :bye\r\n"))
+
+    def test_disconnect_over_hard_limit(self):
+        """A client whose send queue cannot take the ERROR line is
+        disconnected (without the line) instead of recursing.
+        """
+        gateway = FakeGateway(sendq_limit=10)
+        client = IRCClient(gateway, FakeSocket())
+        client.message("x" * 36, sendq.CONTROL)  # 38 bytes, hard limit 40
+        client.message("PING :over the hard limit", sendq.CONTROL)
+        self.assertTrue(client.client_socket.closed)
+        self.assertEqual(gateway.removed_clients, [client])
+        self.assertEqual(client.write_queue_size(), 38)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""
+test_notification.py
+"""
+
+import unittest
+
+from src import notification
+from src import stats
+from src import subscriptions
+from src import timers
+from src.channel import Channel, ChannelMember, PendingChannel
+
+
+class FakeGateway(object):
+    """The FlowIRCGateway attributes used by the notification handler.
+    Flow calls are kept in 'calls' until they are completed.
+    """
+
+    def __init__(self):
+        self.stats = stats.Counters()
+        self.timers = timers.TimerWheel()
+        self.subscriptions = subscriptions.Subscriptions()
+        self.attachment_server = None
+        self.calls = []  # (func, on_success, on_failure)
+
+    def call_flow_with_retry(self, description, func, on_success,
+                             backoff=None, on_failure=None):
+        self.calls.append((func, on_success, on_failure))
+
+    def complete_calls(self):
+        """Completes the outstanding Flow calls."""
+        (calls, self.calls) = (self.calls, [])
+        for (func, on_success, _) in calls:
+            on_success(func())
+
+
+class FakeSession(object):
+    """The FlowSession attributes used by the notification handler."""
+
+    show_timestamps = False
+
+    def __init__(self):
+        self.gateway = FakeGateway()
+        self.channels = {}
+        self.pending_channels = {}
+        self.loading_channels = set()
+        self.reloading_channels = {}
+        self.unsubscribed_channels = set()
+        self.sent_messages = {}
+        self.clients = {}
+        self.reorder_buffer = notification.ReorderBuffer(self)
+        self.notifications = []  # lines sent to the clients
+        self.member_loads = []  # channelIds
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def add_channel(self, channel):
+        # (as FlowSession.add_channel: the reorder buffer is left to
+        # the caller)
+        self.channels[channel.channel_id] = channel
+        self.directory_changed()
+
+    def get_channel_members(self, channel):
+        self.member_loads.append(channel.channel_id)
+        for account_id in ("a1", "a2"):
+            if not channel.get_member_from_account_id(account_id):
+                channel.add_member(ChannelMember(account_id, account_id, "O"))
+
+    def reload_channel(self, channel, on_loaded):
+        self.reloading_channels[channel.channel_id] = [on_loaded]
+
+        def loaded(_):
+            for callback in self.reloading_channels.pop(channel.channel_id):
+                callback()
+        channel.evicted = False
+        self.gateway.call_flow_with_retry(
+            "enumerate_channel_members",
+            lambda: self.get_channel_members(channel), loaded)
+
+    def get_username_from_id(self, account_id):
+        return account_id
+
+    def check_channel_collision(self, channel):
+        pass
+
+    def directory_changed(self):
+        pass
+
+    def store_messages(self, messages, channel=None):
+        pass
+
+    def notify_clients(self, line, *_):
+        self.notifications.append(line)
+
+
+def regular_message(message_id, channel_id, sender="a2"):
+    """Returns a Flow message dict."""
+    return {"id": message_id, "channelId": channel_id,
+            "senderAccountId": sender, "text": message_id,
+            "creationTime": 1}
+
+
+def channel_message(channel_id):
+    """Returns a 'ChannelMessages' entry of a 'message' notification."""
+    return {"id": channel_id, "name": "chan", "purpose": ""}
+
+
+class NotificationHandlerTest(unittest.TestCase):
+    """Tests of notification.NotificationHandler."""
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.handler = notification.NotificationHandler(self.session)
+
+    def test_events_before_channel(self):
+        """Events of a channel not added yet are processed once it is,
+        in arrival order, messages deduplicated.
+        """
+        self.session.pending_channels["c1"] = PendingChannel(
+            "c1", "", "o1", "O")
+        self.handler.process_regular_message(regular_message("m1", "c1"))
+        self.handler.channel_member_notification(
+            [{"channelId": "c1", "accountId": "a3"}])
+        self.handler.process_regular_message(regular_message("m1", "c1"))
+        self.handler.process_regular_message(
+            regular_message("m2", "c1", "a3"))
+        self.assertEqual(len(self.session.reorder_buffer), 4)
+        self.handler.process_channel_message(channel_message("c1"))
+        self.session.gateway.complete_calls()
+        self.assertEqual(self.session.notifications, [
+            ":a2(O)!@ PRIVMSG #chan(O) :m1",
+            ":a3(O)!@ JOIN :#chan(O)",
+            ":a3(O)!@ PRIVMSG #chan(O) :m2"])
+        self.assertEqual(self.session.gateway.stats.get("reorder.duplicates"),
+                         1)
+        self.assertEqual(self.session.pending_channels, {})
+
+    def test_channel_message_while_loading(self):
+        """A ChannelMessage received while the members of the channel
+        are loaded does not load them again.
+        """
+        self.session.pending_channels["c1"] = PendingChannel(
+            "c1", "", "o1", "O")
+        self.handler.process_channel_message(channel_message("c1"))
+        self.handler.process_channel_message(channel_message("c1"))
+        self.assertEqual(len(self.session.gateway.calls), 1)
+        self.session.gateway.complete_calls()
+        self.handler.process_channel_message(channel_message("c1"))
+        self.assertEqual(self.session.member_loads, ["c1"])
+        self.assertEqual(self.session.loading_channels, set())
+        self.assertIn("c1", self.session.channels)
+
+    def test_loading_failure(self):
+        """A channel whose members could not be loaded is loaded again
+        on the next ChannelMessage.
+        """
+        self.session.pending_channels["c1"] = PendingChannel(
+            "c1", "", "o1", "O")
+        self.handler.process_channel_message(channel_message("c1"))
+        (_, _, on_failure) = self.session.gateway.calls.pop()
+        on_failure(Exception("Flow is down"))
+        self.handler.process_channel_message(channel_message("c1"))
+        self.assertEqual(len(self.session.gateway.calls), 1)
+
+    def test_evicted_channel_events(self):
+        """Events of an evicted channel wait for its members to be
+        reloaded, members are not joined again.
+        """
+        channel = Channel(self.session, "c1", "chan", "o1", "O")
+        self.session.get_channel_members(channel)
+        self.session.add_channel(channel)
+        channel.evict()
+        self.handler.process_regular_message(regular_message("m1", "c1"))
+        self.handler.channel_member_notification(
+            [{"channelId": "c1", "accountId": "a2"}])
+        self.handler.process_regular_message(regular_message("m2", "c1"))
+        self.assertEqual(self.session.notifications, [])
+        self.assertEqual(len(self.session.gateway.calls), 1)
+        self.session.gateway.complete_calls()
+        self.assertEqual(self.session.notifications, [
+            ":a2(O)!@ PRIVMSG #chan(O) :m1",
+            ":a2(O)!@ PRIVMSG #chan(O) :m2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+test_ratelimit.py
+"""
+
+import unittest
+
+from src import ratelimit
+
+
+class ParseLimitTest(unittest.TestCase):
+    """Tests of ratelimit.parse_limit."""
+
+    def test_limits(self):
+        """'BURST/RATE' limits, '0' for no limit."""
+        self.assertEqual(ratelimit.parse_limit("50/10"), (50, 10.0))
+        self.assertEqual(ratelimit.parse_limit("1/0.5"), (1, 0.5))
+        self.assertIsNone(ratelimit.parse_limit(" 0 "))
+
+    def test_bad_limits(self):
+        """Invalid limits raise ValueError."""
+        for value in ("", "10", "0/1", "10/0", "a/b", "-1/1"):
+            self.assertRaises(ValueError, ratelimit.parse_limit, value)
+
+    def test_default_limits(self):
+        """The default limits are valid."""
+        for value in ratelimit.DEFAULT_LIMITS.values():
+            self.assertTrue(ratelimit.parse_limit(value))
+
+
+class TokenBucketTest(unittest.TestCase):
+    """Tests of ratelimit.TokenBucket."""
+
+    def test_burst_then_rate(self):
+        """'burst' tokens at once, then refilled at 'rate' per second."""
+        bucket = ratelimit.TokenBucket(2, 4.0)
+        now = bucket.updated
+        self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0)
+        self.assertAlmostEqual(bucket.take(now), 0.25)
+        self.assertAlmostEqual(bucket.take(now + 0.125), 0.125)
+        self.assertEqual(bucket.take(now + 0.25), 0)
+
+    def test_refill_capped(self):
+        """Idle time does not accumulate more than 'burst' tokens."""
+        bucket = ratelimit.TokenBucket(2, 4.0)
+        now = bucket.updated + 60
+        for _ in range(2):
+            self.assertEqual(bucket.take(now), 0)
+        self.assertTrue(bucket.take(now) > 0)
+
+
+class CommandClassTest(unittest.TestCase):
+    """Tests of the command classes."""
+
+    def test_command_class(self):
+        self.assertEqual(ratelimit.command_class("PRIVMSG"),
+                         ratelimit.MESSAGES)
+        self.assertEqual(ratelimit.command_class("WHO"), ratelimit.QUERIES)
+        self.assertEqual(ratelimit.command_class("JOIN"), ratelimit.OTHER)
+        self.assertIsNone(ratelimit.command_class("PING"))
+
+    def test_client_buckets(self):
+        """Classes without limit get no bucket."""
+        buckets = ratelimit.client_buckets(
+            {ratelimit.MESSAGES: (5, 1.0), ratelimit.QUERIES: None})
+        self.assertEqual(list(buckets), [ratelimit.MESSAGES])
+
+
+if __name__ == "__main__":
+    unittest.main()
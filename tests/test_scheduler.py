@@ -0,0 +1,87 @@
+"""
+test_scheduler.py
+"""
+
+import unittest
+
+from src import scheduler
+from src import stats
+
+
+class WorkSchedulerTest(unittest.TestCase):
+    """Tests of scheduler.WorkScheduler."""
+
+    def setUp(self):
+        self.stats = stats.Counters()
+        self.scheduler = scheduler.WorkScheduler(self.stats, time_slice=10)
+
+    def test_tasks_round_robin(self):
+        """Task steps are interleaved, finished tasks are dropped."""
+        steps = []
+
+        def task(name, count):
+            for index in range(count):
+                steps.append((name, index))
+                yield
+
+        self.scheduler.add_task(task("a", 2))
+        self.scheduler.add_task(task("b", 1))
+        self.scheduler.run_tasks()
+        self.assertEqual(steps, [("a", 0), ("b", 0), ("a", 1)])
+        self.assertFalse(self.scheduler.has_backlog())
+
+    def test_task_budget(self):
+        """A tick runs at most the TASKS budget of steps."""
+        def endless():
+            while True:
+                yield
+
+        self.scheduler.add_task(endless())
+        self.scheduler.run_tasks()
+        self.assertEqual(self.scheduler.budgets[scheduler.TASKS].used,
+                         scheduler.TASK_BUDGET)
+        self.assertTrue(self.scheduler.has_backlog())
+
+    def test_failing_task(self):
+        """A task that raises is dropped, the other tasks go on."""
+        steps = []
+
+        def failing():
+            yield
+            raise KeyError("broken")
+
+        def working():
+            for index in range(3):
+                steps.append(index)
+                yield
+
+        self.scheduler.add_task(failing())
+        self.scheduler.add_task(working())
+        self.scheduler.run_tasks()
+        self.assertEqual(steps, [0, 1, 2])
+        self.assertEqual(self.stats.get("scheduler.task_errors"), 1)
+        self.assertFalse(self.scheduler.has_backlog())
+
+    def test_notification_sources_round_robin(self):
+        """Sources are served one notification each per round."""
+        processed = []
+
+        def source(name, count):
+            pending = [count]
+
+            def process_one(_):
+                if not pending[0]:
+                    return False
+                pending[0] -= 1
+                processed.append(name)
+                return True
+            return (process_one, 0)
+
+        self.scheduler.run_notifications(
+            [source("a", 3), source("b", 1)], 0)
+        self.assertEqual(sorted(processed), ["a", "a", "a", "b"])
+        self.assertEqual(processed[:2], ["b", "a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+test_sendq.py
+"""
+
+import unittest
+
+from src import sendq
+from src import stats
+
+
+class SendQueueTest(unittest.TestCase):
+    """Tests of sendq.SendQueue."""
+
+    def setUp(self):
+        self.stats = stats.Counters()
+
+    def test_lanes_priority(self):
+        """CONTROL lines go before LIVE lines, REPLAY lines last."""
+        queue = sendq.SendQueue(self.stats, 1024)
+        queue.push_replay([b"replay\r\n"])
+        queue.push(b"live\r\n", sendq.LIVE)
+        queue.push(b"control\r\n", sendq.CONTROL)
+        self.assertEqual(queue.peek(), b"control\r\nlive\r\nreplay\r\n")
+
+    def test_consume_returns_marks(self):
+        """Marks are returned once their line is completely sent."""
+        queue = sendq.SendQueue(self.stats, 1024)
+        (first, second) = (object(), object())
+        queue.push(b"one\r\n", sendq.LIVE, mark=first)
+        queue.push(b"two\r\n", sendq.LIVE, mark=second)
+        self.assertEqual(queue.peek(), b"one\r\ntwo\r\n")
+        self.assertEqual(queue.consume(4), [])
+        self.assertEqual(queue.consume(1), [first])
+        self.assertEqual(queue.consume(5), [second])
+        self.assertEqual(len(queue), 0)
+
+    def test_drop_policy(self):
+        """LIVE lines over the limit are dropped and summarised."""
+        queue = sendq.SendQueue(self.stats, 10, sendq.POLICY_DROP)
+        queue.push(b"01234567\r\n", sendq.LIVE, "#a")
+        queue.push(b"dropped\r\n", sendq.LIVE, "#a")
+        self.assertEqual(self.stats.get("sendq.dropped_lines"), 1)
+        queue.consume(len(queue.peek()))
+        self.assertEqual(queue.pop_dropped_summary(), {"#a": 1})
+
+    def test_disconnect_policy(self):
+        """LIVE lines over the limit raise SendQueueFull."""
+        queue = sendq.SendQueue(self.stats, 10, sendq.POLICY_DISCONNECT)
+        queue.push(b"01234567\r\n", sendq.LIVE)
+        self.assertRaises(sendq.SendQueueFull,
+                          queue.push, b"more\r\n", sendq.LIVE)
+
+    def test_hard_limit_applies_to_control(self):
+        """CONTROL lines over the hard limit raise SendQueueFull."""
+        queue = sendq.SendQueue(self.stats, 10)
+        queue.push(b"x" * 38 + b"\r\n", sendq.CONTROL)
+        self.assertRaises(sendq.SendQueueFull,
+                          queue.push, b"ERROR\r\n", sendq.CONTROL)
+
+    def test_replay_paused_over_limit(self):
+        """Replay is not advanced while the queue is over the limit."""
+        queue = sendq.SendQueue(self.stats, 10)
+        queue.push(b"01234567\r\n", sendq.LIVE)
+        queue.push_replay([b"replay\r\n"])
+        self.assertEqual(queue.peek(), b"01234567\r\n")
+        self.assertTrue(queue.has_pending_replay())
+        queue.consume(10)
+        self.assertEqual(queue.peek(), b"replay\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+test_store.py
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from src import store
+
+
+def message(message_id, channel_id, text, creation_time=1):
+    """Returns a Flow message dict."""
+    return {"id": message_id, "channelId": channel_id,
+            "senderAccountId": "a1", "text": text,
+            "creationTime": creation_time}
+
+
+class MessageStoreTest(unittest.TestCase):
+    """Tests of store.MessageStore."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "messages.db")
+        self.search_index = store.SEARCH_INDEX
+
+    def tearDown(self):
+        store.SEARCH_INDEX = self.search_index
+        shutil.rmtree(self.directory)
+
+    def open_store(self):
+        message_store = store.MessageStore(self.path)
+        self.addCleanup(message_store.close)
+        return message_store
+
+    def test_deduplicated_history(self):
+        """Messages are stored once, returned in chronological order."""
+        message_store = self.open_store()
+        self.assertEqual(message_store.add_messages(
+            [message("m2", "c1", "two", 2), message("m1", "c1", "one", 1)]),
+            2)
+        self.assertEqual(message_store.add_messages(
+            [message("m1", "c1", "one", 1)]), 0)
+        self.assertEqual(
+            [msg["id"] for msg in message_store.get_messages("c1", 0)],
+            ["m1", "m2"])
+        self.assertEqual(
+            [msg["id"] for msg in message_store.get_messages("c1", 1)],
+            ["m2"])
+        self.assertEqual(message_store.get_latest_message_times(),
+                         {"c1": 2})
+
+    def test_search_many_channels(self):
+        """Searches are not limited by the SQLite query parameters."""
+        message_store = self.open_store()
+        if not message_store.search_enabled:
+            self.skipTest("SQLite without FTS5")
+        message_store.add_messages([message("m1", "c1", "deploy done"),
+                                    message("m2", "c2", "deploy failed")])
+        channel_ids = ["c%d" % index for index in range(2, 5000)]
+        results = message_store.search(
+            store.build_search_query("deploy"), channel_ids, 10)
+        self.assertEqual([msg["id"] for msg in results], ["m2"])
+
+    def test_search_query(self):
+        """Words are literals, 'from:' and 'in:' match columns."""
+        self.assertEqual(store.build_search_query('a "b" from:bob in:'),
+                         '"a" """b""" sender : "bob"')
+
+    def test_without_fts5(self):
+        """The store opens without FTS5, with the search disabled."""
+        store.SEARCH_INDEX = ["CREATE VIRTUAL TABLE messages_fts "
+                              "USING no_such_module(text)"]
+        message_store = self.open_store()
+        self.assertFalse(message_store.search_enabled)
+        self.assertEqual(message_store.add_messages(
+            [message("m1", "c1", "text")]), 1)
+        self.assertRaises(sqlite3.OperationalError, message_store.search,
+                          '"text"', ["c1"], 10)
+
+    def test_search_index_created_later(self):
+        """Messages stored without FTS5 are indexed once it is
+        available.
+        """
+        store.SEARCH_INDEX = ["CREATE VIRTUAL TABLE messages_fts "
+                              "USING no_such_module(text)"]
+        message_store = self.open_store()
+        message_store.add_messages([message("m1", "c1", "late text")])
+        message_store.close()
+        store.SEARCH_INDEX = self.search_index
+        message_store = self.open_store()
+        if not message_store.search_enabled:
+            self.skipTest("SQLite without FTS5")
+        self.assertEqual(
+            [msg["id"] for msg in message_store.search('"late"', ["c1"], 10)],
+            ["m1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
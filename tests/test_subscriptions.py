@@ -0,0 +1,62 @@
+"""
+test_subscriptions.py
+"""
+
+import unittest
+
+from src import subscriptions
+
+
+class ParsePatternsTest(unittest.TestCase):
+    """Tests of subscriptions.parse_patterns."""
+
+    def test_globs_and_regexps(self):
+        """Globs match the whole name, 're:' patterns are searched."""
+        regexps = subscriptions.parse_patterns("Old Team*, re:^archive-\n")
+        self.assertEqual(len(regexps), 2)
+        self.assertTrue(subscriptions.matches(regexps, "old team 2"))
+        self.assertFalse(subscriptions.matches(regexps, "The Old Team"))
+        self.assertTrue(subscriptions.matches(regexps, "archive-2015"))
+        self.assertFalse(subscriptions.matches(regexps, "my-archive-"))
+
+    def test_empty(self):
+        self.assertEqual(subscriptions.parse_patterns(" , \n"), [])
+
+    def test_bad_regexp(self):
+        self.assertRaises(ValueError, subscriptions.parse_patterns, "re:(")
+
+
+class SubscriptionsTest(unittest.TestCase):
+    """Tests of subscriptions.Subscriptions."""
+
+    def test_everything_by_default(self):
+        rules = subscriptions.Subscriptions()
+        self.assertTrue(rules.wants_org("Any"))
+        self.assertTrue(rules.wants_channel("Any", "general", False))
+
+    def test_orgs(self):
+        """Exclusions apply to the included organizations."""
+        rules = subscriptions.Subscriptions(include_orgs="Team*",
+                                            exclude_orgs="Team Old")
+        self.assertTrue(rules.wants_org("Team A"))
+        self.assertFalse(rules.wants_org("Team Old"))
+        self.assertFalse(rules.wants_org("Other"))
+        self.assertFalse(rules.wants_channel("Other", "dm", True))
+
+    def test_channels(self):
+        """Channel rules do not apply to direct conversations."""
+        rules = subscriptions.Subscriptions(include_channels="dev-*",
+                                            exclude_channels="dev-old")
+        self.assertTrue(rules.wants_channel("Org", "dev-ops", False))
+        self.assertFalse(rules.wants_channel("Org", "dev-old", False))
+        self.assertFalse(rules.wants_channel("Org", "random", False))
+        self.assertTrue(rules.wants_channel("Org", "random", True))
+
+    def test_direct_only(self):
+        rules = subscriptions.Subscriptions(direct_only=True)
+        self.assertFalse(rules.wants_channel("Org", "general", False))
+        self.assertTrue(rules.wants_channel("Org", "dm", True))
+
+
+if __name__ == "__main__":
+    unittest.main()
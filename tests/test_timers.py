@@ -0,0 +1,84 @@
+"""
+test_timers.py
+"""
+
+import time
+import unittest
+
+from src import timers
+
+
+class TimerWheelTest(unittest.TestCase):
+    """Tests of timers.TimerWheel."""
+
+    def setUp(self):
+        self.wheel = timers.TimerWheel(tick=0.1, slots=8)
+        self.now = time.time()
+        self.fired = []
+
+    def test_fires_in_order_of_deadline(self):
+        """Timers fire once their deadline passed, not before."""
+        self.wheel.schedule(0.5, self.fired.append, "late")
+        self.wheel.schedule(0.2, self.fired.append, "early")
+        self.assertEqual(self.wheel.advance(self.now + 0.35), 1)
+        self.assertEqual(self.fired, ["early"])
+        self.wheel.advance(self.now + 0.65)
+        self.assertEqual(self.fired, ["early", "late"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        """Cancelled timers do not fire, cancel() tolerates fired
+        timers and 'None'.
+        """
+        timer = self.wheel.schedule(0.2, self.fired.append, "cancelled")
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.wheel.cancel(None)
+        self.assertFalse(timer.active())
+        self.wheel.advance(self.now + 1)
+        self.assertEqual(self.fired, [])
+
+    def test_several_rounds(self):
+        """Timers beyond a turn of the wheel wait for their round."""
+        self.wheel.schedule(1.25, self.fired.append, "round")
+        self.wheel.advance(self.now + 0.45)
+        self.wheel.advance(self.now + 0.95)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(self.now + 1.45)
+        self.assertEqual(self.fired, ["round"])
+
+    def test_stall(self):
+        """After a stall longer than a turn, the expired timers fire
+        and the others keep their deadline.
+        """
+        self.wheel.schedule(0.5, self.fired.append, "expired")
+        self.wheel.schedule(5, self.fired.append, "pending")
+        self.wheel.advance(self.now + 2)
+        self.assertEqual(self.fired, ["expired"])
+        self.wheel.advance(self.now + 5.2)
+        self.assertEqual(self.fired, ["expired", "pending"])
+
+    def test_failing_callback(self):
+        """A failing callback does not prevent the other timers."""
+        self.wheel.schedule(0.2, lambda: 1 / 0)
+        self.wheel.schedule(0.2, self.fired.append, "fired")
+        self.wheel.advance(self.now + 0.5)
+        self.assertEqual(self.fired, ["fired"])
+
+
+class BackoffTest(unittest.TestCase):
+    """Tests of timers.Backoff."""
+
+    def test_delays(self):
+        """Delays grow up to the maximum, with up to 50% jitter,
+        until the attempts are exhausted.
+        """
+        backoff = timers.Backoff(initial=1, maximum=4, max_attempts=4)
+        for maximum in (1, 2, 4, 4):
+            delay = backoff.next_delay()
+            self.assertTrue(maximum / 2.0 <= delay <= maximum)
+        self.assertIsNone(backoff.next_delay())
+
+
+if __name__ == "__main__":
+    unittest.main()